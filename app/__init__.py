@@ -9,6 +9,20 @@ def create_app(config_filename):
 
     db.init_app(app)
 
+    from .methods import data, outage_map, feature_store, model, metrics, upstream, warmup
+    data.configure_cache(app.config.get('WEATHER_CACHE_TTL'), app.config.get('WEATHER_CACHE_SIZE'),
+                         app.config.get('WEATHER_CACHE_PATH'))
+    outage_map.poller.interval = app.config.get('ODIN_POLL_INTERVAL', 300)
+    feature_store.store.configure(app.config.get('FEATURE_STORE_PATH', feature_store.FEATURE_STORE_PATH))
+    model.forecast_cache.configure(ttl=app.config.get('FORECAST_REFRESH', 3600))
+    model.registry.engine = app.config.get('MODEL_ENGINE') == 'compiled'
+    upstream.configure(failure_threshold=app.config.get('UPSTREAM_FAILURE_THRESHOLD'),
+                       reset_timeout=app.config.get('UPSTREAM_RESET_TIMEOUT'))
+    metrics.configure(app.config.get('METRICS_DIR'), app.config.get('METRICS_INTERVAL', 5))
+    metrics.init_app(app)
+    if app.config.get('WARM_UP'):
+        warmup.warm_up()
+
     with app.app_context():
         #from . import routes
         from .homepage.homepage_views import homepage_bp
@@ -1,22 +1,27 @@
-from xmlrpc.client import Boolean
 from flask import (
     Blueprint, 
-    render_template, 
-    request
+    render_template as flask_render_template, 
+    request,
+    jsonify,
+    current_app,
+    Response,
+    stream_with_context,
+    url_for,
+    abort
 )
 import app.methods.outage_map as om
+import app.methods.risk_map as rm
 import app.methods.helpers as he
-import io
+import os
 import json
 import pandas as pd
-import plotly
+import numpy as np
 import app.methods.data as weather_data
+import app.methods.model as model
+import app.methods.metrics as metrics
+import app.methods.upstream as upstream
+import app.methods.warmup as warmup
 from datetime import datetime, timedelta
-import plotly.graph_objects as go
-import datetime as dt
-from joblib import load
-from sklearn.preprocessing import StandardScaler
-from sklearn.preprocessing import LabelEncoder
 
 
 # Blueprint Configuration
@@ -27,71 +32,158 @@ homepage_bp = Blueprint(
     static_url_path='/homepage/static'
 )
 
+def render_template(template_name, **context):
+    '''
+    Renders a template, timed as the template_render stage
+    '''
+    with metrics.timer('template_render'):
+        return flask_render_template(template_name, **context)
+
 @homepage_bp.route('/')
 def index():
     return render_template('index.html')
 
 @homepage_bp.route('/outage-map', methods=['GET'])
 def outage_map():
+    # The ODIN feed and the county GeoJSON are independent, so a cold worker waits for the slower one only
+    for result in upstream.fan_out([om.poller.get, om.load_counties]):
+        if isinstance(result, Exception):
+            raise result
     real_time = om.OutageMap()
-    fig = real_time.real_time_outages_map()
+    html = real_time.real_time_outages_html()
+
+    nav = True
+    nav_flag = request.args.get('navflag', default = 'True')
+    if nav_flag == "False":
+        nav = False
 
-    buffer = io.StringIO()
-    fig.write_html(buffer, full_html=False, include_plotlyjs='cdn')
+    snapshot = om.poller.get()
+    updated = datetime.utcfromtimestamp(snapshot.fetched_at).strftime('%m/%d/%Y %H:%M UTC')
+    return render_template('outage_map.html', map=html, nav_flag=nav, updated=updated,
+                           age_minutes=int(om.poller.age() // 60))
+
+@homepage_bp.route('/risk-map', methods=['GET'])
+def risk_map():
+    html, result = rm.risk_map_html(current_app.config.get('RISK_MAP_PATH', rm.RISK_MAP_PATH))
 
     nav = True
     nav_flag = request.args.get('navflag', default = 'True')
     if nav_flag == "False":
         nav = False
 
-    return render_template('outage_map.html', map=buffer.getvalue(), nav_flag=nav)
+    if result is None:
+        return render_template('risk_map.html', map=None, nav_flag=nav)
+    updated = datetime.utcfromtimestamp(result['computed_at']).strftime('%m/%d/%Y %H:%M UTC')
+    return render_template('risk_map.html', map=html, nav_flag=nav, updated=updated, hours=result['hours'])
 
 @homepage_bp.route('/search-records', methods=['GET', 'POST'])
 def search_records():
-    if request.method == 'GET':
-        return render_template('search_records.html')
-    if request.method == 'POST':
-        county = request.form['county'].strip()
-        state = request.form['state'].strip()
-        start_date = request.form['start_date'].strip()
-        end_date = request.form['end_date'].strip()
-        if start_date == "":
-            start_date = '2017-01-01'
-        if end_date == "":
-            end_date = '2021-06-28'
-
-        df = he.filter_df_by_location((county, state))
-        df = df[['Start Date', 'End Date', 'County', 'State', 'Number of Customers Affected']]
-        df.loc[df['County'] == 'None', 'County'] = '---'
-        df = he.filter_df_by_date(start_date, end_date, df)
-
-        return render_template('search_records.html', county=county, state=state, start_date=start_date, end_date=end_date, 
-            num_records=df.shape[0], df=df.to_html(classes="table table-striped table-sm table-hover table-bordered", index=False, 
-            justify='center'))
+    return render_search('search_records.html', 'homepage_bp.search_records')
 
 @homepage_bp.route('/search-records-no-nav', methods=['GET', 'POST'])
 def search_records_no_nav():
-    if request.method == 'GET':
-        return render_template('search_records_nonav.html')
-    if request.method == 'POST':
-        county = request.form['county'].strip()
-        state = request.form['state'].strip()
-        start_date = request.form['start_date'].strip()
-        end_date = request.form['end_date'].strip()
-        if start_date == "":
-            start_date = '2017-01-01'
-        if end_date == "":
-            end_date = '2021-06-28'
-
-        df = he.filter_df_by_location((county, state))
-        df = df[['Start Date', 'End Date', 'County', 'State', 'Number of Customers Affected']]
-        df.loc[df['County'] == 'None', 'County'] = '---'
-        df = he.filter_df_by_date(start_date, end_date, df)
-
-        return render_template('search_records_nonav.html', county=county, state=state, start_date=start_date, end_date=end_date, 
-            num_records=df.shape[0], df=df.to_html(classes="table table-striped table-sm table-hover table-bordered", index=False, 
-            justify='center'))
+    return render_search('search_records_nonav.html', 'homepage_bp.search_records_no_nav')
+
+@homepage_bp.route('/search-records/export', methods=['GET'])
+def search_records_export():
+    params = search_params()
+    fmt = request.args.get('format', 'csv')
+    if fmt not in ['csv', 'json']:
+        abort(400, "format must be 'csv' or 'json'")
+
+    store = he.get_store()
+    rows = store.query_rows(params['county'], params['state'], params['start_date'], params['end_date'])
+    rows = store.sorted_rows(rows, params['sort'], params['order'] == 'desc')
+
+    def generate_csv():
+        yield ','.join(he.RESULT_COLUMNS) + '\n'
+        for chunk in store.iter_records(rows):
+            yield chunk.to_csv(index=False, header=False)
+
+    def generate_json():
+        yield '['
+        first = True
+        for chunk in store.iter_records(rows):
+            yield ('' if first else ',') + chunk.to_json(orient='records')[1:-1]
+            first = False
+        yield ']'
+
+    if fmt == 'csv':
+        response = Response(stream_with_context(generate_csv()), mimetype='text/csv')
+    else:
+        response = Response(stream_with_context(generate_json()), mimetype='application/json')
+    response.headers['Content-Disposition'] = f'attachment; filename=outage_records.{fmt}'
+    return response
+
+def search_params():
+    '''
+    Reads search parameters from a submitted form or from the query string
+    '''
+    values = request.values
+    params = {
+        'county': values.get('county', '').strip(),
+        'state': values.get('state', '').strip(),
+        'start_date': values.get('start_date', '').strip() or '2017-01-01',
+        'end_date': values.get('end_date', '').strip() or '2021-06-28',
+        'sort': values.get('sort', 'Start Date'),
+        'order': 'desc' if values.get('order') == 'desc' else 'asc',
+    }
+    if params['sort'] not in he.SORT_COLUMNS:
+        params['sort'] = 'Start Date'
+    return params
+
+def render_search(template, endpoint):
+    '''
+    Renders one page of search results. The first page is requested by submitting the form,
+    following pages by GET links carrying the search parameters and a keyset cursor
+    '''
+    if request.method == 'GET' and 'state' not in request.args:
+        return render_template(template, sort_columns=he.SORT_COLUMNS)
+
+    params = search_params()
+    cursor = request.values.get('cursor') or None
+    limit = current_app.config.get('SEARCH_PAGE_SIZE', 100)
+
+    store = he.get_store()
+    rows = store.query_rows(params['county'], params['state'], params['start_date'], params['end_date'])
+    try:
+        page_rows, next_cursor = store.page(rows, params['sort'], params['order'] == 'desc', cursor, limit)
+    except ValueError as e:
+        abort(400, str(e))
+
+    df = store.df.iloc[page_rows][he.RESULT_COLUMNS].copy()
+    df.loc[df['County'].isin(['None', '']) | df['County'].isna(), 'County'] = '---'
+
+    return render_template(template, **params, sort_columns=he.SORT_COLUMNS, num_records=len(rows),
+        df=df.to_html(classes="table table-striped table-sm table-hover table-bordered", index=False, justify='center'),
+        first_url=url_for(endpoint, **params) if cursor else None,
+        next_url=url_for(endpoint, **params, cursor=next_cursor) if next_cursor else None,
+        csv_url=url_for('homepage_bp.search_records_export', **params, format='csv'),
+        json_url=url_for('homepage_bp.search_records_export', **params, format='json'))
+
+
+def weather_graph(day, dateTime, temp, humidity, precip, snow, snow_depth, windgust, windspeed):
+    '''
+    Builds the hourly weather chart of the real-time weather pages and returns it as plotly JSON.
+    plotly is imported on first use rather than at startup
+    '''
+    import plotly
+    import plotly.graph_objects as go
+
+    with metrics.timer('figure_build'):
+        fig1 = go.Figure()
+        fig1.add_trace(go.Scatter(x=dateTime, y=temp, name='Temperature', line=dict(color='black')))
+        fig1.add_trace(go.Scatter(x=dateTime, y=humidity, name='Humidity', line=dict(color='red')))
+        fig1.add_trace(go.Scatter(x=dateTime, y=precip, name='precipitation', line=dict(color='blue')))
+        fig1.add_trace(go.Scatter(x=dateTime, y=snow, name='Snow', line=dict(color='green')))
+        fig1.add_trace(go.Scatter(x=dateTime, y=snow_depth, name='Snow Depth', line=dict(color='yellow')))
+        fig1.add_trace(go.Scatter(x=dateTime, y=windgust, name='Wind Gust', line=dict(color='orange')))
+        fig1.add_trace(go.Scatter(x=dateTime, y=windspeed, name='Wind Speed', line=dict(color='violet')))
 
+        fig1.update_layout(title='Temperature Forecast for ' + day,
+                          xaxis_title='Time',
+                          yaxis_title='Weather Conditions')
+        return json.dumps(fig1, cls=plotly.utils.PlotlyJSONEncoder)
 
 @homepage_bp.route('/real-time-weather', methods=['GET', 'POST'])
 def real_time_weather():
@@ -149,19 +241,7 @@ def real_time_weather():
         dataframe['windspeed'] = windspeed
 
         # creating the graph for the dataframe
-        fig1 = go.Figure()
-        fig1.add_trace(go.Scatter(x=dateTime, y=temp, name='Temperature', line=dict(color='black')))
-        fig1.add_trace(go.Scatter(x=dateTime, y=humidity, name='Humidity', line=dict(color='red')))
-        fig1.add_trace(go.Scatter(x=dateTime, y=precip, name='precipitation', line=dict(color='blue')))
-        fig1.add_trace(go.Scatter(x=dateTime, y=snow, name='Snow', line=dict(color='green')))
-        fig1.add_trace(go.Scatter(x=dateTime, y=snow_depth, name='Snow Depth', line=dict(color='yellow')))
-        fig1.add_trace(go.Scatter(x=dateTime, y=windgust, name='Wind Gust', line=dict(color='orange')))
-        fig1.add_trace(go.Scatter(x=dateTime, y=windspeed, name='Wind Speed', line=dict(color='violet')))
-
-        fig1.update_layout(title='Temperature Forecast for ' + day1,
-                          xaxis_title='Time',
-                          yaxis_title='Weather Conditions')
-        graphJSON = json.dumps(fig1, cls=plotly.utils.PlotlyJSONEncoder)
+        graphJSON = weather_graph(day1, dateTime, temp, humidity, precip, snow, snow_depth, windgust, windspeed)
 
         return render_template('real_time_weather.html', description=description, search=search,
                                 dateTime1=day1, description1=des_day1, temp_min1=temp_min, 
@@ -223,19 +303,7 @@ def real_time_weather_no_nav():
         dataframe['windspeed'] = windspeed
 
         # creating the graph for the dataframe
-        fig1 = go.Figure()
-        fig1.add_trace(go.Scatter(x=dateTime, y=temp, name='Temperature', line=dict(color='black')))
-        fig1.add_trace(go.Scatter(x=dateTime, y=humidity, name='Humidity', line=dict(color='red')))
-        fig1.add_trace(go.Scatter(x=dateTime, y=precip, name='precipitation', line=dict(color='blue')))
-        fig1.add_trace(go.Scatter(x=dateTime, y=snow, name='Snow', line=dict(color='green')))
-        fig1.add_trace(go.Scatter(x=dateTime, y=snow_depth, name='Snow Depth', line=dict(color='yellow')))
-        fig1.add_trace(go.Scatter(x=dateTime, y=windgust, name='Wind Gust', line=dict(color='orange')))
-        fig1.add_trace(go.Scatter(x=dateTime, y=windspeed, name='Wind Speed', line=dict(color='violet')))
-
-        fig1.update_layout(title='Temperature Forecast for ' + day1,
-                          xaxis_title='Time',
-                          yaxis_title='Weather Conditions')
-        graphJSON = json.dumps(fig1, cls=plotly.utils.PlotlyJSONEncoder)
+        graphJSON = weather_graph(day1, dateTime, temp, humidity, precip, snow, snow_depth, windgust, windspeed)
 
         return render_template('real_time_weather_nonav.html', description=description, search=search,
                                 dateTime1=day1, description1=des_day1, temp_min1=temp_min, 
@@ -246,128 +314,85 @@ def reg_model():
     if request.method == 'GET':
         return render_template('model.html')
     elif request.method == 'POST':
-        current = datetime.today().strftime('%Y-%m-%d')
-        enddate = (datetime.today()+timedelta(days=7)).strftime('%Y-%m-%d')
-
-        county = request.form['county']
-        state = request.form['state']
-        start_date = request.form['start_date']
-
-        now = dt.datetime.utcnow()
-        start = dt.datetime.strptime(start_date, '%Y-%m-%d %H:%M')
-        hours = abs(now-start).total_seconds() / 3600
-
-        loc = county
-        if loc != '':
-            loc = loc + ', ' + state
-        else:
-            loc = state
-        # Get current weather data for location
-        current = weather_data.get_weather(loc, current, enddate)
-        df = weather_data.get_rel_data(current)
-        df['Outage'] = 1
-        df['hours'] = hours
-        df['State'] = state
-
-        model_states = ['Alabama', 'Alaska', 'Arizona', 'Arkansas', 'California',
-                        'Colorado', 'Connecticut', 'Delaware', 'Florida', 'Georgia',
-                        'Idaho', 'Illinois', 'Indiana', 'Iowa', 'Kansas', 'Kentucky',
-                        'Louisiana', 'Maine', 'Maryland', 'Michigan', 'Minnesota',
-                        'Mississippi', 'Missouri', 'Montana', 'Nebraska', 'Nevada',
-                        'New Hampshire', 'New Jersey', 'New Mexico', 'New York',
-                        'North Carolina', 'North Dakota', 'Ohio', 'Oklahoma', 'Oregon',
-                        'Pennsylvania', 'Rhode Island', 'South Carolina', 'South Dakota',
-                        'Tennessee', 'Texas', 'Utah', 'Vermont', 'Virginia', 'Washington',
-                        'West Virginia', 'Wisconsin', 'Wyoming']
-        if state in model_states:
-            df['State'] = model_states.index(state)
-        else:
-            df['State'] = len(model_states)
-
-        df = normalize_data(df.copy())
-        xgb_model = load('reg_model.joblib')
-        y = xgb_model.predict(df)
-        
-        pred = f"{y} Customers to be Affected"
-        if y[0] <= 2:
-            pred = "Outage unlikely to occur based on current weather conditions (Model predicts < 2 people affected)"
-        
-        return render_template('model.html', pred=pred, county=county, state=state, start_date=start_date)
+        county, state, start_date, pred, timeline = predict_from_form(request.form)
+        return render_template('model.html', pred=pred, timeline=timeline, county=county, state=state, start_date=start_date)
 
 @homepage_bp.route('/regression-model-no-nav', methods=['GET', 'POST'])
 def reg_model_no_nav():
     if request.method == 'GET':
         return render_template('model_nonav.html')
     elif request.method == 'POST':
-        current = datetime.today().strftime('%Y-%m-%d')
-        enddate = (datetime.today()+timedelta(days=7)).strftime('%Y-%m-%d')
-
-        county = request.form['county']
-        state = request.form['state']
-        start_date = request.form['start_date']
-
-        now = dt.datetime.utcnow()
-        start = dt.datetime.strptime(start_date, '%Y-%m-%d %H:%M')
-        hours = abs(now-start).total_seconds() / 3600
-
-        loc = county
-        if loc != '':
-            loc = loc + ', ' + state
-        else:
-            loc = state
-        # Get current weather data for location
-        current = weather_data.get_weather(loc, current, enddate)
-        df = weather_data.get_rel_data(current)
-        df['Outage'] = 1
-        df['hours'] = hours
-        df['State'] = state
-
-        model_states = ['Alabama', 'Alaska', 'Arizona', 'Arkansas', 'California',
-                        'Colorado', 'Connecticut', 'Delaware', 'Florida', 'Georgia',
-                        'Idaho', 'Illinois', 'Indiana', 'Iowa', 'Kansas', 'Kentucky',
-                        'Louisiana', 'Maine', 'Maryland', 'Michigan', 'Minnesota',
-                        'Mississippi', 'Missouri', 'Montana', 'Nebraska', 'Nevada',
-                        'New Hampshire', 'New Jersey', 'New Mexico', 'New York',
-                        'North Carolina', 'North Dakota', 'Ohio', 'Oklahoma', 'Oregon',
-                        'Pennsylvania', 'Rhode Island', 'South Carolina', 'South Dakota',
-                        'Tennessee', 'Texas', 'Utah', 'Vermont', 'Virginia', 'Washington',
-                        'West Virginia', 'Wisconsin', 'Wyoming']
-        if state in model_states:
-            df['State'] = model_states.index(state)
-        else:
-            df['State'] = len(model_states)
-
-        df = normalize_data(df.copy())
-        xgb_model = load('reg_model.joblib')
-        y = xgb_model.predict(df)
-
-        pred = f"{y} Customers to be Affected"
-        if y[0] <= 2:
-            pred = "Outage unlikely to occur based on current weather conditions (Model predicts < 2 people affected)"
-        
-        return render_template('model_nonav.html', pred=pred, county=county, state=state, start_date=start_date)
-
-def normalize_data(df):
-    mean_std_dict = {'State': [23.487577957264083, 13.852090218156427],
-                    'Outage': [0.01435180451896534, 0.1189370043776488],
-                    'AWND': [3.6046979067938993, 1.4829674266885424],
-                    'PRCP': [2.6506215026527857, 6.174512701716785],
-                    'SNOW': [2.154551489298647, 13.406634232864967],
-                    'SNWD': [17.32275710760568, 72.79354447532016],
-                    'TMAX': [18.445801819436678, 11.322569065874935],
-                    'TMIN': [6.772201132654679, 10.388184118762583],
-                    'Fog': [0.6803496574992333, 0.4663440579303284],
-                    'Thunder': [0.24240875166138431, 0.4285429917670362],
-                    'Hail': [0.010620079746447193, 0.10250574586962279],
-                    'Dust': [0.0050991718638176056, 0.07122664631620647],
-                    'Tornado': [0.000830692158266026, 0.02880994127495925],
-                    'Wind': [0.00011501891422144975, 0.010724138876776201],
-                    'Snow': [2.5559758715877723e-05, 0.005055633695301739],
-                    'hours': [1.2550957638702203, 13.112778029383072],
-                    'Season_Fall': [0.2230983539515387, 0.4163264266446045],
-                    'Season_Spring': [0.28217973622329007, 0.4500632414908624],
-                    'Season_Summer': [0.23780799509252631, 0.42574366585275464],
-                    'Season_Winter': [0.2569139147326449, 0.43693431425849816]}
-    for col in df.columns:
-        df[col] = df[col].apply(lambda x: (x - mean_std_dict[col][0])/mean_std_dict[col][1])
-    return df
\ No newline at end of file
+        county, state, start_date, pred, timeline = predict_from_form(request.form)
+        return render_template('model_nonav.html', pred=pred, timeline=timeline, county=county, state=state, start_date=start_date)
+
+@homepage_bp.route('/regression-model/batch', methods=['POST'])
+def reg_model_batch():
+    payload = request.get_json(silent=True)
+    if not isinstance(payload, dict) or not isinstance(payload.get('records'), list):
+        return jsonify({'error': "Expected a JSON body of the form {'records': [{'county', 'state', 'start_date'}, ...]}"}), 400
+
+    records = payload['records']
+    max_records = current_app.config.get('BATCH_MAX_RECORDS', 5000)
+    if len(records) > max_records:
+        return jsonify({'error': f'A batch may contain at most {max_records} records'}), 400
+    if not all(isinstance(record, dict) for record in records):
+        return jsonify({'error': 'Each record must be an object'}), 400
+
+    results = model.predict_batch(records, current_app.config.get('BATCH_WEATHER_WORKERS', 16))
+    return jsonify({'model_version': model.registry.version, 'predictions': results})
+
+@homepage_bp.route('/regression-model/forecast', methods=['GET'])
+def reg_model_forecast():
+    county = request.args.get('county', '')
+    state = request.args.get('state', '').strip()
+    start_date = request.args.get('start_date', '')
+    if state == '':
+        return jsonify({'error': 'state is required'}), 400
+    try:
+        model.outage_hours(start_date)
+    except ValueError:
+        return jsonify({'error': "start_date must be in the form of 'YYYY-MM-DD HH:MM'"}), 400
+
+    timeline = model.forecast_timeline(county, state, start_date)
+    return jsonify({'model_version': model.registry.version, 'county': county, 'state': state,
+                    'start_date': start_date, 'timeline': timeline})
+
+@homepage_bp.route('/regression-model/info', methods=['GET'])
+def reg_model_info():
+    model.registry.get()
+    return jsonify(model.registry.info())
+
+@homepage_bp.route('/ready', methods=['GET'])
+def ready():
+    '''
+    Readiness check. Loads any asset this worker is still missing and answers 503 until all are loaded
+    '''
+    status = warmup.warm_up()
+    return jsonify({'ready': warmup.ready(), 'pid': os.getpid(), 'assets': status}), 200 if warmup.ready() else 503
+
+@homepage_bp.route('/metrics', methods=['GET'])
+def metrics_endpoint():
+    '''
+    Per-stage latency histograms and cache and upstream counters in the Prometheus text format,
+    summed over every worker when METRICS_DIR is set
+    '''
+    return Response(metrics.render(), content_type=metrics.CONTENT_TYPE)
+
+def predict_from_form(form):
+    '''
+    Runs a single prediction from the regression model form and returns
+    (county, state, start_date, prediction message, 7 day forecast timeline)
+    '''
+    county = form['county']
+    state = form['state']
+    start_date = form['start_date']
+
+    # The first day of the timeline is the current prediction
+    timeline = model.forecast_timeline(county, state, start_date)
+    y = np.array([timeline[0]['customers_affected']], dtype=np.float32)
+
+    pred = f"{y} Customers to be Affected"
+    if y[0] <= 2:
+        pred = "Outage unlikely to occur based on current weather conditions (Model predicts < 2 people affected)"
+
+    return county, state, start_date, pred, timeline
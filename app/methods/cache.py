@@ -0,0 +1,170 @@
+import os
+import json
+import time
+import sqlite3
+import threading
+from collections import OrderedDict
+
+class _Call:
+    '''Private holder for the result of an in-flight fetch shared by concurrent callers'''
+    def __init__(self):
+        self.event = threading.Event()
+        self.result = None
+        self.error = None
+
+class TTLCache:
+    def __init__(self, ttl=900, maxsize=512, path=None):
+        '''
+        A bounded LRU cache whose entries expire after a fixed time to live. Concurrent
+        lookups of the same missing key are collapsed into a single fetch, and entries can
+        optionally be persisted to a SQLite file so they survive worker restarts. Values
+        must be JSON serializable when persistence is enabled.
+
+        Optional arguments:\n
+        ttl -- Seconds an entry stays valid. Defaults to 900\n
+        maxsize -- Maximum number of entries kept in memory. Defaults to 512\n
+        path -- Path of a SQLite file used to persist entries. Defaults to None (memory only)
+        '''
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()   # key -> (expires, value), oldest first
+        self._inflight = {}
+        self.path = None
+        self._db = None
+        self._db_pid = None
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.waits = 0
+        self.evictions = 0
+        self.configure(ttl, maxsize, path)
+
+    def configure(self, ttl=None, maxsize=None, path=None):
+        '''
+        Updates the cache settings. Opens the SQLite store if a path is given
+        '''
+        with self._lock:
+            if ttl is not None:
+                self.ttl = ttl
+            if maxsize is not None:
+                self.maxsize = maxsize
+            if path:
+                self.path = path
+                self._db_pid = None
+                self._database()
+            self._evict()
+
+    def _database(self):
+        '''
+        Private method returning this process's SQLite connection, or None when persistence is off.
+        The connection is reopened after a fork, as SQLite connections must not be shared between
+        processes. Caller holds the lock
+        '''
+        if self.path is None:
+            return None
+        if self._db_pid != os.getpid():
+            self._db = sqlite3.connect(self.path, check_same_thread=False)
+            self._db.execute('CREATE TABLE IF NOT EXISTS cache (key TEXT PRIMARY KEY, expires REAL, value TEXT)')
+            self._db.commit()
+            self._db_pid = os.getpid()
+        return self._db
+
+    def _evict(self):
+        '''Private method to drop least recently used entries beyond maxsize. Caller holds the lock'''
+        while len(self._entries) > self.maxsize:
+            self._entries.popitem(last=False)
+            self.evictions += 1
+
+    def _lookup(self, key, now):
+        '''Private method to find a live entry in memory, then on disk. Caller holds the lock'''
+        entry = self._entries.get(key)
+        if entry is not None:
+            if entry[0] > now:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return True, entry[1]
+            del self._entries[key]
+
+        db = self._database()
+        if db is not None:
+            row = db.execute('SELECT expires, value FROM cache WHERE key = ?', (key,)).fetchone()
+            if row is not None and row[0] > now:
+                value = json.loads(row[1])
+                self._entries[key] = (row[0], value)
+                self._evict()
+                self.disk_hits += 1
+                return True, value
+        return False, None
+
+    def _store(self, key, value):
+        '''Private method to save a freshly fetched value. Caller holds the lock'''
+        expires = time.time() + self.ttl
+        self._entries[key] = (expires, value)
+        self._entries.move_to_end(key)
+        self._evict()
+        db = self._database()
+        if db is not None:
+            db.execute('INSERT OR REPLACE INTO cache VALUES (?, ?, ?)', (key, expires, json.dumps(value)))
+            db.execute('DELETE FROM cache WHERE expires <= ?', (time.time(),))
+            db.commit()
+
+    def get(self, key, fetch):
+        '''
+        Returns the cached value for key, calling fetch() to produce it on a miss. If another
+        caller is already fetching the same key, waits for and shares that result instead.
+        Exceptions raised by fetch, including BaseExceptions such as gevent.Timeout, are
+        propagated to every waiting caller and not cached
+
+        Keyword arguments:\n
+        key -- A str identifying the value\n
+        fetch -- A zero argument callable returning the value
+        '''
+        with self._lock:
+            found, value = self._lookup(key, time.time())
+            if found:
+                return value
+            call = self._inflight.get(key)
+            leader = call is None
+            if leader:
+                call = self._inflight[key] = _Call()
+                self.misses += 1
+            else:
+                self.waits += 1
+
+        if not leader:
+            call.event.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result
+
+        try:
+            call.result = fetch()
+        except BaseException as e:
+            call.error = e
+            raise
+        else:
+            with self._lock:
+                self._store(key, call.result)
+        finally:
+            with self._lock:
+                del self._inflight[key]
+            call.event.set()
+        return call.result
+
+    def clear(self):
+        '''
+        Removes every entry from memory and disk
+        '''
+        with self._lock:
+            self._entries.clear()
+            db = self._database()
+            if db is not None:
+                db.execute('DELETE FROM cache')
+                db.commit()
+
+    def stats(self):
+        '''
+        Returns a dict of cache counters
+        '''
+        with self._lock:
+            return {'size': len(self._entries), 'hits': self.hits, 'disk_hits': self.disk_hits,
+                    'misses': self.misses, 'waits': self.waits, 'evictions': self.evictions}
@@ -1,15 +1,55 @@
-import requests
-from statistics import mean
+import os
 import datetime as dt
+import numpy as np
 import pandas as pd
+from app.methods import metrics, upstream
+from app.methods.cache import TTLCache
+from app.methods.feature_store import SEASON_COLUMNS, season_features, to_days
 
-base = 'https://weather.visualcrossing.com/VisualCrossingWebServices/rest/services/timeline/'
+# Overridable so a local fake server can stand in for Visual Crossing
+base = os.environ.get('WEATHER_API_BASE', 'https://weather.visualcrossing.com/VisualCrossingWebServices/rest/services/timeline/')
 #api_key = str(os.getenv('API_KEY'))
 ApiKey='NHBDAL2QBK7KADAS2TY42G6XG'
 #UnitGroup sets the units of the output - us or metric
 UnitGroup='metric'
+# (connect, read) timeouts in seconds
+Timeout = (3.05, 10)
+
+client = upstream.UpstreamClient('visual_crossing', timeout=Timeout)
+weather_cache = TTLCache(ttl=900, maxsize=512)
+metrics.register_cache('weather', weather_cache)
+
+def configure_cache(ttl=None, maxsize=None, path=None):
+    '''
+    Updates the weather cache settings
+
+    Optional arguments:\n
+    ttl -- Seconds a response stays cached\n
+    maxsize -- Maximum number of responses kept in memory\n
+    path -- Path of a SQLite file used to persist responses across restarts
+    '''
+    weather_cache.configure(ttl, maxsize, path)
+
+def cache_key(location, startDate, endDate):
+    '''
+    Returns the cache key for a weather query. Locations are compared case and whitespace insensitively
+    '''
+    location = ' '.join(str(location).lower().replace(',', ', ').split())
+    return f'{location}|{startDate}|{endDate}|{UnitGroup}'
 
 def get_weather(location, startDate, endDate):
+    '''
+    Returns Visual Crossing timeline data for a location, served from the weather cache when possible
+
+    Keyword arguments:\n
+    location -- A location str such as 'Middlesex County, New Jersey'\n
+    startDate -- A start date in the form of 'YYYY-MM-DD' or ''\n
+    endDate -- An end date in the form of 'YYYY-MM-DD' or ''
+    '''
+    return weather_cache.get(cache_key(location, startDate, endDate),
+                             lambda: fetch_weather(location, startDate, endDate))
+
+def fetch_weather(location, startDate, endDate):
     # Location for the weather data
     Location = str(location)
     Location = Location.replace(' ', '%20')
@@ -40,68 +80,98 @@ def get_weather(location, startDate, endDate):
     # values include days,hours,current,alerts
     # Include = "days"
     # we can specify the date range of information we are interested in the format yyyy-mm-dd
-    response = requests.get(apiQuery)
-    data = response.json()
+    data = client.get_json(apiQuery)
     return data
 
+def get_weather_many(locations, startDate, endDate, max_workers=16):
+    '''
+    Fetches weather for several locations concurrently
+
+    Keyword arguments:\n
+    locations -- An iterable of location strings\n
+    startDate -- A start date in the form of 'YYYY-MM-DD'\n
+    endDate -- An end date in the form of 'YYYY-MM-DD'
+
+    Optional arguments:\n
+    max_workers -- Maximum number of requests in flight. Defaults to 16
+
+    Return: A dict mapping each location to its response, or to the exception raised fetching it
+    '''
+    locations = list(dict.fromkeys(locations))
+    calls = [lambda location=location: get_weather(location, startDate, endDate) for location in locations]
+    return dict(zip(locations, upstream.fan_out(calls, max_workers)))
+
+# Event labels set when their keyword appears in a day's description
+EVENT_LABELS = {'Fog': 'fog', 'Thunder': 'thunder', 'Hail': 'hail', 'Dust': 'dust',
+                'Tornado': 'tornado', 'Wind': 'wind', 'Snow': 'snow'}
+REL_COLUMNS = ['TMIN', 'TMAX', 'PRCP', 'SNOW', 'SNWD', 'AWND'] + SEASON_COLUMNS + list(EVENT_LABELS)
+
+@metrics.timer('feature_extraction')
+def get_rel_data_many(responses, days=None, current_conditions=False):
+    '''
+    Extracts relevant data from many api calls in one pass, one row per (location, day).
+    Hourly values are averaged per day, seasons come from each day's date and event labels
+    from each day's description (or the response's description if a day has none)
+
+    Keyword arguments:\n
+    responses -- A dict mapping locations to Visual Crossing timeline responses
+
+    Optional arguments:\n
+    days -- Number of days to keep from each response. Defaults to None (all days)\n
+    current_conditions -- Whether to build rows the way the model's current prediction inputs
+    have always been built: the mean of the first 24 hours with no daily fallback, and event
+    labels from the response's description. Defaults to False
+
+    Return: DataFrame with 'Location' and 'Date' columns followed by REL_COLUMNS
+    '''
+    locations, dates, temps, descriptions, counts, day_values, hourly = [], [], [], [], [], [], []
+    for location, api_data in responses.items():
+        for day in api_data['days'][:days]:
+            hours = (day.get('hours') or [])[:24 if current_conditions else None]
+            locations.append(location)
+            dates.append(day['datetime'])
+            temps.append((day.get('tempmin'), day.get('tempmax')))
+            if current_conditions:
+                descriptions.append(api_data.get('description') or '')
+            else:
+                descriptions.append(day.get('description') or api_data.get('description') or '')
+            day_values.append((day.get('precip'), day.get('snow'), day.get('snowdepth'), day.get('windspeed')))
+            counts.append(len(hours))
+            hourly.extend((h.get('precip'), h.get('snow'), h.get('snowdepth'), h.get('windspeed')) for h in hours)
+
+    n = len(dates)
+    temps = np.array(temps, dtype=np.float64).reshape(n, 2)
+    hourly = np.array(hourly, dtype=np.float64).reshape(-1, 4)
+    day_values = np.array(day_values, dtype=np.float64).reshape(n, 4)
+
+    # Mean of the reported hourly values of each day
+    segment = np.repeat(np.arange(n), counts)
+    reported = ~np.isnan(hourly)
+    sums = np.stack([np.bincount(segment, weights=np.where(reported[:, i], hourly[:, i], 0), minlength=n) for i in range(4)], axis=1)
+    totals = np.stack([np.bincount(segment, weights=reported[:, i], minlength=n) for i in range(4)], axis=1)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        means = sums / totals
+    # Days without hours fall back to daily values. Precipitation and snow are daily totals, so spread them over 24 hours
+    if not current_conditions:
+        fallback = day_values / np.array([24, 24, 1, 1])
+        means = np.where(totals > 0, means, fallback)
+
+    descriptions = pd.Series(descriptions, dtype=object).str.lower()
+    events = np.stack([descriptions.str.contains(keyword, regex=False).to_numpy() for keyword in EVENT_LABELS.values()], axis=1) \
+        if n else np.empty((0, len(EVENT_LABELS)))
+
+    values = np.hstack([temps, means, season_features(to_days(dates)), events.astype(np.float64)])
+    df = pd.DataFrame(values, columns=REL_COLUMNS)
+    df.insert(0, 'Date', dates)
+    df.insert(0, 'Location', locations)
+    return df
+
 def get_rel_data(api_data):
     '''
     Extracts relevant data from api call
-    Return: DataFrame containing relevenat weather information
+    Return: DataFrame containing relevenat weather information for the first day
     '''
-    # Core weather data types
-    temp_min = api_data['days'][0]['tempmin']
-    temp_max = api_data['days'][0]['tempmax']
-    precip = []
-    snow = []
-    snow_depth = []
-    windspeed = []
-
-    month = int(dt.datetime.today().strftime('%m')) - 1
-    seasons = ['Winter', 'Winter', 'Spring', 'Spring', 'Spring', 'Summer', 'Summer', 'Summer', 'Fall', 'Fall', 'Fall', 'Winter']
-    season = seasons[month]
-    season_fall = 1 if season == "Fall" else 0
-    season_winter = 1 if season == "Winter" else 0
-    season_spring = 1 if season == "Spring" else 0
-    season_summer = 1 if season == "Summer" else 0
-
-
-    for i in range (0,24):
-        hours = api_data['days'][0]['hours'][i]
-        precip.append(hours['precip'])
-        snow.append(hours['snow'])
-        snow_depth.append(hours['snowdepth'])
-        windspeed.append(hours['windspeed'])
-
-    precip = mean(precip)
-    snow = mean(snow)
-    snow_depth = mean(snow_depth)
-    windspeed = mean(windspeed)
-
-    # Descriptive labels
-    description = api_data['description'].lower()
-    fog_lbl = thunder_lbl = hail_lbl = dust_lbl = tornado_lbl = wind_lbl = snow_lbl = 0
-    if 'fog' in description:
-        fog_lbl = 1
-    if 'thunder' in description:
-        thunder_lbl = 1
-    if 'hail' in description:
-        hail_lbl = 1
-    if 'dust' in description:
-        dust_lbl = 1
-    if 'tornado' in description:
-        tornado_lbl = 1
-    if 'wind' in description:
-        wind_lbl = 1
-    if 'snow' in description:
-        snow_lbl = 1
-    data = {'TMIN': temp_min, 'TMAX': temp_max, 'PRCP': precip, 
-            'SNOW': snow, 'SNWD': snow_depth, 'AWND': windspeed, 'Season_Fall': season_fall, 
-            'Season_Spring': season_spring, 'Season_Summer': season_summer, 'Season_Winter': season_winter,
-            'Fog': fog_lbl, 'Thunder': thunder_lbl, 'Hail': hail_lbl, 'Dust': dust_lbl, 
-            'Tornado': tornado_lbl, 'Wind': wind_lbl, 'Snow': snow_lbl}
-    df = pd.DataFrame.from_records([data])
-    return df
+    return get_rel_data_many({None: api_data}, days=1, current_conditions=True)[REL_COLUMNS]
 
 if __name__ == '__main__':
     import pandas as pd
@@ -0,0 +1,310 @@
+import os
+import json
+import threading
+import numpy as np
+import pandas as pd
+from pathlib import Path
+from app.methods import fips
+
+FEATURE_STORE_PATH = 'feature_store'
+
+# Daily weather features stored per location, in model order
+COLUMNS = ['AWND', 'PRCP', 'SNOW', 'SNWD', 'TMAX', 'TMIN', 'Fog', 'Thunder', 'Hail', 'Dust', 'Tornado', 'Wind', 'Snow']
+SEASON_COLUMNS = ['Season_Fall', 'Season_Spring', 'Season_Summer', 'Season_Winter']
+# Index into SEASON_COLUMNS for each month
+MONTH_SEASONS = np.array([3, 3, 1, 1, 1, 2, 2, 2, 0, 0, 0, 3])
+
+EPOCH = np.datetime64('1970-01-01', 'D')
+
+def to_days(dates):
+    '''
+    Converts dates (str, date, datetime or array-like of them) to int32 days since 1970-01-01
+    '''
+    try:
+        days = np.asarray(dates, dtype='datetime64[D]')
+    except (ValueError, TypeError):
+        days = pd.to_datetime(dates).values.astype('datetime64[D]')
+    return (days - EPOCH).astype(np.int32)
+
+def season_features(days):
+    '''
+    Returns an (n, 4) array of season one-hots in SEASON_COLUMNS order for an array of days since 1970-01-01
+    '''
+    months = (np.asarray(days).astype('datetime64[D]').astype('datetime64[M]').astype(np.int64) % 12)
+    return np.eye(len(SEASON_COLUMNS))[MONTH_SEASONS[months]]
+
+class FeatureStore:
+    def __init__(self, root=FEATURE_STORE_PATH):
+        '''
+        Append-only table of daily model features keyed by location FIPS code (two digits for
+        a state, five for a county) and date. Rows are stored as flat binary columns that are
+        memory mapped on read, and indexed by (location, date) so a point-in-time lookup is a
+        binary search. Readers pick up rows appended by another process on their next lookup.
+
+        Optional arguments:\n
+        root -- Folder holding the table. Defaults to 'feature_store'
+        '''
+        self._lock = threading.Lock()
+        self.configure(root)
+
+    def configure(self, root):
+        '''
+        Points the store at a different folder
+        '''
+        with self._lock:
+            self.root = Path(root)
+            self._size = None
+            self._index = None
+
+    def _paths(self):
+        '''Private method returning the paths of the metadata and column files'''
+        return (self.root / 'meta.json', self.root / 'locations.i4', self.root / 'days.i4', self.root / 'values.f4')
+
+    def _rows(self):
+        '''Private method returning the number of complete rows on disk. days.i4 is written last'''
+        days_path = self._paths()[2]
+        return days_path.stat().st_size // 4 if days_path.exists() else 0
+
+    def _load(self, rows):
+        '''Private method to memory map the column files and build the (location, date) index'''
+        meta_path, locations_path, days_path, values_path = self._paths()
+        if rows == 0:
+            return {'keys': {}, 'locations': np.empty(0, np.int32), 'days': np.empty(0, np.int32),
+                    'values': np.empty((0, len(COLUMNS)), np.float32), 'order': np.empty(0, np.intp), 'starts': {}}
+
+        with open(meta_path) as f:
+            meta = json.load(f)
+        if meta['columns'] != COLUMNS:
+            raise ValueError(f'Feature store columns {meta["columns"]} do not match {COLUMNS}')
+        locations = np.memmap(locations_path, dtype=np.int32, mode='r', shape=(rows,))
+        days = np.memmap(days_path, dtype=np.int32, mode='r', shape=(rows,))
+        values = np.memmap(values_path, dtype=np.float32, mode='r', shape=(rows, len(COLUMNS)))
+
+        # Rows are appended in any order, so lookups go through a permutation sorted by (location, date)
+        order = np.lexsort((days, locations))
+        sorted_locations = locations[order]
+        bounds = np.flatnonzero(np.diff(sorted_locations)) + 1
+        starts = np.concatenate([[0], bounds])
+        ends = np.concatenate([bounds, [rows]])
+        starts = {int(sorted_locations[s]): (s, e) for s, e in zip(starts, ends)}
+        return {'keys': {key: i for i, key in enumerate(meta['keys'])}, 'locations': locations,
+                'days': days[order], 'values': values, 'order': order, 'starts': starts}
+
+    def index(self):
+        '''
+        Returns the current index, reloading it if rows were appended since it was built
+        '''
+        rows = self._rows()
+        if self._index is None or rows != self._size:
+            with self._lock:
+                if self._index is None or rows != self._size:
+                    self._index = self._load(rows)
+                    self._size = rows
+        return self._index
+
+    def __len__(self):
+        return self._rows()
+
+    def append(self, df):
+        '''
+        Appends daily features, skipping (location, date) pairs that are already stored.
+        Returns the number of rows written
+
+        Keyword arguments:\n
+        df -- A DataFrame with 'Location' (FIPS code), 'Date' and every column in COLUMNS
+        '''
+        meta_path, locations_path, days_path, values_path = self._paths()
+        self.root.mkdir(parents=True, exist_ok=True)
+        index = self.index()
+
+        keys = list(index['keys'])
+        codes = dict(index['keys'])
+        for location in df['Location'].astype(str).unique():
+            if location not in codes:
+                codes[location] = len(keys)
+                keys.append(location)
+
+        locations = df['Location'].astype(str).map(codes).to_numpy(np.int32)
+        days = to_days(df['Date'])
+        # (location, day) pairs packed into one int64 so membership is a single isin
+        existing = index['locations'][index['order']].astype(np.int64) << 32 | index['days'].astype(np.int64) & 0xFFFFFFFF
+        keep = ~np.isin(locations.astype(np.int64) << 32 | days.astype(np.int64) & 0xFFFFFFFF, existing)
+        # Also drop duplicates within df, keeping the last row for a (location, date)
+        keep &= ~pd.DataFrame({'l': locations, 'd': days}).duplicated(keep='last').to_numpy()
+        if not keep.any():
+            return 0
+
+        values = df.reindex(columns=COLUMNS).to_numpy(np.float32)[keep]
+        # Replaced whole so a reader never loads a partly written file
+        with open(f'{meta_path}.tmp', 'w') as f:
+            json.dump({'columns': COLUMNS, 'keys': keys}, f)
+        os.replace(f'{meta_path}.tmp', meta_path)
+        with open(values_path, 'ab') as f:
+            f.write(np.ascontiguousarray(values).tobytes())
+        with open(locations_path, 'ab') as f:
+            f.write(locations[keep].tobytes())
+        with open(days_path, 'ab') as f:
+            f.write(days[keep].tobytes())
+        return int(keep.sum())
+
+    def lookup_many(self, locations, dates, max_age=0, complete=False):
+        '''
+        Point-in-time lookup of many (location, date) pairs. For each pair, returns the latest
+        stored row on or before the date and no more than max_age days older than it
+
+        Keyword arguments:\n
+        locations -- An iterable of FIPS codes\n
+        dates -- An iterable of dates aligned to locations
+
+        Optional arguments:\n
+        max_age -- Maximum number of days a row may lag the requested date. Defaults to 0 (exact date)\n
+        complete -- Whether rows missing any column count as not found, e.g. county rows built
+        from NOAA station data, which has no wind or event columns. Defaults to False
+
+        Return: An (n, len(COLUMNS)) float array and a boolean array marking the pairs that were found
+        '''
+        index = self.index()
+        days = to_days(list(dates))
+        out = np.full((len(days), len(COLUMNS)), np.nan)
+        found = np.zeros(len(days), dtype=bool)
+        for i, (location, day) in enumerate(zip(locations, days)):
+            code = index['keys'].get(str(location))
+            if code not in index['starts']:
+                continue
+            start, end = index['starts'][code]
+            pos = start + np.searchsorted(index['days'][start:end], day, side='right') - 1
+            if pos >= start and day - index['days'][pos] <= max_age:
+                out[i] = index['values'][index['order'][pos]]
+                found[i] = True
+        if complete:
+            found &= ~np.isnan(out).any(axis=1)
+        return out, found
+
+    def lookup(self, location, date, max_age=0, complete=False):
+        '''
+        Returns a one row DataFrame of stored features and season one-hots for a location on a
+        date, or None if the store has no row for it
+
+        Keyword arguments:\n
+        location -- A FIPS code\n
+        date -- A date
+
+        Optional arguments:\n
+        max_age -- Maximum number of days the row may lag date. Defaults to 0\n
+        complete -- Whether a row missing any column counts as not found. Defaults to False
+        '''
+        values, found = self.lookup_many([location], [date], max_age, complete)
+        if not found[0]:
+            return None
+        return pd.DataFrame(np.hstack([values, season_features(to_days([date]))]), columns=COLUMNS + SEASON_COLUMNS)
+
+    def lookup_location(self, county, state, date, max_age=0, complete=False):
+        '''
+        Returns stored features for a county, falling back to its state, or None if neither is stored
+
+        Keyword arguments:\n
+        county -- A county name, or '' for the whole state\n
+        state -- A state name or abbreviation\n
+        date -- A date
+
+        Optional arguments:\n
+        max_age -- Maximum number of days a row may lag date. Defaults to 0\n
+        complete -- Whether to skip rows missing any column, falling back to the next one. Defaults to False
+        '''
+        codes = [fips.resolve(county, state)]
+        if codes[0] is not None and len(codes[0]) == 5:
+            codes.append(codes[0][:2])
+        for code in codes:
+            if code is not None:
+                df = self.lookup(code, date, max_age, complete)
+                if df is not None:
+                    return df
+        return None
+
+    def frame(self, locations=None, start_date=None, end_date=None):
+        '''
+        Returns stored rows as a DataFrame with 'Location', 'Date', COLUMNS and season one-hots,
+        sorted by location and date. Used to build training sets
+
+        Optional arguments:\n
+        locations -- An iterable of FIPS codes to include. Defaults to None (all)\n
+        start_date -- First date to include. Defaults to None (unbounded)\n
+        end_date -- Last date to include. Defaults to None (unbounded)
+        '''
+        index = self.index()
+        keys = list(index['keys'])
+        codes = sorted(index['starts']) if locations is None else \
+            sorted(index['keys'][str(l)] for l in locations if index['keys'].get(str(l)) in index['starts'])
+        lo = None if start_date is None else to_days([start_date])[0]
+        hi = None if end_date is None else to_days([end_date])[0]
+
+        parts = []
+        for code in codes:
+            start, end = index['starts'][code]
+            days = index['days'][start:end]
+            s = start + (0 if lo is None else np.searchsorted(days, lo, side='left'))
+            e = start + (len(days) if hi is None else np.searchsorted(days, hi, side='right'))
+            parts.append((code, s, e))
+
+        rows = np.concatenate([np.arange(s, e) for _, s, e in parts]) if parts else np.empty(0, np.intp)
+        days = index['days'][rows]
+        df = pd.DataFrame(index['values'][index['order'][rows]], columns=COLUMNS)
+        df.insert(0, 'Date', days.astype('datetime64[D]'))
+        df.insert(0, 'Location', [keys[code] for code, s, e in parts for _ in range(e - s)])
+        df[SEASON_COLUMNS] = season_features(days)
+        return df
+
+def weather_data_features(folder):
+    '''
+    Reads the state-wide daily weather csv of a weather_data state folder into rows ready to append
+
+    Keyword arguments:\n
+    folder -- Path of the state folder, e.g. 'weather_data/New_Jersey'
+    '''
+    folder = Path(folder)
+    frames = [pd.read_csv(path, parse_dates=['Date']) for path in folder.glob('*_weather_new_clean.csv')]
+    if not frames:
+        return None
+    df = pd.concat(frames, ignore_index=True)
+    df['Location'] = fips.resolve('', folder.name.replace('_', ' '))
+    return df if df['Location'].notna().all() else None
+
+def materialize_weather_data(store, src='weather_data'):
+    '''
+    Appends every state under weather_data to a store. Days already stored are skipped, so
+    running it again only adds new days. Returns the number of rows written
+
+    Keyword arguments:\n
+    store -- A FeatureStore
+
+    Optional arguments:\n
+    src -- Folder holding one folder of weather csv files per state. Defaults to 'weather_data'
+    '''
+    written = 0
+    for folder in sorted(Path(src).iterdir()):
+        df = weather_data_features(folder) if folder.is_dir() else None
+        if df is not None:
+            written += store.append(df)
+    return written
+
+def materialize_noaa(store, path='noaa_weather.sqlite'):
+    '''
+    Appends the county and state records fetched by NOAAWeatherDataInterface to a store.
+    NOAA daily summaries have no wind or event data, so those columns are left missing.
+    Returns the number of rows written
+
+    Keyword arguments:\n
+    store -- A FeatureStore
+
+    Optional arguments:\n
+    path -- Path of the NOAA result store. Defaults to 'noaa_weather.sqlite'
+    '''
+    import sqlite3
+    with sqlite3.connect(path) as db:
+        rows = db.execute('SELECT fips, date, data FROM weather').fetchall()
+    records = [dict(json.loads(data), Location=code, Date=date) for code, date, data in rows]
+    if not records:
+        return 0
+    return store.append(pd.DataFrame.from_records(records))
+
+store = FeatureStore(os.environ.get('FEATURE_STORE_PATH', FEATURE_STORE_PATH))
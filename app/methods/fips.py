@@ -0,0 +1,116 @@
+import pandas as pd
+from functools import lru_cache
+
+FIPS_TABLE_PATH = 'data/fips_table.csv'
+
+# Suffixes of county equivalents that records often leave out, e.g. 'Anchorage' for 'Anchorage Municipality'
+EQUIVALENT_SUFFIXES = [' city and borough', ' census area', ' municipality', ' borough']
+
+def normalize_county(county):
+    '''
+    Normalizes a county name for lookups by lowercasing it, collapsing whitespace, spelling
+    'Saint' as 'st', dropping periods and removing a trailing 'County' or 'Parish'
+    '''
+    county = ' '.join(str(county).lower().replace('.', ' ').split())
+    if county.startswith('saint '):
+        county = 'st ' + county[len('saint '):]
+    for suffix in [' county', ' parish']:
+        if county.endswith(suffix):
+            county = county[:-len(suffix)]
+    return county
+
+def normalize_state(state):
+    '''
+    Normalizes a state name or abbreviation for lookups by lowercasing it and collapsing whitespace
+    '''
+    return ' '.join(str(state).lower().split())
+
+@lru_cache(maxsize=None)
+def load_fips_table(path=FIPS_TABLE_PATH):
+    '''
+    Returns the FIPS lookup table. Loaded once per process
+    '''
+    return pd.read_csv(path)
+
+class FIPSResolver:
+    def __init__(self, table):
+        '''
+        Resolves state and county names to FIPS codes with hash lookups on normalized names.
+        Names missing from the table fall back to addfips, which is loaded at most once
+
+        Keyword arguments:\n
+        table -- The FIPS lookup table as returned by load_fips_table
+        '''
+        self.states = {}
+        self.counties = {}
+        self._addfips = None
+
+        for name, abbr, code in table[['StateName', 'StateAbbr', 'StateFIPS']].drop_duplicates().itertuples(index=False):
+            self.states[normalize_state(name)] = self.states[normalize_state(abbr)] = '%02d' % code
+
+        for state, name, code in table[['StateFIPS', 'CountyName', 'CountyFIPS']].itertuples(index=False):
+            state = '%02d' % state
+            name = normalize_county(name)
+            self.counties[(state, name)] = '%05d' % code
+            for suffix in EQUIVALENT_SUFFIXES:
+                if name.endswith(suffix):
+                    self.counties.setdefault((state, name[:-len(suffix)]), '%05d' % code)
+                    break
+
+    def _fallback(self):
+        '''Private method returning the shared addfips instance'''
+        if self._addfips is None:
+            import addfips
+            self._addfips = addfips.AddFIPS()
+        return self._addfips
+
+    def state_fips(self, state):
+        '''
+        Returns the two digit FIPS code of a state name or abbreviation, or None if it is unknown
+        '''
+        code = self.states.get(normalize_state(state))
+        if code is None:
+            code = self._fallback().get_state_fips(str(state).strip())
+        return code
+
+    def county_fips(self, county, state):
+        '''
+        Returns the five digit FIPS code of a county, or None if it is unknown
+
+        Keyword arguments:\n
+        county -- A county name, with or without a 'County'/'Parish' suffix\n
+        state -- A state name or abbreviation
+        '''
+        state_code = self.state_fips(state)
+        if state_code is None:
+            return None
+        code = self.counties.get((state_code, normalize_county(county)))
+        if code is None:
+            code = self._fallback().get_county_fips(str(county).strip(), state=state_code)
+        return code
+
+    def resolve(self, county, state):
+        '''
+        Returns the county FIPS code of a location, or the state FIPS code when no county is given
+
+        Keyword arguments:\n
+        county -- A county name, or one of None, '', 'Unknown', 'None', 'nan' for the whole state\n
+        state -- A state name or abbreviation
+        '''
+        if county is None or str(county).strip() in ['', 'Unknown', 'None', 'nan']:
+            return self.state_fips(state)
+        return self.county_fips(county, state)
+
+@lru_cache(maxsize=None)
+def get_resolver(path=FIPS_TABLE_PATH):
+    '''
+    Returns the process wide FIPSResolver for a FIPS table
+    '''
+    return FIPSResolver(load_fips_table(path))
+
+@lru_cache(maxsize=8192)
+def resolve(county, state):
+    '''
+    Memoized FIPSResolver.resolve using the process wide resolver
+    '''
+    return get_resolver().resolve(county, state)
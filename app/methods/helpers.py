@@ -1,14 +1,192 @@
+import base64
+import numpy as np
 import pandas as pd
+from bisect import bisect_left
+from functools import lru_cache
+from app.methods.fips import normalize_county
 
-def filter_df_by_location(location, df=pd.read_csv('data/merged_data.csv')):
+# Columns results can be sorted on. Each has a precomputed rank so sorting a result is an argsort of ints
+SORT_COLUMNS = ['Start Date', 'State', 'County']
+RESULT_COLUMNS = ['Start Date', 'End Date', 'County', 'State', 'Number of Customers Affected']
+
+class OutageStore:
+    def __init__(self, df):
+        '''
+        Queryable store of historical outage records. Records are kept sorted by start date and
+        indexed by state, by normalized county name within each state, and by start date, so
+        location and date range queries are answered with binary searches instead of full scans
+
+        Keyword arguments:\n
+        df -- A dataframe containing historical records
+        '''
+        self.df = df.sort_values('Start Date', kind='stable').reset_index(drop=True)
+        self._dates = self.df['Start Date'].to_numpy(dtype=str)
+
+        statewide = self.df['County'].isna() | self.df['County'].isin(['None', ''])
+        self._state_rows = {}
+        self._statewide_rows = {}
+        self._county_index = {}
+        for state, rows in self.df.groupby('State', sort=False).indices.items():
+            self._state_rows[state] = rows
+            self._statewide_rows[state] = rows[statewide.to_numpy()[rows]]
+
+            counties = {}
+            for row in rows[~statewide.to_numpy()[rows]]:
+                counties.setdefault(normalize_county(self.df.at[row, 'County']), []).append(row)
+            names = sorted(counties)
+            self._county_index[state] = (names, [np.array(counties[name]) for name in names])
+
+        # Rank of every row under each sort column, ties broken by start date order. Ranks are
+        # unique, so (sort column, rank) is a stable keyset cursor
+        self._ranks = {}
+        for col in SORT_COLUMNS:
+            order = np.lexsort((np.arange(len(self.df)), self.df[col].fillna('').astype(str).to_numpy()))
+            rank = np.empty(len(order), dtype=np.intp)
+            rank[order] = np.arange(len(order))
+            self._ranks[col] = rank
+
+    @classmethod
+    def from_csv(cls, path='data/merged_data.csv'):
+        '''
+        Builds a store from a csv file of historical records
+        '''
+        return cls(pd.read_csv(path, keep_default_na=False, na_values=['']))
+
+    def _date_slice(self, rows, start_date, end_date):
+        '''Private method to restrict sorted row positions to a start date range'''
+        lo = 0 if start_date is None else np.searchsorted(self._dates, start_date, side='left')
+        hi = len(self._dates) if end_date is None else np.searchsorted(self._dates, end_date, side='right')
+        return rows[np.searchsorted(rows, lo):np.searchsorted(rows, hi)]
+
+    def county_rows(self, county, state):
+        '''
+        Returns the sorted row positions for counties in a state whose normalized name starts with county
+        '''
+        names, rows = self._county_index.get(state, ([], []))
+        prefix = normalize_county(county)
+        lo = bisect_left(names, prefix)
+        hi = bisect_left(names, prefix + '\uffff')
+        if lo == hi:
+            return np.array([], dtype=np.intp)
+        return np.sort(np.concatenate(rows[lo:hi]))
+
+    def query_rows(self, county, state, start_date=None, end_date=None):
+        '''
+        Returns the sorted row positions matching a location and an optional start date range.
+        A county query also returns the state's statewide records, as they affect every county
+
+        Keyword arguments:\n
+        county -- A county name or prefix. '' or 'nan' selects the whole state\n
+        state -- A state name
+
+        Optional arguments:\n
+        start_date -- A str in the form of 'YYYY-MM-DD'. Defaults to None (unbounded)\n
+        end_date -- A str in the form of 'YYYY-MM-DD'. Defaults to None (unbounded)
+        '''
+        if state not in self._state_rows:
+            return np.array([], dtype=np.intp)
+        if county in ['', 'nan']:
+            rows = self._state_rows[state]
+        else:
+            rows = np.union1d(self.county_rows(county, state), self._statewide_rows[state])
+        return self._date_slice(rows, start_date, end_date)
+
+    def query_dates(self, start_date=None, end_date=None):
+        '''
+        Returns a dataframe of records in every location whose start date falls in a range
+        '''
+        lo = 0 if start_date is None else np.searchsorted(self._dates, start_date, side='left')
+        hi = len(self._dates) if end_date is None else np.searchsorted(self._dates, end_date, side='right')
+        return self.df.iloc[lo:hi]
+
+    def query(self, county, state, start_date=None, end_date=None):
+        '''
+        Returns a dataframe of records matching a location and an optional start date range.
+        See query_rows for arguments
+        '''
+        return self.df.iloc[self.query_rows(county, state, start_date, end_date)]
+
+    def page(self, rows, sort='Start Date', descending=False, cursor=None, limit=100):
+        '''
+        Returns one page of row positions and the cursor of the next page (None on the last page).
+        Pages are defined by keyset rather than offset, so they stay stable while paging
+
+        Keyword arguments:\n
+        rows -- Row positions as returned by query_rows
+
+        Optional arguments:\n
+        sort -- One of SORT_COLUMNS. Defaults to 'Start Date'\n
+        descending -- Whether to sort in descending order. Defaults to False\n
+        cursor -- A cursor returned by a previous call. Defaults to None (first page)\n
+        limit -- Maximum number of rows per page. Defaults to 100
+        '''
+        ranks = self._ranks[sort][rows]
+        order = np.argsort(-ranks if descending else ranks)
+        ranks = ranks[order]
+        start = 0
+        if cursor is not None:
+            last = decode_cursor(cursor, sort)
+            if descending:
+                start = np.searchsorted(-ranks, -last, side='right')
+            else:
+                start = np.searchsorted(ranks, last, side='right')
+        end = start + limit
+        next_cursor = encode_cursor(sort, ranks[end-1]) if end < len(ranks) else None
+        return rows[order[start:end]], next_cursor
+
+    def sorted_rows(self, rows, sort='Start Date', descending=False):
+        '''
+        Returns row positions ordered by a sort column
+        '''
+        ranks = self._ranks[sort][rows]
+        return rows[np.argsort(-ranks if descending else ranks)]
+
+    def iter_records(self, rows, columns=RESULT_COLUMNS, chunksize=500):
+        '''
+        Yields dataframes of at most chunksize records for the given row positions, so large
+        results can be streamed without materializing them all at once
+        '''
+        for i in range(0, len(rows), chunksize):
+            yield self.df.iloc[rows[i:i+chunksize]][columns]
+
+def encode_cursor(sort, rank):
+    '''
+    Encodes a keyset cursor for a sort column and the rank of the last row on a page
+    '''
+    return base64.urlsafe_b64encode(f'{sort}|{int(rank)}'.encode()).decode()
+
+def decode_cursor(cursor, sort):
+    '''
+    Decodes a keyset cursor. Raises a ValueError if it is malformed or was made for a different sort column
+    '''
+    try:
+        cursor_sort, rank = base64.urlsafe_b64decode(cursor.encode()).decode().rsplit('|', 1)
+        rank = int(rank)
+    except Exception:
+        raise ValueError('Invalid cursor')
+    if cursor_sort != sort:
+        raise ValueError('Cursor does not match the sort column')
+    return rank
+
+@lru_cache(maxsize=None)
+def get_store(path='data/merged_data.csv'):
+    '''
+    Returns the process-wide outage store, building it on first use
+    '''
+    return OutageStore.from_csv(path)
+
+def filter_df_by_location(location, df=None):
     '''
     Filters a dataframe containing historical records based on a location tuple
 
     Keyword Arguements:\n
     location: A two-tuple in the form of (county, state)\n
-    df: A dataframe containing historical records. Defaults to 'data/merged_data.csv'
+    df: A dataframe containing historical records. Defaults to the indexed store built from 'data/merged_data.csv'
     '''
     county, state = location
+    if df is None:
+        return get_store().query(county, state)
+
     records = None
         
     if county == 'nan':
@@ -18,15 +196,19 @@ def filter_df_by_location(location, df=pd.read_csv('data/merged_data.csv')):
                 ((df['State'] == state) & (df['County'] == 'None'))]
     return records
 
-def filter_df_by_date(start_date: str, end_date: str, df=pd.read_csv('data/merged_data.csv')):
+def filter_df_by_date(start_date: str, end_date: str, df=None):
     '''
     Filters a dataframe containing historical records based on a location tuple
 
     Keyword Arguements:\n
     start_date: A str representing a start date to filter by\n
     end_date: A str representing an end date filter by\n
-    df: A dataframe containing historical records. Defaults to 'data/merged_data.csv'
+    df: A dataframe containing historical records. Defaults to the indexed store built from 'data/merged_data.csv'
     '''
+    if df is None:
+        store = get_store()
+        return store.query_dates(start_date, end_date)
+
     records = None
     records = df.loc[(df['Start Date'] >= start_date) & (df['Start Date'] <= end_date)]
-    return records
\ No newline at end of file
+    return records
@@ -0,0 +1,158 @@
+import numpy as np
+import pandas as pd
+from app.methods.feature_store import to_days, EPOCH
+
+CUSTOMERS = 'Number of Customers Affected'
+# County value of records that cover a whole state
+STATE_WIDE = ['None', '']
+
+def read_intervals(path='data/merged_data.csv'):
+    '''
+    Reads the outage records written by clean_hist_data.py into intervals with 'Start' and 'End'
+    timestamps, the outage duration in 'hours' and numeric customer counts ('Unknown' becomes
+    missing). Records without a parseable start or end are dropped
+
+    Optional arguments:\n
+    path -- Path of the merged records. Defaults to 'data/merged_data.csv'
+    '''
+    df = pd.read_csv(path, keep_default_na=False, na_values=[''])
+    start = pd.to_datetime(df['Start Date'] + ' ' + df['Start Time'].fillna('00:00:00'), errors='coerce')
+    end = pd.to_datetime(df['End Date'] + ' ' + df['End Time'].fillna('00:00:00'), errors='coerce')
+    df = df.assign(Start=start, End=end, hours=(end - start).dt.total_seconds() / 3600)
+    df[CUSTOMERS] = pd.to_numeric(df[CUSTOMERS], errors='coerce')
+    return df.dropna(subset=['Start', 'End']).reset_index(drop=True)
+
+def _max_by_cell(cells, values, size):
+    '''
+    Private function returning the largest non missing value of each cell, NaN for cells without one
+    '''
+    out = np.full(size, np.nan)
+    ok = ~np.isnan(values)
+    cells, values = cells[ok], values[ok]
+    if len(cells) == 0:
+        return out
+    order = np.lexsort((values, cells))
+    cells, values = cells[order], values[order]
+    last = np.r_[cells[1:] != cells[:-1], True]
+    out[cells[last]] = values[last]
+    return out
+
+class DailyLabels:
+    def __init__(self, first_day, regions, outages, customers, hours, affected=None):
+        '''
+        Dense (day, region) outage labels. Row d of every array is day first_day + d
+
+        Keyword arguments:\n
+        first_day -- The first day, in days since 1970-01-01\n
+        regions -- A pandas MultiIndex of the region of each column, e.g. (State,) or (State, County)\n
+        outages -- int32 array of the number of outage records ongoing on each day\n
+        customers -- float64 array of the most customers affected by an ongoing outage, NaN if unknown or none\n
+        hours -- float64 array of the longest duration of an ongoing outage, NaN if none
+
+        Optional arguments:\n
+        affected -- int32 array of the number of counties with an ongoing outage. Defaults to None
+        '''
+        self.first_day = first_day
+        self.regions = regions
+        self.outages = outages
+        self.customers = customers
+        self.hours = hours
+        self.affected = affected
+
+    @property
+    def dates(self):
+        '''The date of each row as datetime64[D]'''
+        return EPOCH + (self.first_day + np.arange(len(self.outages))).astype('timedelta64[D]')
+
+    def by_state(self, level='State'):
+        '''
+        Rolls labels of (State, County) regions up to states. Outage records are summed, customers
+        and hours take the largest value and affected counts the counties with an outage. Records
+        that cover the whole state are not counted as counties
+
+        Optional arguments:\n
+        level -- Name of the state level of regions. Defaults to 'State'
+        '''
+        states = self.regions.get_level_values(level)
+        # Regions are sorted, so each state's columns are contiguous
+        starts = np.flatnonzero(np.r_[True, states[1:] != states[:-1]]) if len(states) else np.array([], dtype=np.intp)
+        if len(starts) == 0:
+            empty = np.zeros((len(self.outages), 0))
+            return DailyLabels(self.first_day, pd.MultiIndex.from_arrays([states], names=[level]),
+                               empty.astype(np.int32), empty, empty, empty.astype(np.int32))
+        if self.regions.nlevels > 1:
+            county = ~np.isin(self.regions.droplevel(level).get_level_values(0), STATE_WIDE)
+        else:
+            # State-only labels have no county records to count
+            county = np.zeros(len(states), dtype=bool)
+        affected = np.add.reduceat(((self.outages > 0) & county).astype(np.int32), starts, axis=1)
+        return DailyLabels(self.first_day, pd.MultiIndex.from_arrays([states[starts]], names=[level]),
+                           np.add.reduceat(self.outages, starts, axis=1),
+                           np.fmax.reduceat(self.customers, starts, axis=1),
+                           np.fmax.reduceat(self.hours, starts, axis=1), affected)
+
+    def to_frame(self):
+        '''
+        Returns the (day, region) cells with an ongoing outage as a long DataFrame with the region
+        columns, 'Date', 'Outages', CUSTOMERS, 'hours' and, after by_state, 'Num Counties Affected'
+        '''
+        days, columns = np.nonzero(self.outages)
+        df = self.regions[columns].to_frame(index=False)
+        df['Date'] = pd.to_datetime(self.dates[days])
+        df['Outages'] = self.outages[days, columns]
+        df[CUSTOMERS] = self.customers[days, columns]
+        df['hours'] = self.hours[days, columns]
+        if self.affected is not None:
+            df['Num Counties Affected'] = self.affected[days, columns]
+        return df
+
+def expand_intervals(intervals, by=('State',), start=None, end=None):
+    '''
+    Expands outage intervals into dense day by region labels without a per-record loop. Ongoing
+    outage counts come from a difference array (+1 on each start day, -1 after each end day)
+    summed down the days, and the maxima from one sorted pass over every (record, day) pair
+
+    Keyword arguments:\n
+    intervals -- A DataFrame returned by read_intervals
+
+    Optional arguments:\n
+    by -- Columns that identify a region. Defaults to ('State',)\n
+    start -- First day of the labels. Defaults to the earliest start\n
+    end -- Last day of the labels. Defaults to the latest end
+
+    Return: A DailyLabels, without any days or regions if there are no intervals and no start and end
+    '''
+    regions = pd.MultiIndex.from_frame(intervals[list(by)])
+    # factorize cannot infer the levels of an empty index
+    codes, regions = regions.factorize(sort=True) if len(regions) else (np.array([], dtype=np.intp), regions)
+    regions = regions.set_names(list(by))
+    first = to_days(intervals['Start'].dt.normalize()).astype(np.int64)
+    last = to_days(intervals['End'].dt.normalize()).astype(np.int64)
+    if start is not None:
+        first_day = int(to_days(start))
+    else:
+        first_day = int(first.min()) if len(first) else 0
+    if end is not None:
+        last_day = int(to_days(end))
+    else:
+        last_day = int(last.max()) if len(last) else first_day - 1
+    n_days, n_regions = last_day - first_day + 1, len(regions)
+
+    # Clip intervals to the requested days and drop those outside them or ending before they start
+    first, last = np.maximum(first, first_day) - first_day, np.minimum(last, last_day) - first_day
+    keep = last >= first
+    codes, first, last = codes[keep], first[keep], last[keep]
+
+    diff = np.bincount(first * n_regions + codes, minlength=(n_days + 1) * n_regions) \
+         - np.bincount((last + 1) * n_regions + codes, minlength=(n_days + 1) * n_regions)
+    outages = np.cumsum(diff.reshape(n_days + 1, n_regions)[:-1], axis=0).astype(np.int32)
+
+    # Every (record, day) cell an outage covers
+    lengths = last - first + 1
+    record = np.repeat(np.arange(len(codes)), lengths)
+    day = first[record] + np.arange(lengths.sum()) - np.repeat(np.cumsum(lengths) - lengths, lengths)
+    cells = day * n_regions + codes[record]
+    size = n_days * n_regions
+    customers = _max_by_cell(cells, intervals[CUSTOMERS].to_numpy(np.float64)[keep][record], size)
+    hours = _max_by_cell(cells, intervals['hours'].to_numpy(np.float64)[keep][record], size)
+    return DailyLabels(first_day, regions, outages, customers.reshape(n_days, n_regions), hours.reshape(n_days, n_regions))
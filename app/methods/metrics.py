@@ -0,0 +1,332 @@
+import os
+import json
+import time
+import atexit
+import threading
+from bisect import bisect_left
+from contextlib import contextmanager
+from flask import g, request
+
+# Content type of the Prometheus text exposition format
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+# Upper bounds in seconds, from an in-memory lookup up to a slow upstream call
+BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+def _escape(value):
+    '''Private function to escape a label value for the text format'''
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+def _format(value):
+    '''Private function to format a sample value for the text format'''
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+class Histogram:
+    def __init__(self, name, documentation, labelname, buckets=BUCKETS):
+        '''
+        A histogram with one label and fixed buckets. Observing a value is a bisect and
+        two additions under a lock, so it is cheap enough to wrap every request
+
+        Keyword arguments:\n
+        name -- The metric name\n
+        documentation -- Help text shown on /metrics\n
+        labelname -- Name of the label that distinguishes series, e.g. 'stage'
+
+        Optional arguments:\n
+        buckets -- Sorted bucket upper bounds in seconds. Defaults to BUCKETS
+        '''
+        self.name = name
+        self.documentation = documentation
+        self.labelname = labelname
+        self.buckets = tuple(buckets)
+        self._lock = threading.Lock()
+        self._series = {}   # label value -> [count per bucket..., count above the last bucket, sum]
+
+    def observe(self, label, value):
+        '''
+        Records one observation for a label value
+        '''
+        i = bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(label)
+            if series is None:
+                series = self._series[label] = [0] * (len(self.buckets) + 1) + [0.0]
+            series[i] += 1
+            series[-1] += value
+
+    @contextmanager
+    def time(self, label):
+        '''
+        Context manager observing the seconds spent in its block for a label value
+        '''
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(label, time.perf_counter() - start)
+
+    def snapshot(self):
+        '''
+        Returns a copy of every series, by label value
+        '''
+        with self._lock:
+            return {label: list(values) for label, values in self._series.items()}
+
+    def collect(self, series=None):
+        '''
+        Returns the metric in the text exposition format as a list of lines
+
+        Optional arguments:\n
+        series -- Series to format instead of this process's, e.g. merged from every worker
+        '''
+        series = self.snapshot() if series is None else series
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} histogram']
+        for label, values in sorted(series.items()):
+            label = f'{self.labelname}="{_escape(label)}"'
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float('inf'),), values[:-1]):
+                cumulative += count
+                lines.append(f'{self.name}_bucket{{{label},le="{_format(float(bound))}"}} {cumulative}')
+            lines.append(f'{self.name}_sum{{{label}}} {_format(values[-1])}')
+            lines.append(f'{self.name}_count{{{label}}} {cumulative}')
+        return lines
+
+class Counter:
+    def __init__(self, name, documentation, labelname):
+        '''
+        A monotonically increasing counter with one label
+
+        Keyword arguments:\n
+        name -- The metric name, ending in _total\n
+        documentation -- Help text shown on /metrics\n
+        labelname -- Name of the label that distinguishes series
+        '''
+        self.name = name
+        self.documentation = documentation
+        self.labelname = labelname
+        self._lock = threading.Lock()
+        self._series = {}
+
+    def inc(self, label, amount=1):
+        '''
+        Increments the counter of a label value
+        '''
+        with self._lock:
+            self._series[label] = self._series.get(label, 0) + amount
+
+    def snapshot(self):
+        '''
+        Returns a copy of every series, by label value
+        '''
+        with self._lock:
+            return dict(self._series)
+
+    def collect(self, series=None):
+        '''
+        Returns the metric in the text exposition format as a list of lines
+
+        Optional arguments:\n
+        series -- Series to format instead of this process's, e.g. merged from every worker
+        '''
+        series = self.snapshot() if series is None else series
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} counter']
+        for label, value in sorted(series.items()):
+            lines.append(f'{self.name}{{{self.labelname}="{_escape(label)}"}} {_format(value)}')
+        return lines
+
+REQUEST_SECONDS = Histogram('dashboard_request_duration_seconds', 'Request latency by endpoint.', 'endpoint')
+STAGE_SECONDS = Histogram('dashboard_stage_duration_seconds',
+                          'Time spent in each serving stage (feature extraction, normalization, inference, '
+                          'figure build, template render).', 'stage')
+UPSTREAM_SECONDS = Histogram('dashboard_upstream_request_duration_seconds', 'Latency of upstream HTTP calls.', 'upstream')
+UPSTREAM_ERRORS = Counter('dashboard_upstream_errors_total', 'Upstream HTTP calls that failed or timed out.', 'upstream')
+UPSTREAM_REJECTED = Counter('dashboard_upstream_rejected_total', 'Upstream calls refused because the circuit was open.', 'upstream')
+FEATURE_STORE_LOOKUPS = Counter('dashboard_feature_store_lookups_total',
+                                'Feature store lookups while serving, by whether the store had the row.', 'result')
+
+METRICS = [REQUEST_SECONDS, STAGE_SECONDS, UPSTREAM_SECONDS, UPSTREAM_ERRORS, UPSTREAM_REJECTED, FEATURE_STORE_LOOKUPS]
+
+# Caches whose counters are read when /metrics is scraped, by name
+_caches = {}
+
+# Folder where every worker process writes snapshots of its metrics, see configure
+_multiprocess = {'path': None, 'interval': 5, 'pid': None}
+
+def register_cache(name, cache):
+    '''
+    Exposes the hit, miss and eviction counters of a TTLCache on /metrics
+
+    Keyword arguments:\n
+    name -- Value of the 'cache' label, e.g. 'weather'\n
+    cache -- A TTLCache
+    '''
+    _caches[name] = cache
+
+def timer(stage):
+    '''
+    Context manager timing a serving stage, e.g. with metrics.timer('inference'): ...
+    Also usable as a function decorator, e.g. @metrics.timer('feature_extraction')
+    '''
+    return STAGE_SECONDS.time(stage)
+
+@contextmanager
+def upstream(name):
+    '''
+    Context manager timing an upstream HTTP call and counting it as an error if its block raises
+
+    Keyword arguments:\n
+    name -- The upstream service, e.g. 'visual_crossing'
+    '''
+    start = time.perf_counter()
+    try:
+        yield
+    except Exception:
+        UPSTREAM_ERRORS.inc(name)
+        raise
+    finally:
+        UPSTREAM_SECONDS.observe(name, time.perf_counter() - start)
+
+def cache_lines(stats=None):
+    '''
+    Returns the counters of every registered cache in the text exposition format
+
+    Optional arguments:\n
+    stats -- Cache stats by name to format instead of this process's, e.g. merged from every worker
+    '''
+    stats = {name: cache.stats() for name, cache in _caches.items()} if stats is None else stats
+    stats = dict(sorted(stats.items()))
+    lines = []
+    for key, kind, documentation in [('hits', 'counter', 'Lookups served from memory.'),
+                                     ('disk_hits', 'counter', 'Lookups served from the SQLite store.'),
+                                     ('misses', 'counter', 'Lookups that had to fetch.'),
+                                     ('waits', 'counter', 'Lookups that waited for another caller fetching the same key.'),
+                                     ('evictions', 'counter', 'Entries dropped to stay under maxsize.'),
+                                     ('size', 'gauge', 'Entries currently held in memory.')]:
+        name = f'dashboard_cache_{key}_total' if kind == 'counter' else f'dashboard_cache_{key}'
+        lines += [f'# HELP {name} {documentation}', f'# TYPE {name} {kind}']
+        lines += [f'{name}{{cache="{_escape(cache)}"}} {values.get(key, 0)}' for cache, values in stats.items()]
+    return lines
+
+def configure(path=None, interval=5):
+    '''
+    Shares metrics between the worker processes of a server. Each worker writes a snapshot of
+    its metrics to path every interval seconds and when scraped, and /metrics sums the
+    snapshots of every worker, including ones that have exited so counters never go back.
+    Other workers' values lag by at most interval seconds. gunicorn.conf.py gives every server
+    start a new folder
+
+    Optional arguments:\n
+    path -- Folder shared by the workers. Defaults to None (each worker reports only its own metrics)\n
+    interval -- Seconds between snapshots. Defaults to 5
+    '''
+    if path is not None:
+        os.makedirs(path, exist_ok=True)
+    _multiprocess.update(path=path, interval=interval)
+
+def snapshot():
+    '''
+    Returns every metric and cache counter of this process as a JSON serializable dict
+    '''
+    return {'metrics': {metric.name: metric.snapshot() for metric in METRICS},
+            'caches': {name: cache.stats() for name, cache in _caches.items()}}
+
+def write_snapshot():
+    '''
+    Atomically writes this process's snapshot to the shared folder as <pid>.json
+    '''
+    path = os.path.join(_multiprocess['path'], f'{os.getpid()}.json')
+    with open(f'{path}.tmp', 'w') as f:
+        json.dump(snapshot(), f)
+    os.replace(f'{path}.tmp', path)
+
+def _start_snapshots():
+    '''
+    Private function starting the thread that writes this worker's snapshots. Called on every
+    request, it only starts one per process since threads do not survive a fork
+    '''
+    if _multiprocess['path'] is None or _multiprocess['pid'] == os.getpid():
+        return
+    _multiprocess['pid'] = os.getpid()
+
+    def run():
+        while True:
+            time.sleep(_multiprocess['interval'])
+            write_snapshot()
+
+    threading.Thread(target=run, daemon=True).start()
+    atexit.register(write_snapshot)
+
+def _alive(pid):
+    '''Private function returning whether a process is still running'''
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+def _add(total, values):
+    '''Private function adding a series (a number or a histogram's list) to a running total'''
+    return values if total is None else [a + b for a, b in zip(total, values)] if isinstance(total, list) else total + values
+
+def merged_snapshot():
+    '''
+    Returns the sum of every worker's snapshot in the shared folder, after writing this one's.
+    Cache sizes are only summed over workers that are still running
+    '''
+    write_snapshot()
+    merged = {'metrics': {metric.name: {} for metric in METRICS}, 'caches': {}}
+    for name in os.listdir(_multiprocess['path']):
+        pid, ext = os.path.splitext(name)
+        if ext != '.json':
+            continue
+        try:
+            with open(os.path.join(_multiprocess['path'], name)) as f:
+                worker = json.load(f)
+        except (OSError, ValueError):
+            continue
+        for metric, series in worker['metrics'].items():
+            for label, values in series.items():
+                total = merged['metrics'].setdefault(metric, {})
+                total[label] = _add(total.get(label), values)
+        alive = _alive(int(pid))
+        for cache, stats in worker['caches'].items():
+            total = merged['caches'].setdefault(cache, {})
+            for key, value in stats.items():
+                total[key] = total.get(key, 0) + (value if key != 'size' or alive else 0)
+    return merged
+
+def render():
+    '''
+    Returns every metric in the Prometheus text exposition format, summed over every worker
+    when a shared folder is configured and for this process otherwise
+    '''
+    lines = []
+    if _multiprocess['path'] is None:
+        for metric in METRICS:
+            lines += metric.collect()
+        lines += cache_lines()
+    else:
+        merged = merged_snapshot()
+        for metric in METRICS:
+            lines += metric.collect(merged['metrics'][metric.name])
+        lines += cache_lines(merged['caches'])
+    return '\n'.join(lines) + '\n'
+
+def init_app(app):
+    '''
+    Records the latency of every request to the app by endpoint
+    '''
+    @app.before_request
+    def start_timer():
+        _start_snapshots()
+        g.metrics_start = time.perf_counter()
+
+    @app.teardown_request
+    def observe_request(exc=None):
+        start = g.pop('metrics_start', None)
+        if start is not None:
+            REQUEST_SECONDS.observe(request.endpoint or 'unmatched', time.perf_counter() - start)
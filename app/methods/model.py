@@ -0,0 +1,458 @@
+import io
+import os
+import json
+import time
+import hashlib
+import threading
+import datetime as dt
+from joblib import load
+import numpy as np
+import pandas as pd
+import app.methods.data as weather_data
+from app.methods import feature_store, metrics
+from app.methods.cache import TTLCache
+from app.methods.tree_engine import TreeEnsemble
+
+# States in the order used by the LabelEncoder at training time. Unknown states map to len(MODEL_STATES)
+MODEL_STATES = ['Alabama', 'Alaska', 'Arizona', 'Arkansas', 'California',
+                'Colorado', 'Connecticut', 'Delaware', 'Florida', 'Georgia',
+                'Idaho', 'Illinois', 'Indiana', 'Iowa', 'Kansas', 'Kentucky',
+                'Louisiana', 'Maine', 'Maryland', 'Michigan', 'Minnesota',
+                'Mississippi', 'Missouri', 'Montana', 'Nebraska', 'Nevada',
+                'New Hampshire', 'New Jersey', 'New Mexico', 'New York',
+                'North Carolina', 'North Dakota', 'Ohio', 'Oklahoma', 'Oregon',
+                'Pennsylvania', 'Rhode Island', 'South Carolina', 'South Dakota',
+                'Tennessee', 'Texas', 'Utah', 'Vermont', 'Virginia', 'Washington',
+                'West Virginia', 'Wisconsin', 'Wyoming']
+
+# Feature order expected by the booster
+FEATURES = ['State', 'Outage', 'AWND', 'PRCP', 'SNOW', 'SNWD', 'TMAX', 'TMIN', 'Fog', 'Thunder',
+            'Hail', 'Dust', 'Tornado', 'Wind', 'Snow', 'hours', 'Season_Fall', 'Season_Spring',
+            'Season_Summer', 'Season_Winter']
+
+class Scaler:
+    def __init__(self, features, mean, std, model_sha256=None):
+        '''
+        Standardizes feature frames using the mean and standard deviation of the training data.
+        The statistics are kept as NumPy arrays aligned to the model's feature order so a whole
+        batch is normalized in one broadcasted operation.
+
+        Keyword arguments:\n
+        features -- A list of feature names in model order\n
+        mean -- A list of feature means aligned to features\n
+        std -- A list of feature standard deviations aligned to features
+
+        Optional arguments:\n
+        model_sha256 -- sha256 hex digest of the model file the statistics were fitted for. Defaults to None
+        '''
+        self.features = list(features)
+        self.mean = np.asarray(mean, dtype=np.float64)
+        self.std = np.asarray(std, dtype=np.float64)
+        if not (len(self.features) == self.mean.shape[0] == self.std.shape[0]):
+            raise ValueError('Scaler features, mean and std must have the same length')
+        self.model_sha256 = model_sha256
+
+    @classmethod
+    def load(cls, path):
+        '''
+        Loads scaler statistics from a JSON file of the form {'features', 'mean', 'std'} and
+        optionally 'model_sha256'
+        '''
+        with open(path) as f:
+            stats = json.load(f)
+        return cls(stats['features'], stats['mean'], stats['std'], stats.get('model_sha256'))
+
+    def save(self, path):
+        '''
+        Saves scaler statistics to a JSON file
+        '''
+        stats = {'features': self.features, 'mean': self.mean.tolist(), 'std': self.std.tolist()}
+        if self.model_sha256 is not None:
+            stats['model_sha256'] = self.model_sha256
+        with open(path, 'w') as f:
+            json.dump(stats, f, indent=4)
+
+    def check(self, feature_names):
+        '''
+        Raises a ValueError if the scaler's feature order differs from feature_names
+        '''
+        if feature_names is not None and list(feature_names) != self.features:
+            raise ValueError(f'Scaler feature order {self.features} does not match model feature order {list(feature_names)}')
+
+    def check_model(self, model_bytes):
+        '''
+        Raises a ValueError if the scaler was saved for a model file other than model_bytes.
+        Scalers saved without a model digest are not checked
+        '''
+        if self.model_sha256 is not None and hashlib.sha256(model_bytes).hexdigest() != self.model_sha256:
+            raise ValueError('Scaler was saved for a different model file')
+
+    def transform(self, df):
+        '''
+        Returns a normalized copy of df with columns in model order
+
+        Keyword arguments:\n
+        df -- A DataFrame containing at least every feature column
+        '''
+        missing = [col for col in self.features if col not in df.columns]
+        if missing:
+            raise ValueError(f'Missing feature columns: {missing}')
+        values = (df[self.features].to_numpy(dtype=np.float64) - self.mean) / self.std
+        return pd.DataFrame(values, columns=self.features, index=df.index)
+
+def scaler_path(model_path):
+    '''
+    Returns the path of the scaler statistics saved alongside a model file
+    '''
+    return os.path.splitext(model_path)[0] + '.scaler.json'
+
+def artifact_version(model_path, scaler_file):
+    '''
+    Returns a short content hash of a model and its scaler file, used as the model version
+    '''
+    sha = hashlib.sha256()
+    for path in [model_path, scaler_file]:
+        with open(path, 'rb') as f:
+            for block in iter(lambda: f.read(1 << 16), b''):
+                sha.update(block)
+    return sha.hexdigest()[:12]
+
+class ModelRegistry:
+    def __init__(self, path='reg_model.joblib', engine=False, engine_max_rows=64):
+        '''
+        Holds a single in-memory copy of the regression model and its scaler for this process.
+        The artifacts are loaded lazily on first use and reloaded whenever either file's mtime
+        changes, so a new model can be dropped in place without restarting the server.
+
+        Keyword arguments:\n
+        path -- Path to the joblib model file. Defaults to 'reg_model.joblib'
+
+        Optional arguments:\n
+        engine -- Score small batches with a TreeEnsemble exported from the booster. Defaults to False\n
+        engine_max_rows -- Largest batch scored by the TreeEnsemble, above which XGBoost is faster. Defaults to 64
+        '''
+        self.path = path
+        self.scaler_path = scaler_path(path)
+        self.engine = engine
+        self.engine_max_rows = engine_max_rows
+        self._lock = threading.Lock()   # Patched into a greenlet-safe lock under gevent workers
+        self._artifacts = None
+        self._engine = None
+        self._mtime = None
+        self.version = None
+        self.load_time = None
+        self.loaded_at = None
+
+    def _stat(self):
+        '''Private method returning the modification times of the model and scaler files'''
+        return (os.stat(self.path).st_mtime_ns, os.stat(self.scaler_path).st_mtime_ns)
+
+    def _load(self, mtime):
+        '''Private method to (re)load the artifacts from disk and record load statistics'''
+        start = time.perf_counter()
+        try:
+            # The scaler is read first, so a model installed after it still matches its digest
+            scaler = Scaler.load(self.scaler_path)
+            with open(self.path, 'rb') as f:
+                model_bytes = f.read()
+            scaler.check_model(model_bytes)
+            model = load(io.BytesIO(model_bytes))
+            scaler.check(model.get_booster().feature_names)
+        except Exception:
+            # Keep serving the previous model if a new file is only partially written, or only
+            # one file of a new pair is in place. The pair is retried on the next call
+            if self._artifacts is None:
+                raise
+            return
+        engine = self._export_engine(model) if self.engine else None
+        self.load_time = time.perf_counter() - start
+        metrics.STAGE_SECONDS.observe('model_load', self.load_time)
+        self.version = artifact_version(self.path, self.scaler_path)
+        self.loaded_at = time.time()
+        self._mtime = mtime
+        self._artifacts = (model, scaler)
+        self._engine = (model, engine)
+
+    def _export_engine(self, model, rows=256, rtol=1e-5):
+        '''
+        Private method to export the booster to a TreeEnsemble. Returns None if the booster
+        cannot be exported or the engine disagrees with XGBoost on random rows
+        '''
+        try:
+            engine = TreeEnsemble.from_booster(model.get_booster())
+        except ValueError:
+            return None
+        X = np.random.default_rng(0).normal(scale=2, size=(rows, len(FEATURES))).astype(np.float32)
+        X[::7, 2] = np.nan
+        expected = model.predict(pd.DataFrame(X, columns=FEATURES))
+        if not np.allclose(engine.predict(X), expected, rtol=rtol, atol=1e-3):
+            return None
+        return engine
+
+    def engine_for(self, model):
+        '''
+        Returns the TreeEnsemble exported from model, or None if it is disabled or unavailable
+        '''
+        loaded = self._engine
+        return loaded[1] if loaded is not None and loaded[0] is model else None
+
+    def artifacts(self):
+        '''
+        Returns the current (model, scaler) pair, loading or hot-swapping them if the files
+        on disk have changed
+        '''
+        mtime = self._stat()
+        if self._artifacts is None or mtime != self._mtime:
+            with self._lock:
+                if self._artifacts is None or mtime != self._mtime:
+                    self._load(mtime)
+        return self._artifacts
+
+    def get(self):
+        '''
+        Returns the current model
+        '''
+        return self.artifacts()[0]
+
+    def info(self):
+        '''
+        Returns a dict describing the currently loaded model
+        '''
+        return {
+            'path': self.path,
+            'version': self.version,
+            'load_time_ms': None if self.load_time is None else round(self.load_time * 1000, 3),
+            'loaded_at': self.loaded_at,
+            'engine': self._engine is not None and self._engine[1] is not None,
+        }
+
+registry = ModelRegistry(os.environ.get('MODEL_PATH', 'reg_model.joblib'), os.environ.get('MODEL_ENGINE') == 'compiled')
+
+# Forecast timelines, kept until the next forecast refresh. The ttl is the refresh interval in seconds
+forecast_cache = TTLCache(ttl=3600, maxsize=512)
+metrics.register_cache('forecast', forecast_cache)
+
+def location_string(county, state):
+    '''
+    Builds the location query used for weather lookups from a county and a state
+    '''
+    county = county.strip()
+    state = state.strip()
+    return county + ', ' + state if county != '' else state
+
+def encode_state(state):
+    '''
+    Returns the label encoded value of a state name
+    '''
+    if state in MODEL_STATES:
+        return MODEL_STATES.index(state)
+    return len(MODEL_STATES)
+
+def outage_hours(start_date, now=None):
+    '''
+    Returns the number of hours between an outage start time and now
+
+    Keyword arguments:\n
+    start_date -- A str in the form of 'YYYY-MM-DD HH:MM' (UTC)
+
+    Optional arguments:\n
+    now -- A datetime to measure from. Defaults to the current UTC time
+    '''
+    now = now or dt.datetime.utcnow()
+    start = dt.datetime.strptime(start_date.strip(), '%Y-%m-%d %H:%M')
+    return abs(now-start).total_seconds() / 3600
+
+def forecast_hours(start_date, days, now=None):
+    '''
+    Returns the hours since an outage start at the current time of day on each of the next
+    days, starting today. Days before a future start get 0
+
+    Keyword arguments:\n
+    start_date -- A str in the form of 'YYYY-MM-DD HH:MM' (UTC)\n
+    days -- Number of days, including today
+
+    Optional arguments:\n
+    now -- A datetime to measure from. Defaults to the current UTC time
+    '''
+    now = now or dt.datetime.utcnow()
+    start = dt.datetime.strptime(start_date.strip(), '%Y-%m-%d %H:%M')
+    return np.maximum((now - start).total_seconds() / 3600 + 24 * np.arange(days), 0)
+
+def build_features(api_data, state, hours):
+    '''
+    Builds a single row of model features from a weather API response
+
+    Keyword arguments:\n
+    api_data -- A Visual Crossing timeline response\n
+    state -- The state name of the location\n
+    hours -- Hours since the outage started
+    '''
+    df = weather_data.get_rel_data(api_data)
+    df['Outage'] = 1
+    df['hours'] = hours
+    df['State'] = encode_state(state.strip())
+    return df[FEATURES]
+
+def stored_features(county, state, hours, date=None):
+    '''
+    Builds a single row of model features from the feature store, or returns None if the store
+    has no complete row for the location on that date. Rows missing a feature (e.g. NOAA county
+    rows without wind and event columns) are skipped, since the model never saw them missing
+
+    Keyword arguments:\n
+    county -- The county name of the location, or ''\n
+    state -- The state name of the location\n
+    hours -- Hours since the outage started
+
+    Optional arguments:\n
+    date -- The date to look up. Defaults to today
+    '''
+    with metrics.timer('feature_lookup'):
+        df = feature_store.store.lookup_location(county, state, date or dt.date.today(), complete=True)
+    metrics.FEATURE_STORE_LOOKUPS.inc('miss' if df is None else 'hit')
+    if df is None:
+        return None
+    df['Outage'] = 1
+    df['hours'] = hours
+    df['State'] = encode_state(state.strip())
+    return df[FEATURES]
+
+def location_features(county, state, hours):
+    '''
+    Builds a single row of model features for today, from the feature store when it has the
+    location and from the weather API otherwise
+    '''
+    df = stored_features(county, state, hours)
+    if df is not None:
+        return df
+    current = dt.datetime.today().strftime('%Y-%m-%d')
+    enddate = (dt.datetime.today()+dt.timedelta(days=7)).strftime('%Y-%m-%d')
+    api_data = weather_data.get_weather(location_string(county, state), current, enddate)
+    return build_features(api_data, state, hours)
+
+def normalize_data(df):
+    '''
+    Normalizes a DataFrame of raw features with the scaler saved alongside the current model
+    '''
+    return registry.artifacts()[1].transform(df)
+
+def predict(df):
+    '''
+    Normalizes a feature frame and scores every row with a single call to the model. Small
+    batches go through the exported TreeEnsemble when it is enabled
+
+    Keyword arguments:\n
+    df -- A DataFrame of raw features, one row per prediction
+    '''
+    xgb_model, scaler = registry.artifacts()
+    engine = registry.engine_for(xgb_model)
+    with metrics.timer('normalization'):
+        X = scaler.transform(df)
+    with metrics.timer('inference'):
+        if engine is not None and len(df) <= registry.engine_max_rows:
+            return engine.predict(X.to_numpy())
+        return xgb_model.predict(X)
+
+def forecast_timeline(county, state, start_date):
+    '''
+    Predicts customers affected for each day from today through the next 7 days. Later days
+    are scored from the daily forecast with a single predict call and cached per location and
+    outage start until the next forecast refresh. Today is the current prediction, scored on
+    every call from location_features with the hours since the outage started, as the form and
+    the batch endpoint score it
+
+    Keyword arguments:\n
+    county -- The county name of the location, or ''\n
+    state -- The state name of the location\n
+    start_date -- The outage start in the form of 'YYYY-MM-DD HH:MM' (UTC)
+
+    Return: A list of dicts with 'date' and 'customers_affected' keys
+    '''
+    hours = outage_hours(start_date)
+    registry.artifacts()
+    location = location_string(county, state)
+    refresh = int(time.time() // forecast_cache.ttl)
+    key = f'{weather_data.cache_key(location, "", "")}|{start_date.strip()}|{registry.version}|{refresh}'
+
+    def compute():
+        current = dt.datetime.today().strftime('%Y-%m-%d')
+        enddate = (dt.datetime.today()+dt.timedelta(days=7)).strftime('%Y-%m-%d')
+        api_data = weather_data.get_weather(location, current, enddate)
+        df = weather_data.get_rel_data_many({location: api_data})
+        df['Outage'] = 1
+        # Each later day is scored as the outage would stand at the same time of day
+        df['hours'] = forecast_hours(start_date, len(df))
+        df['State'] = encode_state(state.strip())
+        y = predict(df[FEATURES].iloc[1:]) if len(df) > 1 else []
+        # Today's value is filled in per call
+        return [{'date': df['Date'].iloc[0], 'customers_affected': None}] + \
+               [{'date': date, 'customers_affected': float(value)} for date, value in zip(df['Date'].iloc[1:], y)]
+
+    timeline = forecast_cache.get(key, compute)
+    today = predict(location_features(county, state, hours))
+    return [dict(timeline[0], customers_affected=float(today[0]))] + timeline[1:]
+
+def predict_batch(records, max_workers=16):
+    '''
+    Scores many (county, state, start_date) records at once. Locations missing from the feature
+    store have their weather fetched concurrently, and all rows are scored with a single predict call
+
+    Keyword arguments:\n
+    records -- A list of dicts with 'county', 'state' and 'start_date' keys
+
+    Optional arguments:\n
+    max_workers -- Maximum number of concurrent weather requests. Defaults to 16
+
+    Return: A list of result dicts in the same order as records
+    '''
+    current = dt.datetime.today().strftime('%Y-%m-%d')
+    enddate = (dt.datetime.today()+dt.timedelta(days=7)).strftime('%Y-%m-%d')
+    now = dt.datetime.utcnow()
+
+    results = []
+    hours = []
+    for record in records:
+        county = str(record.get('county') or '').strip()
+        state = str(record.get('state') or '').strip()
+        start_date = str(record.get('start_date') or '')
+        result = {'county': county, 'state': state, 'start_date': start_date}
+        results.append(result)
+        try:
+            hours.append(outage_hours(start_date, now))
+        except ValueError:
+            hours.append(None)
+            result['error'] = "start_date must be in the form of 'YYYY-MM-DD HH:MM'"
+        if state == '':
+            result['error'] = 'state is required'
+
+    stored = [None if 'error' in r else stored_features(r['county'], r['state'], hrs) for r, hrs in zip(results, hours)]
+    locations = {location_string(r['county'], r['state']) for r, row in zip(results, stored) if 'error' not in r and row is None}
+    weather = weather_data.get_weather_many(locations, current, enddate, max_workers)
+
+    fetched = {location: api_data for location, api_data in weather.items() if isinstance(api_data, dict)}
+    # Scored like the current prediction of a single location
+    fetched = weather_data.get_rel_data_many(fetched, days=1, current_conditions=True).set_index('Location')
+
+    rows = []
+    scored = []
+    for result, hrs, row in zip(results, hours, stored):
+        if 'error' in result:
+            continue
+        if row is None:
+            location = location_string(result['county'], result['state'])
+            if location not in fetched.index:
+                result['error'] = 'weather lookup failed'
+                continue
+            row = fetched.loc[[location], weather_data.REL_COLUMNS].reset_index(drop=True)
+            row['Outage'] = 1
+            row['hours'] = hrs
+            row['State'] = encode_state(result['state'])
+            row = row[FEATURES]
+        rows.append(row)
+        scored.append(result)
+
+    if rows:
+        y = predict(pd.concat(rows, ignore_index=True))
+        for result, value in zip(scored, y):
+            result['customers_affected'] = float(value)
+    return results
@@ -1,9 +1,203 @@
-import requests
 import pandas as pd
-import plotly.express as px
 import io
+import os
+import json
+import time
+import threading
 import numpy as np
 import datetime as dt
+from pathlib import Path
+from functools import lru_cache
+from collections import namedtuple
+from app.methods import metrics, upstream
+from app.methods.fips import FIPS_TABLE_PATH, load_fips_table
+
+GEOJSON_URL = 'https://raw.githubusercontent.com/plotly/datasets/master/geojson-counties-fips.json'
+GEOJSON_PATH = 'data/geojson-counties-fips.json'
+ODIN_URL = 'https://odin.ornl.gov/odi'
+
+odin_client = upstream.UpstreamClient('odin', timeout=(3.05, 30))
+geojson_client = upstream.UpstreamClient('geojson', timeout=(3.05, 30), pool_maxsize=1)
+
+def quantize_geojson(geojson, precision=3):
+    '''
+    Returns a copy of a GeoJSON FeatureCollection with coordinates rounded to a fixed number of
+    decimals and consecutive duplicate points removed. 3 decimals is roughly 100m, which is well
+    below what a county choropleth can show
+
+    Keyword arguments:\n
+    geojson -- A GeoJSON FeatureCollection dict
+
+    Optional arguments:\n
+    precision -- Number of decimals to keep. Defaults to 3
+    '''
+    def ring(points):
+        out = []
+        for x, y in points:
+            point = [round(x, precision), round(y, precision)]
+            if not out or out[-1] != point:
+                out.append(point)
+        # A closed ring needs at least 4 points, keep the original shape if rounding collapsed it
+        return out if len(out) >= 4 else [[round(x, precision), round(y, precision)] for x, y in points]
+
+    features = []
+    for feature in geojson['features']:
+        geometry = feature['geometry']
+        if geometry['type'] == 'Polygon':
+            coordinates = [ring(r) for r in geometry['coordinates']]
+        elif geometry['type'] == 'MultiPolygon':
+            coordinates = [[ring(r) for r in polygon] for polygon in geometry['coordinates']]
+        else:
+            coordinates = geometry['coordinates']
+        features.append({'type': 'Feature', 'id': feature['id'], 'properties': feature.get('properties', {}),
+                         'geometry': {'type': geometry['type'], 'coordinates': coordinates}})
+    return {'type': 'FeatureCollection', 'features': features}
+
+def bundle_geojson(path=GEOJSON_PATH, precision=3):
+    '''
+    Downloads the county GeoJSON, quantizes it and saves it locally. Run at build time by
+    bin/post_compile so deployed dynos never download it. The file is replaced atomically, so
+    readers in other processes never load a partial file
+
+    Optional arguments:\n
+    path -- Where to save the file. Defaults to 'data/geojson-counties-fips.json'\n
+    precision -- Number of decimals to keep. Defaults to 3
+    '''
+    counties = quantize_geojson(geojson_client.get_json(GEOJSON_URL), precision)
+    Path(path).parent.mkdir(parents=True, exist_ok=True)
+    # One temporary file per process, as several workers may bundle at once
+    tmp = f'{path}.{os.getpid()}.tmp'
+    with open(tmp, 'w') as f:
+        json.dump(counties, f, separators=(',', ':'))
+    os.replace(tmp, path)
+    return counties
+
+@lru_cache(maxsize=None)
+def load_counties(path=GEOJSON_PATH):
+    '''
+    Returns the county GeoJSON indexed by integer FIPS code. Loaded once per process from the
+    local bundle, which is downloaded on first use if it does not exist (e.g. a local checkout
+    where bundle_geojson has not been run)
+    '''
+    if Path(path).exists():
+        with open(path) as f:
+            counties = json.load(f)
+    else:
+        counties = bundle_geojson(path)
+    return {int(feature['id']): feature for feature in counties['features']}
+
+def fetch_real_time_outages():
+    '''
+    Requests the ODIN real-time outage feed and returns a sorted tuple of
+    (FIPS code, reported start time) pairs for counties with outages
+    '''
+    params = {
+        'format': 'json',
+    }
+
+    r_json = odin_client.get_json(ODIN_URL, params=params)
+    outage_counties = []
+
+    for outage in r_json['outage']:
+        if 'outageArea' in outage:
+            if outage['outageArea']['outageAreaKind'] == "COUNTY" and len(outage['communityDescriptor']) == 5:
+                if  'reportedStartTime' in outage:
+                    outage_counties.append((outage['communityDescriptor'], outage['reportedStartTime']))
+                else:
+                    outage_counties.append((outage['communityDescriptor'], np.nan))
+
+    return tuple(sorted(outage_counties, key=lambda x: (x[0], str(x[1]))))
+
+OutageSnapshot = namedtuple('OutageSnapshot', ['outages', 'fetched_at', 'added', 'removed', 'error'])
+
+class OutagePoller:
+    def __init__(self, interval=300, fetch=fetch_real_time_outages):
+        '''
+        Polls the ODIN feed in the background and keeps the latest result in memory, so
+        readers never wait on the upstream feed and upstream load does not grow with traffic.
+        Under the gevent worker the polling thread is a greenlet.
+
+        Optional arguments:\n
+        interval -- Seconds between polls. Defaults to 300\n
+        fetch -- A callable returning a tuple of (FIPS, start time) pairs. Defaults to fetch_real_time_outages
+        '''
+        self.interval = interval
+        self.fetch = fetch
+        self.snapshot = None
+        self._lock = threading.Lock()
+        self._thread = None
+        self._pid = None
+
+    def refresh(self):
+        '''
+        Fetches the feed once and swaps in a new snapshot. On failure the previous outages are
+        kept and the error is recorded on the snapshot
+        '''
+        previous = self.snapshot
+        try:
+            outages = self.fetch()
+        except Exception as e:
+            if previous is None:
+                raise
+            self.snapshot = previous._replace(error=repr(e))
+            return self.snapshot
+
+        if previous is None:
+            added, removed = frozenset(code for code, _ in outages), frozenset()
+        else:
+            old = {code for code, _ in previous.outages}
+            new = {code for code, _ in outages}
+            added, removed = frozenset(new - old), frozenset(old - new)
+            if outages == previous.outages:
+                outages = previous.outages  # Reuse the old tuple so downstream caches compare cheaply
+        self.snapshot = OutageSnapshot(outages, time.time(), added, removed, None)
+        return self.snapshot
+
+    def _run(self):
+        '''Private method run by the polling thread'''
+        while True:
+            time.sleep(self.interval)
+            try:
+                self.refresh()
+            except Exception:
+                pass
+
+    def start(self):
+        '''
+        Starts the polling thread if it is not already running in this process. Safe to call
+        after a fork, where the parent's thread does not exist
+        '''
+        if self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid != os.getpid():
+                self._thread = threading.Thread(target=self._run, name='odin-poller', daemon=True)
+                self._thread.start()
+                self._pid = os.getpid()
+
+    def get(self):
+        '''
+        Returns the latest snapshot, starting the poller and fetching synchronously on first use
+        '''
+        self.start()
+        if self.snapshot is None:
+            with self._lock:
+                if self.snapshot is None:
+                    self.refresh()
+        return self.snapshot
+
+    def age(self):
+        '''
+        Returns the number of seconds since the last successful poll, or None before the first one
+        '''
+        if self.snapshot is None:
+            return None
+        return time.time() - self.snapshot.fetched_at
+
+poller = OutagePoller()
+
+_map_cache_lock = threading.Lock()
+_map_cache = {'key': None, 'html': None}
 
 class OutageMap:
     def create_map(self, fips, title=""):
@@ -16,18 +210,20 @@ class OutageMap:
         Optional arguments:\n
         title -- A title for the map. Defaults to "" 
         '''
+        import plotly.express as px
         df = pd.DataFrame(fips, columns=['CountyFIPS', 'Start Time'])
         df['outage'] = 1
         df['CountyFIPS'] = df.CountyFIPS.astype(int)
         df['Start Time'] = pd.to_datetime(df['Start Time'], utc=True).dt.strftime('%m/%d/%Y %H:%M %Z')
         df['Start Time'] = df['Start Time'].fillna('Unknown')
 
-        fips_master = pd.read_csv('data/fips_table.csv')
+        fips_master = load_fips_table()
         df = df.merge(fips_master, on='CountyFIPS')
 
-        fips_url = 'https://raw.githubusercontent.com/plotly/datasets/master/geojson-counties-fips.json'
-        response = requests.get(fips_url)
-        counties = response.json() 
+        # Only ship the shapes that are actually drawn
+        features = load_counties()
+        counties = {'type': 'FeatureCollection',
+                    'features': [features[code] for code in df['CountyFIPS'].unique() if code in features]}
 
         fig = px.choropleth(df, geojson=counties, locations='CountyFIPS', color='outage',
                                 color_continuous_scale='PuBu',
@@ -53,26 +249,9 @@ class OutageMap:
     def real_time_outages_fips(self):
         '''
         Method to get a list of FIPS codes correlating to counties that have 
-        real-time power outages
+        real-time power outages. Served from the background poller's latest snapshot
         '''
-        outage_url = 'https://odin.ornl.gov/odi'
-        params = {
-            'format': 'json',
-        }
-
-        response = requests.get(outage_url, params=params)
-        r_json = response.json()
-        outage_counties = []
-
-        for outage in r_json['outage']:
-            if 'outageArea' in outage:
-                if outage['outageArea']['outageAreaKind'] == "COUNTY" and len(outage['communityDescriptor']) == 5:
-                    if  'reportedStartTime' in outage:
-                        outage_counties.append([outage['communityDescriptor'], outage['reportedStartTime']])
-                    else:
-                        outage_counties.append([outage['communityDescriptor'], np.nan])
-
-        return outage_counties
+        return [[code, start] for code, start in poller.get().outages]
 
     def real_time_outages_map(self, title="Real-Time Power Outages"):
         '''
@@ -85,6 +264,30 @@ class OutageMap:
         fig = self.create_map(fips, title)
         return fig
 
+    def real_time_outages_html(self, title="Real-Time Power Outages"):
+        '''
+        Returns the real-time outage map as an HTML fragment. The fragment is cached and only
+        re-rendered when the set of outage counties (or their start times) changes
+
+        Optional arguments:\n
+        title -- A title for the map. Defaults to "Real-Time Power Outages"
+        '''
+        fips = self.real_time_outages_fips()
+        key = (title, tuple((str(code), str(start)) for code, start in fips))
+        with _map_cache_lock:
+            if _map_cache['key'] == key:
+                return _map_cache['html']
+
+        with metrics.timer('figure_build'):
+            fig = self.create_map(fips, title)
+            buffer = io.StringIO()
+            fig.write_html(buffer, full_html=False, include_plotlyjs='cdn')
+            html = buffer.getvalue()
+        with _map_cache_lock:
+            _map_cache['key'] = key
+            _map_cache['html'] = html
+        return html
+
 if __name__ == "__main__":
     real_time = OutageMap()
     fig = real_time.real_time_outages_map()
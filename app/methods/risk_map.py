@@ -0,0 +1,172 @@
+import io
+import os
+import json
+import time
+import threading
+import datetime as dt
+import numpy as np
+import pandas as pd
+import app.methods.data as weather_data
+from app.methods import model, feature_store, metrics
+from app.methods.fips import load_fips_table
+from app.methods.outage_map import load_counties
+
+RISK_MAP_PATH = 'risk_map.json'
+
+def county_locations(table):
+    '''
+    Returns the weather query location of every county in the FIPS table
+    '''
+    return [model.location_string(county, state) for county, state in zip(table['CountyName'], table['StateName'])]
+
+def score_counties(hours=24, max_workers=16, table=None):
+    '''
+    Scores every county against today's weather with a single predict call. Weather comes from
+    the feature store (county, then state) where available and is otherwise fetched from the
+    weather API with bounded concurrency through the shared weather cache. Counties whose
+    weather could not be fetched are left out
+
+    Optional arguments:\n
+    hours -- Hours since the outage started used for every county. Defaults to 24\n
+    max_workers -- Maximum number of concurrent weather requests. Defaults to 16\n
+    table -- The FIPS lookup table. Defaults to data/fips_table.csv
+
+    Return: DataFrame with 'FIPS', 'County', 'State' and 'Customers Affected' columns
+    '''
+    table = load_fips_table() if table is None else table
+    today = dt.date.today()
+    n = len(table)
+    counties = table['CountyFIPS'].map('{:05d}'.format).to_numpy()
+    states = table['StateFIPS'].map('{:02d}'.format).to_numpy()
+
+    # Rows missing a feature are fetched instead, the model never saw one missing
+    values, found = feature_store.store.lookup_many(counties, [today] * n, complete=True)
+    state_values, state_found = feature_store.store.lookup_many(states, [today] * n, complete=True)
+    use_state = ~found & state_found
+    values[use_state] = state_values[use_state]
+    found |= state_found
+    stored = pd.DataFrame(values, columns=feature_store.COLUMNS)
+    stored[feature_store.SEASON_COLUMNS] = feature_store.season_features(feature_store.to_days([today] * n))
+
+    locations = county_locations(table)
+    missing = [location for location, ok in zip(locations, found) if not ok]
+    # Only today is scored
+    current = today.strftime('%Y-%m-%d')
+    weather = weather_data.get_weather_many(missing, current, current, max_workers)
+    fetched = {location: api_data for location, api_data in weather.items() if isinstance(api_data, dict)}
+    # Scored like the current prediction of a single location
+    fetched = weather_data.get_rel_data_many(fetched, days=1, current_conditions=True).set_index('Location')
+
+    rows = np.flatnonzero(~found)
+    rows = rows[[locations[row] in fetched.index for row in rows]]
+    stored.loc[rows, weather_data.REL_COLUMNS] = fetched.loc[[locations[row] for row in rows], weather_data.REL_COLUMNS].to_numpy()
+
+    scored = np.concatenate([np.flatnonzero(found), rows])
+    scored.sort()
+    df = stored.iloc[scored].reset_index(drop=True)
+    df['Outage'] = 1
+    df['hours'] = hours
+    df['State'] = [model.encode_state(state) for state in table['StateName'].iloc[scored]]
+    y = model.predict(df[model.FEATURES])
+
+    return pd.DataFrame({'FIPS': counties[scored], 'County': table['CountyName'].iloc[scored].to_numpy(),
+                         'State': table['StateAbbr'].iloc[scored].to_numpy(), 'Customers Affected': y})
+
+def save_risk(df, path=RISK_MAP_PATH, hours=24):
+    '''
+    Saves county scores to a JSON file. The file is replaced atomically so readers never see a partial result
+
+    Keyword arguments:\n
+    df -- DataFrame returned by score_counties
+    '''
+    result = {
+        'computed_at': time.time(),
+        'model_version': model.registry.version,
+        'hours': hours,
+        'counties': df.to_dict(orient='list'),
+    }
+    tmp = f'{path}.tmp'
+    with open(tmp, 'w') as f:
+        json.dump(result, f)
+    os.replace(tmp, path)
+
+_risk_cache_lock = threading.Lock()
+_risk_cache = {'key': None, 'result': None, 'html': None}
+
+def load_risk(path=RISK_MAP_PATH):
+    '''
+    Returns the latest saved result as a dict with a 'counties' DataFrame, or None if the job has
+    not run yet. The file is only re-read when it changes
+    '''
+    try:
+        key = (path, os.stat(path).st_mtime_ns)
+    except FileNotFoundError:
+        return None
+    with _risk_cache_lock:
+        if _risk_cache['key'] == key:
+            return _risk_cache['result']
+
+    with open(path) as f:
+        result = json.load(f)
+    result['counties'] = pd.DataFrame(result['counties'], dtype=object).astype({'Customers Affected': float})
+    with _risk_cache_lock:
+        _risk_cache.update(key=key, result=result, html=None)
+    return result
+
+def create_risk_map(df, title="Predicted Customers Affected"):
+    '''
+    Creates a continuous color county map of predicted customers affected
+
+    Keyword arguments:\n
+    df -- DataFrame with 'FIPS', 'County', 'State' and 'Customers Affected' columns
+
+    Optional arguments:\n
+    title -- A title for the map. Defaults to "Predicted Customers Affected"
+    '''
+    import plotly.express as px
+    features = load_counties()
+    counties = {'type': 'FeatureCollection',
+                'features': [features[code] for code in df['FIPS'].astype(int).unique() if code in features]}
+
+    # Clip the scale so a few extreme counties do not wash out the rest of the map
+    upper = float(np.nanpercentile(df['Customers Affected'], 95)) if len(df) else 1
+    fig = px.choropleth(df, geojson=counties, locations='FIPS', color='Customers Affected',
+                            color_continuous_scale='YlOrRd',
+                            range_color=(0, max(upper, 1)),
+                            scope="usa",
+                            hover_data={'County': True, 'State': True, 'FIPS': False, 'Customers Affected': ':,.0f'}
+                        )
+    fig.update_layout(margin={"r":0,"t":0,"l":0,"b":0})
+    fig.update_layout(title = {
+            'text': title,
+            'y':0.95,
+            'x':0.5,
+            'xanchor': 'center',
+            'yanchor': 'top'
+        })
+    fig.layout.xaxis.fixedrange = True
+    fig.layout.yaxis.fixedrange = True
+    fig.layout.dragmode = False
+    return fig
+
+def risk_map_html(path=RISK_MAP_PATH):
+    '''
+    Returns the latest risk map as an HTML fragment and the result it was drawn from, or
+    (None, None) if the job has not run yet. The fragment is rendered once per saved result
+    '''
+    result = load_risk(path)
+    if result is None:
+        return None, None
+    with _risk_cache_lock:
+        if _risk_cache['result'] is result and _risk_cache['html'] is not None:
+            return _risk_cache['html'], result
+
+    with metrics.timer('figure_build'):
+        fig = create_risk_map(result['counties'])
+        buffer = io.StringIO()
+        fig.write_html(buffer, full_html=False, include_plotlyjs='cdn')
+        html = buffer.getvalue()
+    with _risk_cache_lock:
+        if _risk_cache['result'] is result:
+            _risk_cache['html'] = html
+    return html, result
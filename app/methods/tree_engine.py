@@ -0,0 +1,151 @@
+import json
+import numpy as np
+
+class TreeEnsemble:
+    def __init__(self, feature, threshold, left, right, default_left, value, roots, depth, base_score, feature_names=None):
+        '''
+        A gradient boosted tree ensemble flattened into NumPy arrays. Every tree's nodes are
+        stored back to back, leaves point to themselves, and rows are routed through all trees
+        at once for a fixed number of steps, so scoring is a handful of array operations per
+        tree level instead of building a DMatrix.
+
+        Keyword arguments:\n
+        feature -- Split feature index of each node\n
+        threshold -- Split threshold of each node. Rows go left when the value is below it\n
+        left -- Index of each node's left child, or of the node itself for a leaf\n
+        right -- Index of each node's right child, or of the node itself for a leaf\n
+        default_left -- Whether a missing (NaN) value goes left at each node\n
+        value -- Leaf value of each node, 0 for split nodes\n
+        roots -- Index of the root node of each tree\n
+        depth -- Maximum depth of any tree\n
+        base_score -- Constant added to the sum of leaf values\n
+        feature_names -- Feature names in the order the model expects. Defaults to None
+        '''
+        self.feature = feature
+        self.threshold = threshold
+        self.left = left
+        self.right = right
+        self.default_left = default_left
+        self.value = value
+        self.roots = roots
+        self.depth = depth
+        self.base_score = base_score
+        self.feature_names = feature_names
+        # Child of node i is children[2*i + went_left], so a step is one gather
+        self.children = np.stack([right, left], axis=1).ravel()
+
+    @classmethod
+    def from_booster(cls, booster, iterations=None):
+        '''
+        Exports the trees of an XGBoost gbtree booster with a squared error objective
+
+        Keyword arguments:\n
+        booster -- An xgboost.Booster
+
+        Optional arguments:\n
+        iterations -- Number of boosting rounds to keep. Defaults to the booster's best iteration
+        plus one if it was trained with early stopping, otherwise every round
+        '''
+        learner = json.loads(booster.save_raw('json'))['learner']
+        if learner['gradient_booster']['name'] != 'gbtree':
+            raise ValueError(f"Unsupported booster {learner['gradient_booster']['name']}")
+        if learner['objective']['name'] not in ['reg:squarederror', 'reg:linear']:
+            raise ValueError(f"Unsupported objective {learner['objective']['name']}")
+
+        model = learner['gradient_booster']['model']
+        if iterations is None and booster.attr('best_iteration') is not None:
+            iterations = int(booster.attr('best_iteration')) + 1
+        per_round = int(model['gbtree_model_param'].get('num_parallel_tree', 1))
+        trees = model['trees'][:None if iterations is None else iterations * per_round]
+
+        feature, threshold, left, right, default_left, value, roots = [], [], [], [], [], [], []
+        depth = 0
+        offset = 0
+        for tree in trees:
+            if any(tree['split_type']):
+                raise ValueError('Categorical splits are not supported')
+            lc = np.asarray(tree['left_children'], dtype=np.int32)
+            rc = np.asarray(tree['right_children'], dtype=np.int32)
+            nodes = np.arange(len(lc), dtype=np.int32)
+            leaf = lc == -1
+            conditions = np.asarray(tree['split_conditions'], dtype=np.float32)
+
+            roots.append(offset)
+            feature.append(np.where(leaf, 0, tree['split_indices']).astype(np.int32))
+            threshold.append(np.where(leaf, 0, conditions).astype(np.float32))
+            left.append(np.where(leaf, nodes, lc) + offset)
+            right.append(np.where(leaf, nodes, rc) + offset)
+            default_left.append(np.asarray(tree['default_left'], dtype=bool))
+            value.append(np.where(leaf, conditions, 0).astype(np.float32))
+            depth = max(depth, cls._tree_depth(lc, rc))
+            offset += len(lc)
+
+        base_score = float(learner['learner_model_param']['base_score'].strip('[]'))
+        return cls(np.concatenate(feature), np.concatenate(threshold), np.concatenate(left).astype(np.int32),
+                   np.concatenate(right).astype(np.int32), np.concatenate(default_left), np.concatenate(value),
+                   np.asarray(roots, dtype=np.int32), depth, base_score, booster.feature_names)
+
+    @staticmethod
+    def _tree_depth(left, right):
+        '''Private method returning the depth of a tree from its child arrays'''
+        depth = 0
+        level = [0]
+        while level:
+            level = [child for node in level for child in (left[node], right[node]) if child != -1]
+            depth += 1 if level else 0
+        return depth
+
+    def predict(self, X, chunksize=2048):
+        '''
+        Returns the prediction for each row of X
+
+        Keyword arguments:\n
+        X -- A 2D array of features in model order, or a single row. NaN marks a missing value
+
+        Optional arguments:\n
+        chunksize -- Number of rows routed at once, which bounds the size of the working arrays. Defaults to 2048
+        '''
+        X = np.asarray(X, dtype=np.float32)
+        if X.ndim == 1:
+            return np.array([self.predict_one(X)], dtype=np.float32)
+        out = np.empty(X.shape[0], dtype=np.float32)
+        for start in range(0, X.shape[0], chunksize):
+            out[start:start+chunksize] = self._predict_chunk(X[start:start+chunksize])
+        return out
+
+    def _predict_chunk(self, X):
+        '''Private method to score a block of rows, with nodes laid out as (trees, rows)'''
+        n, width = X.shape
+        flat = np.ascontiguousarray(X).ravel()
+        offsets = np.arange(n, dtype=np.int64) * width
+        nodes = np.repeat(self.roots[:, np.newaxis], n, axis=1)
+        for _ in range(self.depth):
+            x = flat[self.feature[nodes] + offsets]
+            go_left = x < self.threshold[nodes]
+            go_left |= np.isnan(x) & self.default_left[nodes]
+            nodes = self.children[nodes * 2 + go_left]
+        return self._accumulate(self.value[nodes])
+
+    def _accumulate(self, leaves):
+        '''
+        Private method to add up leaf values in tree order in float32, starting from base_score,
+        which reproduces XGBoost's rounding exactly. cumsum adds sequentially, unlike sum
+
+        Keyword arguments:\n
+        leaves -- A (trees, ...) array of leaf values, modified in place
+        '''
+        leaves[0] += np.float32(self.base_score)
+        return np.cumsum(leaves, axis=0, dtype=np.float32)[-1]
+
+    def predict_one(self, x):
+        '''
+        Returns the prediction for a single row of features in model order
+        '''
+        x = np.asarray(x, dtype=np.float32).ravel()
+        nodes = self.roots
+        for _ in range(self.depth):
+            v = x[self.feature[nodes]]
+            go_left = v < self.threshold[nodes]
+            go_left |= np.isnan(v) & self.default_left[nodes]
+            nodes = self.children[nodes * 2 + go_left]
+        return float(self._accumulate(self.value[nodes]))
@@ -0,0 +1,198 @@
+import os
+import time
+import threading
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from concurrent.futures import ThreadPoolExecutor
+from app.methods import metrics
+
+# Every client by name
+clients = {}
+
+class CircuitOpenError(requests.exceptions.ConnectionError):
+    '''Raised instead of calling an upstream whose circuit breaker is open'''
+
+class CircuitBreaker:
+    def __init__(self, failure_threshold=5, reset_timeout=30):
+        '''
+        Stops calls to an upstream after consecutive failures. Once reset_timeout seconds have
+        passed a single trial call is let through, which closes the circuit if it succeeds and
+        opens it again if it fails
+
+        Optional arguments:\n
+        failure_threshold -- Consecutive failures that open the circuit. Defaults to 5\n
+        reset_timeout -- Seconds the circuit stays open before a trial call. Defaults to 30
+        '''
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self._lock = threading.Lock()
+        self.failures = 0
+        self.opened_at = None
+        self._trial = False
+
+    @property
+    def state(self):
+        '''One of 'closed', 'open' or 'half-open' '''
+        if self.opened_at is None:
+            return 'closed'
+        return 'half-open' if time.time() >= self.opened_at + self.reset_timeout else 'open'
+
+    def allow(self):
+        '''
+        Returns whether a call may go through now
+        '''
+        with self._lock:
+            if self.opened_at is None:
+                return True
+            if self._trial or time.time() < self.opened_at + self.reset_timeout:
+                return False
+            self._trial = True
+            return True
+
+    def success(self):
+        '''Records a successful call, closing the circuit'''
+        with self._lock:
+            self.failures = 0
+            self.opened_at = None
+            self._trial = False
+
+    def failure(self):
+        '''Records a failed call, opening the circuit after too many in a row or a failed trial'''
+        with self._lock:
+            self.failures += 1
+            if self._trial or self.failures >= self.failure_threshold:
+                self.opened_at = time.time()
+            self._trial = False
+
+    def release(self):
+        '''
+        Ends a trial call that recorded neither a success nor a failure, e.g. one interrupted by
+        gevent.Timeout, so the next call can be let through as a new trial
+        '''
+        with self._lock:
+            self._trial = False
+
+class UpstreamClient:
+    def __init__(self, name, timeout=(3.05, 10), pool_maxsize=16, retries=1, failure_threshold=5, reset_timeout=30):
+        '''
+        HTTP client for one upstream service. Connections are kept alive in a pool per host,
+        every request has a connect and read timeout, failed connects are retried once, and a
+        circuit breaker fails fast while the upstream is down instead of tying up the worker.
+        Requests are timed on /metrics under the client's name
+
+        Keyword arguments:\n
+        name -- Name of the upstream, e.g. 'visual_crossing'
+
+        Optional arguments:\n
+        timeout -- (connect, read) timeouts in seconds. Defaults to (3.05, 10)\n
+        pool_maxsize -- Connections kept alive per host. Defaults to 16\n
+        retries -- Retries of a failed connect. Defaults to 1\n
+        failure_threshold -- Consecutive failures that open the circuit. Defaults to 5\n
+        reset_timeout -- Seconds the circuit stays open. Defaults to 30
+        '''
+        self.name = name
+        self.timeout = timeout
+        self.pool_maxsize = pool_maxsize
+        self.retries = retries
+        self.breaker = CircuitBreaker(failure_threshold, reset_timeout)
+        self._session = None
+        self._pid = None
+        clients[name] = self
+
+    @property
+    def session(self):
+        '''
+        The pooled requests.Session of this process. A new one is made after a fork so workers
+        never share the parent's sockets
+        '''
+        if self._pid != os.getpid():
+            session = requests.Session()
+            retry = Retry(total=None, connect=self.retries, read=False, redirect=3, status=False, backoff_factor=0.2)
+            adapter = HTTPAdapter(pool_connections=4, pool_maxsize=self.pool_maxsize, max_retries=retry)
+            session.mount('https://', adapter)
+            session.mount('http://', adapter)
+            self._session, self._pid = session, os.getpid()
+        return self._session
+
+    def get(self, url, **kwargs):
+        '''
+        Sends a GET request and returns the response, raising for error statuses. Connection
+        errors, timeouts, 5xx and 429 responses count against the circuit breaker
+
+        Keyword arguments:\n
+        url -- The url to request. Other keyword arguments are passed to requests
+        '''
+        if not self.breaker.allow():
+            metrics.UPSTREAM_REJECTED.inc(self.name)
+            raise CircuitOpenError(f'{self.name} is unavailable, retrying in at most {self.breaker.reset_timeout}s')
+        kwargs.setdefault('timeout', self.timeout)
+        try:
+            with metrics.upstream(self.name):
+                response = self.session.get(url, **kwargs)
+                response.raise_for_status()
+        except requests.exceptions.HTTPError as e:
+            status = e.response.status_code
+            # Client errors mean the upstream is up, e.g. an unknown location
+            if status >= 500 or status == 429:
+                self.breaker.failure()
+            else:
+                self.breaker.success()
+            raise
+        except requests.exceptions.RequestException:
+            self.breaker.failure()
+            raise
+        else:
+            self.breaker.success()
+        finally:
+            # Any other exception must not leave a trial pending, which would keep the circuit open
+            self.breaker.release()
+        return response
+
+    def get_json(self, url, **kwargs):
+        '''
+        Sends a GET request and returns the decoded JSON body
+        '''
+        return self.get(url, **kwargs).json()
+
+def configure(timeout=None, failure_threshold=None, reset_timeout=None):
+    '''
+    Updates the settings of every upstream client
+
+    Optional arguments:\n
+    timeout -- (connect, read) timeouts in seconds\n
+    failure_threshold -- Consecutive failures that open a circuit\n
+    reset_timeout -- Seconds a circuit stays open
+    '''
+    for client in clients.values():
+        if timeout is not None:
+            client.timeout = timeout
+        if failure_threshold is not None:
+            client.breaker.failure_threshold = failure_threshold
+        if reset_timeout is not None:
+            client.breaker.reset_timeout = reset_timeout
+
+def fan_out(calls, max_workers=16):
+    '''
+    Runs independent calls concurrently, e.g. upstream requests for several locations. Under the
+    gevent worker the pool's threads are greenlets, so waiting calls do not block each other
+
+    Keyword arguments:\n
+    calls -- An iterable of callables taking no arguments
+
+    Optional arguments:\n
+    max_workers -- Maximum number of calls in flight. Defaults to 16
+
+    Return: A list with the result of each call in order, or the exception it raised
+    '''
+    def run(call):
+        try:
+            return call()
+        except Exception as e:
+            return e
+
+    calls = list(calls)
+    if len(calls) <= 1:
+        return [run(call) for call in calls]
+    with ThreadPoolExecutor(max_workers=min(max_workers, len(calls))) as pool:
+        return list(pool.map(run, calls))
@@ -0,0 +1,44 @@
+import time
+import importlib
+from app.methods import feature_store, fips, helpers, model, outage_map
+
+# Assets every request may need, by name. Under gunicorn's preload_app they are loaded once in
+# the master and the forked workers share them copy-on-write instead of each loading a copy.
+# Modules only needed to draw figures are imported here instead of at startup
+ASSETS = {
+    'model': lambda: model.registry.artifacts(),
+    'plotly': lambda: [importlib.import_module(name) for name in ['plotly.express', 'plotly.graph_objects']],
+    'outage_records': helpers.get_store,
+    'fips_table': fips.get_resolver,
+    'county_geojson': outage_map.load_counties,
+    'feature_store': feature_store.store.index,
+}
+
+# Load result of each asset in this process
+status = {}
+
+def warm_up():
+    '''
+    Loads every asset that is not loaded yet and records how long each took. Failures are
+    recorded instead of raised, so a missing asset (e.g. the GeoJSON when offline) does not stop
+    the server from starting, and it is retried by the next call
+
+    Return: A dict mapping each asset name to {'ready', 'seconds'} or {'ready', 'error'}
+    '''
+    for name, load in ASSETS.items():
+        if status.get(name, {}).get('ready'):
+            continue
+        start = time.perf_counter()
+        try:
+            load()
+        except Exception as e:
+            status[name] = {'ready': False, 'error': repr(e)}
+        else:
+            status[name] = {'ready': True, 'seconds': round(time.perf_counter() - start, 3)}
+    return status
+
+def ready():
+    '''
+    Returns whether every asset is loaded in this process
+    '''
+    return all(status.get(name, {}).get('ready') for name in ASSETS)
@@ -1,21 +1,115 @@
 import pandas as pd
-import addfips
+from app.methods import fips
 import aiohttp
 import asyncio
-import numpy as np
-from more_itertools import chunked
+import datetime as dt
+import json
+import random
+import sqlite3
+import time
 
 
+class TokenBucket:
+    def __init__(self, rate=5, capacity=5):
+        '''
+        Async token bucket rate limiter
+
+        Optional arguments:\n
+        rate -- Tokens added per second. Defaults to 5\n
+        capacity -- Maximum burst size. Defaults to 5
+        '''
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.lock = asyncio.Lock()
+
+    async def acquire(self):
+        '''
+        Waits until a token is available and takes it
+        '''
+        async with self.lock:
+            while True:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+
+class NOAAResultStore:
+    def __init__(self, path='noaa_weather.sqlite'):
+        '''
+        SQLite store of daily weather results keyed by (FIPS, date), plus a count of requests
+        made per day so the daily quota is honored across runs
+
+        Optional arguments:\n
+        path -- Path of the SQLite file. Defaults to 'noaa_weather.sqlite'
+        '''
+        self.db = sqlite3.connect(path)
+        self.db.execute('CREATE TABLE IF NOT EXISTS weather (fips TEXT, date TEXT, data TEXT, PRIMARY KEY (fips, date))')
+        self.db.execute('CREATE TABLE IF NOT EXISTS quota (day TEXT PRIMARY KEY, used INTEGER)')
+        self.db.commit()
+
+    def get(self, fips, date):
+        '''
+        Returns the stored result for a FIPS code and date, or None if it has not been fetched
+        '''
+        row = self.db.execute('SELECT data FROM weather WHERE fips = ? AND date = ?', (fips, date)).fetchone()
+        return None if row is None else json.loads(row[0])
+
+    def put(self, fips, date, data):
+        '''
+        Stores the result for a FIPS code and date
+        '''
+        self.db.execute('INSERT OR REPLACE INTO weather VALUES (?, ?, ?)', (fips, date, json.dumps(data)))
+        self.db.commit()
+
+    def fetched(self):
+        '''
+        Returns the set of (FIPS, date) keys already stored
+        '''
+        return set(self.db.execute('SELECT fips, date FROM weather').fetchall())
+
+    def used_today(self):
+        '''
+        Returns the number of requests made today (UTC)
+        '''
+        row = self.db.execute('SELECT used FROM quota WHERE day = ?', (str(dt.datetime.utcnow().date()),)).fetchone()
+        return 0 if row is None else row[0]
+
+    def count_request(self):
+        '''
+        Records one request against today's quota
+        '''
+        day = str(dt.datetime.utcnow().date())
+        self.db.execute('INSERT INTO quota VALUES (?, 1) ON CONFLICT(day) DO UPDATE SET used = used + 1', (day,))
+        self.db.commit()
+
 class NOAAWeatherDataInterface:
-    def __init__(self, token, units='metric'):
+    def __init__(self, token, units='metric', store_path='noaa_weather.sqlite', rate=5, daily_limit=10000,
+                 concurrency=5, retries=4):
         '''
         Keyword arguments:\n
         token -- A token for the NCDC NOAA API\n
         units -- Must be either 'metric' or 'standard'. Defaults to metric
+
+        Optional arguments:\n
+        store_path -- SQLite file where results are stored. Defaults to 'noaa_weather.sqlite'\n
+        rate -- Maximum requests per second. Defaults to NOAA's limit of 5\n
+        daily_limit -- Maximum requests per day. Defaults to NOAA's limit of 10,000\n
+        concurrency -- Maximum requests in flight. Defaults to 5\n
+        retries -- Attempts per record before giving up. Defaults to 4
         '''
         self.token = token 
         self.units = units
         self.url = 'https://www.ncdc.noaa.gov/cdo-web/api/v2/data'
+        self.store = NOAAResultStore(store_path)
+        self.rate = rate
+        self.daily_limit = daily_limit
+        self.concurrency = concurrency
+        self.retries = retries
 
     def __get_fip_code(self, location: tuple[str, str]):
         '''
@@ -25,110 +119,113 @@ class NOAAWeatherDataInterface:
         Keyword arguments:\n
         location -- A two tuple in the form of (County, State)
         '''
-        af = addfips.AddFIPS()
-        location = [loc.strip() for loc in location]    # Sanitize location strings
-
-        if location[0] not in [None, "", "Unknown", "None", "nan"]:
-            return af.get_county_fips(location[0], state=location[1])
-        else:
-            return af.get_state_fips(location[1])
+        county, state = location
+        return fips.resolve(county, state)
 
-    async def __get_record_weather(self, session, location: tuple[str, str], date: str):
+    async def __get_record_weather(self, session, bucket, fips: str, date: str):
         '''
-        Private method to interface with API and get weather data for a single location and date record
+        Private method to interface with API and get weather data for a single FIPS code and date.
+        Retries with exponential backoff on rate limiting, server and connection errors
 
         Keyword arguments:\n
-        location -- A two tuple in the form of (County, State)\n
+        session -- The shared aiohttp ClientSession\n
+        bucket -- The shared TokenBucket\n
+        fips -- A state or county FIPS code\n
         date -- A date in the form of 'YYYY-MM-DD'
+
+        Return: A dict mapping each datatype to its mean value across stations, empty if no
+        station reported that day. Error responses raise aiohttp.ClientResponseError, after
+        retrying 429 and 5xx responses
         '''
         headers = {
             'token': self.token,
         }
 
-        params = {
-            'datasetid': 'GHCND', # Daily Summaries Dataset
-            'locationid': 'FIPS:%s' % self.__get_fip_code(location),
-            'startdate': date,
-            'enddate': date,
-            'units': self.units,
-            'limit': '1000',
-            'includemetadata': 'false',
-            'datatypeid': ['TMAX', 'TMIN', 'SNOW', 'SNWD', 'PRCP']
-        }
-
-        async with session.get(self.url, headers=headers, params=params) as r:
-            r_json = await r.json()
+        params = [
+            ('datasetid', 'GHCND'), # Daily Summaries Dataset
+            ('locationid', 'FIPS:%s' % fips),
+            ('startdate', date),
+            ('enddate', date),
+            ('units', self.units),
+            ('limit', '1000'),
+            ('includemetadata', 'false'),
+        ] + [('datatypeid', datatype) for datatype in ['TMAX', 'TMIN', 'SNOW', 'SNWD', 'PRCP']]
 
-            try: 
-                df = pd.DataFrame.from_records(r_json['results'])
-            except KeyError:
-                '''TODO: Logic for failed API request'''
-                print(location, r_json)
+        for attempt in range(self.retries):
+            await bucket.acquire()
+            self.store.count_request()
+            try:
+                async with session.get(self.url, headers=headers, params=params) as r:
+                    if r.status >= 400:
+                        raise aiohttp.ClientResponseError(r.request_info, r.history, status=r.status)
+                    r_json = await r.json(content_type=None)
+            except aiohttp.ClientResponseError as e:
+                # Other client errors (e.g. a bad token or locationid) fail the same way on a retry
+                if (e.status != 429 and e.status < 500) or attempt == self.retries - 1:
+                    raise
+                await asyncio.sleep(2 ** attempt + random.random())
+                continue
+            except (aiohttp.ClientError, asyncio.TimeoutError):
+                if attempt == self.retries - 1:
+                    raise
+                await asyncio.sleep(2 ** attempt + random.random())
+                continue
 
-            df.drop(columns=['attributes', 'station'], inplace=True, errors='ignore')
-            df = df.groupby(['datatype'], as_index=False)['value'].mean()
-            df = df.pivot(columns='datatype')['value']
-            df = pd.DataFrame(np.diagonal(df), df.columns).T
-            df = df.rename_axis(None, axis=1)
-            df['Date'] = date
-            return df.loc[0, :].values.tolist()
+            # Days without any station reports return an empty body
+            df = pd.DataFrame.from_records(r_json.get('results', []), columns=['datatype', 'value'])
+            return df.groupby('datatype')['value'].mean().to_dict()
 
-    async def __get_multiple_rec_weather_data(self, records):
+    async def __get_multiple_rec_weather_data(self, keys):
         '''
-        Private helper function to retrieve weather data for multiple records
+        Private helper function to retrieve weather data for multiple (FIPS, date) keys over a
+        single session, with bounded concurrency and a shared rate limiter. Results are written
+        to the store as they arrive
 
         Keyword arguments:\n
-        records -- A 2D list where each element is of the form (location, date) where
-            location -- A three tuple in the form of (City, County, State)\n
-            date -- A date in the form of 'YYYY-MM-DD'
+        keys -- A list of (FIPS, date) tuples
         '''
-        connector = aiohttp.TCPConnector(limit=1)
-        async with aiohttp.ClientSession(connector=connector) as session:
-            tasks = []
-            for record in records:
-                location, date = record
-                tasks.append(asyncio.ensure_future(self.__get_record_weather(session, location, date)))
-
-            weather_data = await asyncio.gather(*tasks)
-            for rec in weather_data:
-                '''TODO: Create a method that interfaces with a database to store data?'''
-                print(rec)
-
-            await asyncio.sleep(1)
-            return weather_data
+        bucket = TokenBucket(self.rate, self.rate)
+        semaphore = asyncio.Semaphore(self.concurrency)
+        timeout = aiohttp.ClientTimeout(total=60, connect=10)
+        connector = aiohttp.TCPConnector(limit=self.concurrency)
+        async with aiohttp.ClientSession(connector=connector, timeout=timeout) as session:
+            async def fetch(fips, date):
+                async with semaphore:
+                    try:
+                        data = await self.__get_record_weather(session, bucket, fips, date)
+                    except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                        print(fips, date, repr(e))
+                        return
+                    self.store.put(fips, date, data)
 
-        #await asyncio.sleep(1) # Rate limiter to ensure requests/sec isn't overloaded
+            await asyncio.gather(*[fetch(fips, date) for fips, date in keys])
 
     def get_multiple_rec_weather_data(self, records):
         '''
-        Retrieves weather data for multiple records. Works by sending 
-        concurrent requests, but is limited to 5 requests/second
+        Retrieves weather data for multiple records. Records already in the store are not
+        requested again, and new requests are sent concurrently at no more than the configured
+        requests/second and requests/day
 
         Keyword arguments:\n
         records -- A 2D list where each element is of the form (location, date)
         where
             location -- A two tuple in the form of (County, State)\n
             date -- A date in the form of 'YYYY-MM-DD'
-        '''
-        batches = list(chunked(records, 5)) # Create batches of 5 records to be sent every second
-        for batch in batches:
-            asyncio.run(self.__get_multiple_rec_weather_data(batch))
 
-    async def __get_single_rec_weather_data(self, record):
+        Return: A list with a dict of weather values per record, or None for records that were not fetched
         '''
-        Private helper function to retrieve weather data for a single record
+        keys = [(self.__get_fip_code(location), date) for location, date in records]
+        fetched = self.store.fetched()
+        missing = list(dict.fromkeys(key for key in keys if key not in fetched and key[0] is not None))
 
-        Keyword arguments:\n
-        record -- A list in the form of (location, date) where
-            location -- A three tuple in the form of (City, County, State)\n
-            date -- A date in the form of 'YYYY-MM-DD'
-        '''
-        async with aiohttp.ClientSession() as session:
-            location, date = record
-            weather_data = await asyncio.gather(*[asyncio.ensure_future(self.__get_record_weather(session, location, date))])
-            for df in weather_data:
-                '''TODO: Create a method that interfaces with a database to store data?'''
-                print(df)
+        remaining = max(self.daily_limit - self.store.used_today(), 0)
+        if len(missing) > remaining:
+            print(f'Daily quota reached, deferring {len(missing) - remaining} of {len(missing)} requests')
+            missing = missing[:remaining]
+        if missing:
+            asyncio.run(self.__get_multiple_rec_weather_data(missing))
+
+        return [None if fips is None else self.store.get(fips, date) for fips, date in keys]
 
     def get_single_rec_weather_data(self, record):
         '''
@@ -136,10 +233,10 @@ class NOAAWeatherDataInterface:
 
         Keyword arguments:\n
         record -- A list in the form of (location, date) where
-            location -- A three tuple in the form of (City, County, State)\n
+            location -- A two tuple in the form of (County, State)\n
             date -- A date in the form of 'YYYY-MM-DD'
         '''
-        asyncio.run(self.__get_single_rec_weather_data(record))
+        return self.get_multiple_rec_weather_data([record])[0]
 
     '''
     TODO: Create a method that expands datatypes into more useful strings and includes units
@@ -168,7 +265,8 @@ if __name__ == "__main__":
             date = row['Date']
             records.append([location, date])
 
-    wd.get_multiple_rec_weather_data(records)
+    for rec in wd.get_multiple_rec_weather_data(records):
+        print(rec)
 
     #weather_records.append(wd.get_multiple_rec_weather_data(records))
     #print(weather_records)
\ No newline at end of file
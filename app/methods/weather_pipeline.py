@@ -0,0 +1,148 @@
+import numpy as np
+import pandas as pd
+from pathlib import Path
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from app.methods import fips
+from app.methods.feature_store import to_days, EPOCH
+
+WEATHER_DATA_PATH = 'weather_data'
+STATION_PATTERN = '*_weather_new.csv'
+
+MEASUREMENTS = ['AWND', 'PRCP', 'SNOW', 'SNWD', 'TMAX', 'TMIN']
+# NOAA weather type flags and the event columns they become
+EVENT_CODES = {'WT01': 'Fog', 'WT03': 'Thunder', 'WT05': 'Hail', 'WT07': 'Dust', 'WT10': 'Tornado',
+               'WT11': 'Wind', 'WT16': 'Rain', 'WT18': 'Snow'}
+DAILY_COLUMNS = MEASUREMENTS + list(EVENT_CODES.values())
+
+def read_station_records(path):
+    '''
+    Reads a NOAA daily summaries csv of station records into a DataFrame with 'Station', 'Date'
+    and DAILY_COLUMNS. Columns missing from the file are left empty
+
+    Keyword arguments:\n
+    path -- Path of the csv file, e.g. 'weather_data/Texas/texas_weather_new.csv'
+    '''
+    df = pd.read_csv(path, dtype={'STATION': str}, parse_dates=['DATE'])
+    df = df.rename(columns={'STATION': 'Station', 'DATE': 'Date', **EVENT_CODES})
+    return df.reindex(columns=['Station', 'Date'] + DAILY_COLUMNS)
+
+def load_station_map(path):
+    '''
+    Reads a station to county mapping csv with 'Station' and 'FIPS' columns and an optional
+    'Weight' column (e.g. the share of the county a station covers). A station may appear
+    under several counties. Missing weights count as 1
+    '''
+    df = pd.read_csv(path, dtype={'Station': str, 'FIPS': str})
+    df['FIPS'] = df['FIPS'].str.zfill(5)
+    df['Weight'] = pd.to_numeric(df['Weight'], errors='coerce').fillna(1) if 'Weight' in df else 1.0
+    return df[['Station', 'FIPS', 'Weight']]
+
+def aggregate_daily(df, groups, weights=None):
+    '''
+    Averages station records into one row per (group, day) with a single grouped sum over every
+    column. Missing values are left out of each mean, days between a group's first and last
+    record without any report become empty rows and event flags of days without a report
+    become 0, as the per-state resample('D').mean() of data_cleaning.ipynb did
+
+    Keyword arguments:\n
+    df -- A DataFrame returned by read_station_records\n
+    groups -- Array-like of the group (location code) of each record
+
+    Optional arguments:\n
+    weights -- Array-like of the weight of each record. Defaults to None (plain mean)
+
+    Return: DataFrame with 'Location' and 'Date' columns followed by DAILY_COLUMNS
+    '''
+    if len(df) == 0:
+        return pd.DataFrame(columns=['Location', 'Date'] + DAILY_COLUMNS)
+    codes, labels = pd.factorize(np.asarray(groups), sort=True)
+    days = to_days(df['Date'])
+    first_day = int(days.min())
+    span = int(days.max()) - first_day + 1
+
+    # One key per (group, day), so the grouped sums are a single bincount per column
+    keys, inverse = np.unique(codes.astype(np.int64) * span + (days - first_day), return_inverse=True)
+    values = df[DAILY_COLUMNS].to_numpy(np.float64)
+    reported = ~np.isnan(values)
+    w = np.ones(len(df)) if weights is None else np.asarray(weights, dtype=np.float64)
+    weighted = np.where(reported, values, 0) * w[:, np.newaxis]
+    sums = np.stack([np.bincount(inverse, weights=weighted[:, i], minlength=len(keys)) for i in range(len(DAILY_COLUMNS))], axis=1)
+    totals = np.stack([np.bincount(inverse, weights=reported[:, i] * w, minlength=len(keys)) for i in range(len(DAILY_COLUMNS))], axis=1)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        means = np.where(totals > 0, sums / totals, np.nan)
+
+    # Expand every group to a contiguous range of days from its first to its last record
+    key_groups, key_days = keys // span, keys % span
+    starts = np.flatnonzero(np.r_[True, key_groups[1:] != key_groups[:-1]])
+    ends = np.r_[starts[1:], len(keys)] - 1
+    lengths = key_days[ends] - key_days[starts] + 1
+    offsets = np.cumsum(lengths) - lengths
+    row_group = np.repeat(key_groups[starts], lengths)
+    row_day = np.repeat(key_days[starts] - offsets, lengths) + np.arange(lengths.sum())
+    rows = np.repeat(offsets - key_days[starts], np.diff(np.r_[starts, len(keys)])) + key_days
+
+    out = np.full((len(row_day), len(DAILY_COLUMNS)), np.nan)
+    out[rows] = means
+    events = len(MEASUREMENTS)
+    out[:, events:] = np.nan_to_num(out[:, events:], nan=0.0)
+
+    result = pd.DataFrame(out, columns=DAILY_COLUMNS)
+    result.insert(0, 'Date', EPOCH + (row_day + first_day).astype('timedelta64[D]'))
+    result.insert(0, 'Location', labels[row_group])
+    return result
+
+def aggregate_state(folder, stations=None, clean=False):
+    '''
+    Aggregates the station records of a weather_data state folder into daily state-wide features
+    and, when a station map is given, station weighted county features
+
+    Keyword arguments:\n
+    folder -- Path of the state folder, e.g. 'weather_data/New_Jersey'
+
+    Optional arguments:\n
+    stations -- DataFrame returned by load_station_map. Defaults to None (state rows only)\n
+    clean -- Whether to also write the state rows next to the source as *_weather_new_clean.csv. Defaults to False
+
+    Return: (state name, DataFrame returned by aggregate_daily), or (state name, None) if the
+    folder has no station records or the state is unknown
+    '''
+    folder = Path(folder)
+    state = folder.name.replace('_', ' ')
+    paths = sorted(folder.glob(STATION_PATTERN))
+    code = fips.resolve('', state)
+    if not paths or code is None:
+        return state, None
+
+    df = pd.concat([read_station_records(path) for path in paths], ignore_index=True)
+    daily = aggregate_daily(df, np.full(len(df), code))
+    if clean:
+        daily.drop(columns=['Location']).to_csv(paths[0].with_name(f'{paths[0].stem}_clean.csv'), index=False)
+
+    if stations is not None:
+        mapped = df.merge(stations, on='Station', how='inner')
+        # Only counties of this state, in case a map lists stations across a border
+        mapped = mapped[mapped['FIPS'].str.startswith(code)]
+        daily = pd.concat([daily, aggregate_daily(mapped, mapped['FIPS'].to_numpy(), mapped['Weight'].to_numpy())],
+                          ignore_index=True)
+    return state, daily
+
+def aggregate_weather(src=WEATHER_DATA_PATH, stations=None, clean=False, max_workers=None):
+    '''
+    Aggregates every state folder under src across a process pool. Results are yielded as each
+    state finishes, so only the states being consumed are held in memory
+
+    Optional arguments:\n
+    src -- Folder holding one folder of weather csv files per state. Defaults to 'weather_data'\n
+    stations -- DataFrame returned by load_station_map. Defaults to None (state rows only)\n
+    clean -- Whether to write each state's *_weather_new_clean.csv. Defaults to False\n
+    max_workers -- Number of processes. Defaults to every core
+
+    Return: A generator of (state name, DataFrame or None) in completion order
+    '''
+    folders = [folder for folder in sorted(Path(src).iterdir()) if folder.is_dir()]
+    with ProcessPoolExecutor(max_workers=max_workers) as pool:
+        pending = {pool.submit(aggregate_state, folder, stations, clean) for folder in folders}
+        for future in as_completed(pending):
+            # Drop our reference so a consumed state's result can be freed
+            pending.discard(future)
+            yield future.result()
@@ -0,0 +1,123 @@
+import datetime as dt
+import pandas as pd
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError as e:
+    # Only the offline conversion needs pyarrow, so it is not a dependency of the app
+    raise ImportError('The Parquet weather store needs pyarrow, install it with pip install pyarrow') from e
+from pathlib import Path
+
+STORE_PATH = 'weather_store'
+WEATHER_DATA_PATH = 'weather_data'
+
+# Station level records as downloaded from NOAA, and the state-wide daily means derived from them
+KINDS = {
+    'station': '*_weather_new.csv',
+    'daily': '*_weather_new_clean.csv',
+}
+
+def state_folder(state):
+    '''
+    Returns the folder name used for a state, e.g. 'New Jersey' -> 'New_Jersey'
+    '''
+    return state.replace(' ', '_')
+
+def read_weather_csv(path, kind):
+    '''
+    Reads one of the weather csv files into a DataFrame with a datetime 'Date' column
+
+    Keyword arguments:\n
+    path -- Path of the csv file\n
+    kind -- Either 'station' or 'daily'
+    '''
+    df = pd.read_csv(path)
+    if kind == 'station':
+        df = df.rename(columns={'STATION': 'Station', 'DATE': 'Date'})
+    df['Date'] = pd.to_datetime(df['Date'])
+    return df.sort_values(['Date'], kind='stable').reset_index(drop=True)
+
+def write_partitions(df, dest, state, kind):
+    '''
+    Writes a state's records as one zstd compressed Parquet file per year with one row group
+    per month, so date filters only read the months they need
+
+    Keyword arguments:\n
+    df -- A DataFrame sorted by 'Date'\n
+    dest -- Root folder of the store\n
+    state -- The state name\n
+    kind -- Either 'station' or 'daily'
+    '''
+    df = df.assign(State=state)
+    folder = Path(dest) / kind / state_folder(state)
+    folder.mkdir(parents=True, exist_ok=True)
+    schema = pa.Schema.from_pandas(df, preserve_index=False)
+    for year, year_df in df.groupby(df['Date'].dt.year):
+        with pq.ParquetWriter(folder / f'{year}.parquet', schema, compression='zstd') as writer:
+            for _, month_df in year_df.groupby(year_df['Date'].dt.month):
+                writer.write_table(pa.Table.from_pandas(month_df, schema=schema, preserve_index=False))
+
+def convert_state(folder, dest=STORE_PATH):
+    '''
+    Converts the csv files of a single state folder under weather_data into the columnar store
+
+    Keyword arguments:\n
+    folder -- Path of the state folder, e.g. 'weather_data/New_Jersey'
+
+    Optional arguments:\n
+    dest -- Root folder of the store. Defaults to 'weather_store'
+    '''
+    folder = Path(folder)
+    state = folder.name.replace('_', ' ')
+    for kind, pattern in KINDS.items():
+        for path in folder.glob(pattern):
+            write_partitions(read_weather_csv(path, kind), dest, state, kind)
+    return state
+
+def convert_weather(src=WEATHER_DATA_PATH, dest=STORE_PATH):
+    '''
+    Converts every state folder under src into the columnar store
+
+    Optional arguments:\n
+    src -- Folder holding one sub folder of csv files per state. Defaults to 'weather_data'\n
+    dest -- Root folder of the store. Defaults to 'weather_store'
+    '''
+    return [convert_state(folder, dest) for folder in sorted(Path(src).iterdir()) if folder.is_dir()]
+
+def load_weather(state, start_date=None, end_date=None, columns=None, kind='daily', root=STORE_PATH):
+    '''
+    Loads weather records for a state from the columnar store. Only the year files overlapping
+    the date range are opened, only the requested columns are read, and row groups outside the
+    date range are skipped using their statistics
+
+    Keyword arguments:\n
+    state -- The state name
+
+    Optional arguments:\n
+    start_date -- First date to include, as a str 'YYYY-MM-DD' or date. Defaults to None (unbounded)\n
+    end_date -- Last date to include, as a str 'YYYY-MM-DD' or date. Defaults to None (unbounded)\n
+    columns -- A list of columns to read. Defaults to None (all columns)\n
+    kind -- Either 'station' or 'daily'. Defaults to 'daily'\n
+    root -- Root folder of the store. Defaults to 'weather_store'
+    '''
+    start = None if start_date is None else pd.Timestamp(start_date)
+    end = None if end_date is None else pd.Timestamp(end_date)
+    if columns is not None and 'Date' not in columns:
+        columns = ['Date'] + list(columns)
+
+    filters = []
+    if start is not None:
+        filters.append(('Date', '>=', start))
+    if end is not None:
+        filters.append(('Date', '<=', end))
+
+    tables = []
+    for path in sorted((Path(root) / kind / state_folder(state)).glob('*.parquet')):
+        year = int(path.stem)
+        if (start is not None and year < start.year) or (end is not None and year > end.year):
+            continue
+        tables.append(pq.read_table(path, columns=columns, filters=filters or None))
+
+    if not tables:
+        return pd.DataFrame(columns=columns or [])
+    return pa.concat_tables(tables).to_pandas()
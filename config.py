@@ -3,6 +3,35 @@ import os
 class Config(object):
     DEBUG = False
     SQLALCHEMY_TRACK_MODIFICATIONS = False
+    # Batch prediction API limits
+    BATCH_MAX_RECORDS = int(os.environ.get('BATCH_MAX_RECORDS', 5000))
+    BATCH_WEATHER_WORKERS = int(os.environ.get('BATCH_WEATHER_WORKERS', 16))
+    # Weather API response cache. Set WEATHER_CACHE_PATH to persist it in a SQLite file
+    WEATHER_CACHE_TTL = int(os.environ.get('WEATHER_CACHE_TTL', 900))
+    WEATHER_CACHE_SIZE = int(os.environ.get('WEATHER_CACHE_SIZE', 512))
+    WEATHER_CACHE_PATH = os.environ.get('WEATHER_CACHE_PATH')
+    # Number of historical records shown per search results page
+    SEARCH_PAGE_SIZE = int(os.environ.get('SEARCH_PAGE_SIZE', 100))
+    # Seconds between polls of the ODIN real-time outage feed
+    ODIN_POLL_INTERVAL = int(os.environ.get('ODIN_POLL_INTERVAL', 300))
+    # Folder of precomputed daily weather features, checked before calling the weather API
+    FEATURE_STORE_PATH = os.environ.get('FEATURE_STORE_PATH', 'feature_store')
+    # Seconds between weather forecast refreshes. 7 day outage-risk timelines are cached until the next one
+    FORECAST_REFRESH = int(os.environ.get('FORECAST_REFRESH', 3600))
+    # County risk scores written by helper_scripts/score_risk_map.py
+    RISK_MAP_PATH = os.environ.get('RISK_MAP_PATH', 'risk_map.json')
+    # Set to 'compiled' to score small batches with trees exported from the booster instead of XGBoost
+    MODEL_ENGINE = os.environ.get('MODEL_ENGINE', 'xgboost')
+    # Consecutive upstream failures (weather API, ODIN, GeoJSON) that open a circuit, and seconds it stays open
+    UPSTREAM_FAILURE_THRESHOLD = int(os.environ.get('UPSTREAM_FAILURE_THRESHOLD', 5))
+    UPSTREAM_RESET_TIMEOUT = int(os.environ.get('UPSTREAM_RESET_TIMEOUT', 30))
+    # Load the model, outage records, FIPS table, GeoJSON and feature store index when the app is created.
+    # With gunicorn's preload_app (gunicorn.conf.py) this happens once in the master, before workers fork
+    WARM_UP = os.environ.get('WARM_UP', 'true').lower() == 'true'
+    # Folder where worker processes share metrics snapshots, so /metrics reports the whole server.
+    # gunicorn.conf.py sets a new one per server start, unset means each process reports its own
+    METRICS_DIR = os.environ.get('METRICS_DIR')
+    METRICS_INTERVAL = int(os.environ.get('METRICS_INTERVAL', 5))
 
 # For use on Heroku
 class ProductionConfig(Config):
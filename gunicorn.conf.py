@@ -0,0 +1,53 @@
+# Multi-worker serving. The app is imported once in the master (preload_app), where create_app
+# warms the model, outage records, FIPS table, GeoJSON and feature store index, and every worker
+# forked from it shares those objects copy-on-write instead of loading its own copy.
+# Size the pool with WEB_CONCURRENCY and check a worker is warm with GET /ready
+from gevent import monkey
+# Patch before the app is imported, so locks created at import time are greenlet-safe in the workers
+monkey.patch_all()
+
+import gc
+import os
+import sys
+import tempfile
+import subprocess
+import multiprocessing
+
+bind = f"0.0.0.0:{os.environ.get('PORT', '8000')}"
+worker_class = 'geventwebsocket.gunicorn.workers.GeventWebSocketWorker'
+workers = int(os.environ.get('WEB_CONCURRENCY', multiprocessing.cpu_count()))
+preload_app = True
+
+# Workers share metrics through snapshot files so /metrics reports the whole server whichever
+# worker answers the scrape. Set before the app is loaded, with a new folder per server start
+# unless METRICS_DIR is already set
+if 'METRICS_DIR' not in os.environ:
+    os.environ['METRICS_DIR'] = tempfile.mkdtemp(prefix='dashboard-metrics-')
+
+# Collection writes to the header of every object it visits, which would copy the shared pages
+# into each worker. It stays off while the master loads the app, everything loaded is frozen
+# before forking, and each worker turns it back on for its own objects
+gc.disable()
+
+def pre_fork(server, worker):
+    gc.freeze()
+
+def post_fork(server, worker):
+    gc.enable()
+
+# With RISK_MAP_INTERVAL set, the county risk map is rescored every RISK_MAP_INTERVAL seconds by
+# a child process of the master. Dynos do not share a filesystem, so the job runs next to the
+# workers that read RISK_MAP_PATH instead of in a dyno of its own. Each run fetches weather for
+# every county the feature store misses, so it is off by default and should only be set on the
+# dyno that serves the map
+risk_map_interval = int(os.environ.get('RISK_MAP_INTERVAL', '0'))
+risk_map_job = None
+
+def when_ready(server):
+    global risk_map_job
+    if risk_map_interval > 0:
+        risk_map_job = subprocess.Popen([sys.executable, '-m', 'helper_scripts.score_risk_map', '--loop', str(risk_map_interval)])
+
+def on_exit(server):
+    if risk_map_job is not None:
+        risk_map_job.terminate()
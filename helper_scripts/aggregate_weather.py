@@ -0,0 +1,27 @@
+import time
+import argparse
+from app.methods.feature_store import FeatureStore
+from app.methods.weather_pipeline import aggregate_weather, load_station_map, WEATHER_DATA_PATH
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(prog='python -m helper_scripts.aggregate_weather', description='Aggregate station weather records into daily state (and county) features')
+    parser.add_argument('-p', '--path', type=str, default=WEATHER_DATA_PATH, help='folder holding one folder of weather csv files per state')
+    parser.add_argument('-s', '--stations', type=str, default=None, help='station to county mapping csv with Station, FIPS and optional Weight columns')
+    parser.add_argument('-d', '--dest', type=str, default=None, help='feature store root to append the daily features to')
+    parser.add_argument('-c', '--clean', action='store_true', help='write each state\'s *_weather_new_clean.csv')
+    parser.add_argument('-j', '--jobs', type=int, default=None, help='number of processes. Defaults to every core')
+    args = parser.parse_args()
+
+    start = time.perf_counter()
+    stations = load_station_map(args.stations) if args.stations else None
+    store = FeatureStore(args.dest) if args.dest else None
+    rows = written = 0
+    for state, daily in aggregate_weather(args.path, stations, args.clean, args.jobs):
+        if daily is None:
+            print(f'Skipped {state}')
+            continue
+        rows += len(daily)
+        if store is not None:
+            written += store.append(daily)
+    print(f'Aggregated {rows} daily rows in {time.perf_counter() - start:.1f}s' +
+          (f', appended {written} to {args.dest}' if store is not None else ''))
@@ -0,0 +1,44 @@
+import argparse
+import time
+import numpy as np
+import pandas as pd
+from joblib import load
+from app.methods.model import FEATURES
+from app.methods.tree_engine import TreeEnsemble
+
+def best_time(fn, repeat):
+    '''Returns the fastest of repeat calls to fn in seconds'''
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        times.append(time.perf_counter() - start)
+    return min(times)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(prog='python -m helper_scripts.benchmark_tree_engine', description='Check the exported tree engine against XGBoost and compare their latency')
+    parser.add_argument('-m', '--model', type=str, default='reg_model.joblib', help='path to the joblib model file')
+    parser.add_argument('-n', '--rows', type=int, default=10000, help='number of random rows to check')
+    parser.add_argument('-r', '--repeat', type=int, default=50, help='timing repetitions per batch size')
+    args = parser.parse_args()
+
+    model = load(args.model)
+    start = time.perf_counter()
+    engine = TreeEnsemble.from_booster(model.get_booster())
+    print(f'Exported {len(engine.roots)} trees ({len(engine.feature)} nodes, depth {engine.depth}) in {(time.perf_counter() - start) * 1000:.1f}ms')
+
+    # Random standardized rows with some missing values
+    rng = np.random.default_rng(0)
+    X = rng.normal(scale=2, size=(args.rows, len(FEATURES))).astype(np.float32)
+    X[rng.random(X.shape) < 0.05] = np.nan
+    expected = model.predict(pd.DataFrame(X, columns=FEATURES))
+    actual = engine.predict(X)
+    print(f'Max abs difference {np.abs(actual - expected).max():.6g}, exact matches {np.mean(actual == expected):.2%}')
+
+    print(f'{"rows":>8} {"xgboost us":>12} {"engine us":>12}')
+    for n in [1, 10, 100, 1000, args.rows]:
+        df = pd.DataFrame(X[:n], columns=FEATURES)
+        repeat = args.repeat if n <= 1000 else max(args.repeat // 10, 1)
+        xgb_time = best_time(lambda: model.predict(df), repeat)
+        engine_time = best_time((lambda: engine.predict_one(X[0])) if n == 1 else (lambda: engine.predict(X[:n])), repeat)
+        print(f'{n:>8} {xgb_time * 1e6:>12.1f} {engine_time * 1e6:>12.1f}')
@@ -0,0 +1,15 @@
+import argparse
+from app.methods.feature_store import FeatureStore, FEATURE_STORE_PATH, materialize_weather_data, materialize_noaa
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(prog='python -m helper_scripts.build_feature_store', description='Materialize daily model features into the feature store, appending only new days')
+    parser.add_argument('-p', '--path', type=str, default='weather_data', help='folder holding one folder of weather csv files per state')
+    parser.add_argument('-n', '--noaa', type=str, default=None, help='NOAA result store to append county records from')
+    parser.add_argument('-d', '--dest', type=str, default=FEATURE_STORE_PATH, help='root folder of the feature store')
+    args = parser.parse_args()
+
+    store = FeatureStore(args.dest)
+    written = materialize_weather_data(store, args.path)
+    if args.noaa:
+        written += materialize_noaa(store, args.noaa)
+    print(f'Appended {written} rows to {args.dest} ({len(store)} total)')
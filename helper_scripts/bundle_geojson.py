@@ -0,0 +1,11 @@
+import argparse
+from app.methods.outage_map import bundle_geojson, GEOJSON_PATH
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(prog='python -m helper_scripts.bundle_geojson', description='Download and quantize the county GeoJSON used by the outage maps')
+    parser.add_argument('-d', '--dest', type=str, default=GEOJSON_PATH, help='where to save the GeoJSON file')
+    parser.add_argument('-p', '--precision', type=int, default=3, help='number of coordinate decimals to keep')
+    args = parser.parse_args()
+
+    counties = bundle_geojson(args.dest, args.precision)
+    print(f"Saved {len(counties['features'])} counties to {args.dest}")
@@ -0,0 +1,86 @@
+from pathlib import Path
+import pandas as pd
+import argparse
+import time
+from helper_scripts.clean_hist_data import read_data, split_area
+
+def split_area_reference(df):
+    '''Row-wise implementation of split_area kept as the reference for the vectorized version'''
+    df_states_only = df[~df['Area'].str.contains('County|Parish', na=False)]
+    df_county_only = df[df['Area'].str.contains('County|Parish', na=False)]
+
+    # Splits records into the form of a list that looks like ["State: County", "State: County", ...]
+    states_split = df_states_only['Area'].str.split(r': |, ',regex=True)
+    counties_split = df_county_only['Area'].str.split(r'; |: ', regex=True) # Special case for mulitiple states in a single row
+
+    # Split function to handle edge cases
+    def custom_split(x):
+        def f(x, i_max):
+            return [x[i] + ': ' + y for i in range(0, i_max, 2) for y in x[i+1].split(', ')]
+
+        def g(x):
+            lst = f(x, len(x)-1)
+            lst.append(x[-1])
+            return lst
+
+        if len(x)%2 == 0:
+            if ',' not in x[0]:
+                return f(x, len(x))
+            else:
+                temp = x[0].split(', ')
+                temp.append(x[1])
+                first = temp.pop(0)
+                temp.append(first)
+                return g(temp)
+        else: 
+            return g(x)
+
+    counties_split = counties_split.apply(custom_split)
+    df['Area'] = pd.concat([states_split, counties_split])
+
+    # Expands each element of the list into its own row
+    df = df.explode('Area', ignore_index=True)
+
+    # Cleans string
+    def custom_clean(x):
+        if x[-1] in [';', ':']:
+            x = x[:-1]
+        if x[-1] == ']':
+            x = x[:x.index('[')]
+        return x
+    df['Area'] = df['Area'].apply(custom_clean)
+
+    # Splits Area column further into State and County columns
+    df[['State', 'County']] = df['Area'].str.split(pat=': ', expand=True)
+    df.drop('Area', axis=1, inplace=True)
+    df = df[['Start Date', 'Start Time', 'End Date', 'End Time', 'County', 'State', 'Number of Customers Affected']]
+    # Remove 'County' string from entries
+    df['County'] = df.County.astype(str)
+    df['County'] = df['County'].map(lambda x: x.removesuffix(' County'))
+    return df
+
+def compare(path: Path, csv_flag=False):
+    '''Runs both implementations on an annual summary file and raises an AssertionError if they differ'''
+    df = read_data(path, csv_flag)
+
+    start = time.perf_counter()
+    expected = split_area_reference(df.copy())
+    reference_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    actual = split_area(df.copy())
+    vectorized_time = time.perf_counter() - start
+
+    pd.testing.assert_frame_equal(actual.reset_index(drop=True), expected.reset_index(drop=True))
+    return len(expected), reference_time, vectorized_time
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(prog='python -m helper_scripts.check_split_area', description='Check the vectorized split_area against the row-wise reference on OE417 annual summaries')
+    parser.add_argument('-p', '--path', type=str, required=True, help='folder where unclean files are located')
+    parser.add_argument('-c','--csv', dest='csv', action='store_true', default=False, help='flag to read csv files instead of excel')
+    args = parser.parse_args()
+
+    path_list = Path(args.path).glob('*.xls') if not args.csv else Path(args.path).glob('*.csv')
+    for path in sorted(path_list):
+        rows, reference_time, vectorized_time = compare(path, args.csv)
+        print(f'{path.name}: {rows} rows match (reference {reference_time*1000:.1f} ms, vectorized {vectorized_time*1000:.1f} ms)')
@@ -1,63 +1,81 @@
 from pathlib import Path
+from concurrent.futures import ProcessPoolExecutor
+from itertools import chain
+import numpy as np
 import pandas as pd
 import argparse
+import hashlib
+import json
+import re
+
+MANIFEST_NAME = '.clean_manifest.json'
+
+COUNTY_PATTERN = re.compile(r'County|Parish')
+STATE_SEPARATOR = re.compile(r': |, ')
+COUNTY_SEPARATOR = re.compile(r'; |: ')
+
+def tokenize_area(area):
+    '''
+    Parses a single Area string into a list of (State, County) tuples. Area strings look like
+    "State: County, County; State: County" for county level records and "State, State:" otherwise.
+    County is 'None' for state level entries
+    '''
+    if COUNTY_PATTERN.search(area) is None:
+        entries = STATE_SEPARATOR.split(area)
+    else:
+        # Tokens alternate [State, Counties, State, Counties, ...]
+        tokens = COUNTY_SEPARATOR.split(area)
+        trailing = len(tokens) % 2 == 1
+        if not trailing and ',' in tokens[0]:
+            # Several states before the counties ("Virginia, North Carolina: Currituck County") are
+            # reordered as [North Carolina, Currituck County, Virginia]
+            states = tokens[0].split(', ')
+            tokens = states[1:] + [tokens[1], states[0]]
+            trailing = True
+        entries = [tokens[i-1] + ': ' + county for i in range(1, len(tokens), 2) for county in tokens[i].split(', ')]
+        # A token left without a pair is kept as its own entry
+        if trailing:
+            entries.append(tokens[-1])
+
+    pairs = []
+    for entry in entries:
+        # Cleans string
+        if entry[-1] in [';', ':']:
+            entry = entry[:-1]
+        if entry[-1] == ']':
+            entry = entry[:entry.index('[')]
+        state, _, county = entry.partition(': ')
+        county = county.removesuffix(' County') if _ else 'None'
+        pairs.append((state, county))
+    return pairs
 
 def split_area(df):
-    df_states_only = df[~df['Area'].str.contains('County|Parish', na=False)]
-    df_county_only = df[df['Area'].str.contains('County|Parish', na=False)]
-
-    # Splits records into the form of a list that looks like ["State: County", "State: County", ...]
-    states_split = df_states_only['Area'].str.split(r': |, ',regex=True)
-    counties_split = df_county_only['Area'].str.split(r'; |: ', regex=True) # Special case for mulitiple states in a single row
-
-    # Split function to handle edge cases
-    def custom_split(x):
-        def f(x, i_max):
-            return [x[i] + ': ' + y for i in range(0, i_max, 2) for y in x[i+1].split(', ')]
-
-        def g(x):
-            lst = f(x, len(x)-1)
-            lst.append(x[-1])
-            return lst
-
-        if len(x)%2 == 0:
-            if ',' not in x[0]:
-                return f(x, len(x))
-            else:
-                temp = x[0].split(', ')
-                temp.append(x[1])
-                first = temp.pop(0)
-                temp.append(first)
-                return g(temp)
-        else: 
-            return g(x)
-
-    counties_split = counties_split.apply(custom_split)
-    df['Area'] = pd.concat([states_split, counties_split])
-
-    # Expands each element of the list into its own row
-    df = df.explode('Area', ignore_index=True)
-
-    # Cleans string
-    def custom_clean(x):
-        if x[-1] in [';', ':']:
-            x = x[:-1]
-        if x[-1] == ']':
-            x = x[:x.index('[')]
-        return x
-    df['Area'] = df['Area'].apply(custom_clean)
-
-    # Splits Area column further into State and County columns
-    df[['State', 'County']] = df['Area'].str.split(pat=': ', expand=True)
-    df.drop('Area', axis=1, inplace=True)
+    '''
+    Splits the Area column of OE-417 records into one row per affected State/County. Each distinct
+    Area string is tokenized once and the records are expanded with a single take. Records
+    without an Area cannot be placed and are dropped
+    '''
+    # factorize codes a missing Area as -1, which would take the entries of the last Area
+    df = df[df['Area'].notna() & (df['Area'].astype(str).str.strip() != '')]
+    codes, areas = pd.factorize(df['Area'])
+    parsed = [tokenize_area(area) for area in areas]
+    flat = np.array(list(chain.from_iterable(parsed)), dtype=object).reshape(-1, 2)
+
+    # Position of each output entry in flat: the first entry of its Area plus its offset within that Area
+    sizes = np.array([len(pairs) for pairs in parsed], dtype=np.intp)
+    starts = np.concatenate([[0], np.cumsum(sizes)[:-1]]).astype(np.intp)
+    counts = sizes[codes]
+    row_starts = np.cumsum(counts) - counts
+    take = np.repeat(starts[codes] - row_starts, counts) + np.arange(counts.sum())
+
+    df = df.iloc[np.repeat(np.arange(len(df)), counts)].reset_index(drop=True)
+    df['State'] = flat[take, 0]
+    df['County'] = flat[take, 1]
     df = df[['Start Date', 'Start Time', 'End Date', 'End Time', 'County', 'State', 'Number of Customers Affected']]
-    # Remove 'County' string from entries
-    df['County'] = df.County.astype(str)
-    df['County'] = df['County'].map(lambda x: x.removesuffix(' County'))
     return df
 
-def clean_data(source_path: Path, dest_path='hist_data/', csv_flag=False):
-    '''Cleans annual summary files to save relevant data'''
+def read_data(source_path: Path, csv_flag=False):
+    '''Reads an annual summary file and keeps the relevant weather related records'''
     if csv_flag:
         df = pd.read_csv(source_path, header=1, skip_blank_lines=True)
     else:
@@ -82,6 +100,11 @@ def clean_data(source_path: Path, dest_path='hist_data/', csv_flag=False):
     # Rename cols for clarity
     df = df.rename(columns={"Date Event Began": "Start Date", "Time Event Began": "Start Time", 
         "Date of Restoration": "End Date", "Time of Restoration": "End Time", "Area Affected": "Area"})
+    return df
+
+def clean_data(source_path: Path, dest_path='hist_data/', csv_flag=False):
+    '''Cleans annual summary files to save relevant data'''
+    df = read_data(source_path, csv_flag)
 
     # Create dest filepath if it doesn't exist and save to csv
     filename = source_path.name[:-4]
@@ -92,12 +115,99 @@ def clean_data(source_path: Path, dest_path='hist_data/', csv_flag=False):
     filepath.parent.mkdir(parents=True, exist_ok=True)
     df.to_csv(filepath, index=False)
 
+    # Years of the cleaned records, used to upsert them into a merged file
+    years = sorted({str(date)[:4] for date in df['Start Date'].dropna()})
+    return str(filepath), years
+
+def file_hash(path):
+    '''Returns the sha256 hex digest of a file's contents'''
+    sha = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 16), b''):
+            sha.update(block)
+    return sha.hexdigest()
+
+def load_manifest(dest_path):
+    '''
+    Loads the manifest of previously cleaned input files. Returns an empty manifest if there is
+    none or if this script has changed since it was written, which forces a full rebuild
+    '''
+    path = Path(dest_path + MANIFEST_NAME)
+    cleaner = file_hash(__file__)
+    if path.exists():
+        with open(path) as f:
+            manifest = json.load(f)
+        if manifest.get('cleaner') == cleaner:
+            return manifest
+    return {'cleaner': cleaner, 'files': {}}
+
+def save_manifest(manifest, dest_path):
+    '''Saves the manifest of cleaned input files'''
+    path = Path(dest_path + MANIFEST_NAME)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    with open(path, 'w') as f:
+        json.dump(manifest, f, indent=4)
+
+def changed_files(paths, manifest, merged=False):
+    '''
+    Returns the input paths whose contents differ from the manifest. Without merged output, an
+    unchanged input is also cleaned again if its output file is missing
+    '''
+    changed = []
+    for path in paths:
+        entry = manifest['files'].get(path.name)
+        if entry is None or entry['hash'] != file_hash(path):
+            changed.append(path)
+        elif not merged and not Path(entry['output']).exists():
+            changed.append(path)
+    return changed
+
+def clean_files(paths, dest_path='hist_data/', csv_flag=False, jobs=1):
+    '''
+    Cleans several annual summary files, in parallel processes when jobs > 1.
+    Returns a list of (output path, years) in the same order as paths
+    '''
+    if jobs > 1 and len(paths) > 1:
+        with ProcessPoolExecutor(max_workers=jobs) as pool:
+            return list(pool.map(clean_data, paths, [dest_path]*len(paths), [csv_flag]*len(paths)))
+    return [clean_data(path, dest_path, csv_flag) for path in paths]
+
+def overlapping_files(paths, manifest, years):
+    '''
+    Returns the input paths whose recorded years intersect years. Their records share those
+    years in merged_data.csv, so they must be cleaned again when the years are replaced
+    '''
+    return [path for path in paths if path.name in manifest['files'] and set(manifest['files'][path.name]['years']) & years]
+
+def upsert_merged(outputs, years, dest_path='hist_data/'):
+    '''
+    Replaces the records of the given years in merged_data.csv with the records of the given
+    cleaned files, leaving every other year untouched. outputs must include every file with
+    records in those years, see overlapping_files
+
+    Keyword arguments:\n
+    outputs -- Paths of freshly cleaned csv files\n
+    years -- Years whose records should be replaced, including years a changed file no longer covers
+    '''
+    merged_path = Path(dest_path + 'merged_data.csv')
+    frames = []
+    if merged_path.exists():
+        merged = pd.read_csv(merged_path, dtype=str, keep_default_na=False)
+        frames.append(merged[~merged['Start Date'].str[:4].isin(set(years))])
+    frames.extend(pd.read_csv(path, dtype=str, keep_default_na=False) for path in sorted(outputs))
+
+    df = pd.concat(frames, ignore_index=True)
+    df = df.iloc[df['Start Date'].str[:4].argsort(kind='stable')]
+    df.to_csv(merged_path, index=False)
+
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description='Format excel data files taken from OE417 annual summaries')
     parser.add_argument('-p', '--path', type=str, required=True, help='folder where unclean files are located')
     parser.add_argument('-c','--csv', dest='csv', action='store_true', default=False, help='flag to read csv files instead of excel')
     parser.add_argument('-d','--dest', type=str, default='hist_data/', help='destination to save csv files')
     parser.add_argument('-m','--merge', action='store_true', default=False, help='merge data into a single csv file and delete individual csvs')
+    parser.add_argument('-j','--jobs', type=int, default=1, help='number of files to clean in parallel processes')
+    parser.add_argument('-f','--force', action='store_true', default=False, help='clean every file even if it is unchanged since the last run')
     args = parser.parse_args()
 
     if args.dest[-1] != '/':
@@ -105,15 +215,40 @@ if __name__ == "__main__":
 
     data_source_path = args.path         # path where unclean data is located
     path_list = Path(data_source_path).glob('*.xls') if not args.csv else Path(data_source_path).glob('*.csv')
-    for path in path_list:
-        clean_data(path, args.dest, args.csv)
-
-    if args.merge:
-        data_list = Path(args.dest).glob('*_Annual_Summary.csv')
-        lst = sorted([str(path) for path in data_list])
-        df = pd.concat(map(pd.read_csv, lst), ignore_index=True)
-        df.to_csv(Path(args.dest + 'merged_data.csv'), index=False)
+    path_list = sorted(path_list)
+
+    manifest = load_manifest(args.dest) if not args.force else {'cleaner': file_hash(__file__), 'files': {}}
+    if args.merge and not Path(args.dest + 'merged_data.csv').exists():
+        manifest['files'] = {}
+    changed = changed_files(path_list, manifest, args.merge)
+    print(f'Cleaning {len(changed)} of {len(path_list)} files')
+
+    results = dict(zip(changed, clean_files(changed, args.dest, args.csv, args.jobs)))
+
+    years = set()
+    while True:
+        for path, (_, output_years) in results.items():
+            previous = manifest['files'].get(path.name)
+            if previous is not None:
+                years.update(previous['years'])
+            years.update(output_years)
+        # Unchanged files with records in a replaced year are cleaned again, since their
+        # individual csv files were deleted after the last merge
+        extra = [path for path in overlapping_files(path_list, manifest, years) if path not in results] if args.merge else []
+        if not extra:
+            break
+        print(f'Cleaning {len(extra)} unchanged files that share years with them')
+        results.update(zip(extra, clean_files(extra, args.dest, args.csv, args.jobs)))
+
+    for path, (output, output_years) in results.items():
+        manifest['files'][path.name] = {'hash': file_hash(path), 'output': output, 'years': output_years}
+
+    if args.merge and results:
+        outputs = [output for output, _ in results.values()]
+        upsert_merged(outputs, years, args.dest)
 
         # Delete individual files
-        for path in lst:
-            Path(path).unlink()
\ No newline at end of file
+        for path in outputs:
+            Path(path).unlink()
+
+    save_manifest(manifest, args.dest)
@@ -0,0 +1,11 @@
+import argparse
+from app.methods.weather_store import convert_weather, STORE_PATH, WEATHER_DATA_PATH
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(prog='python -m helper_scripts.convert_weather', description='Convert the weather_data csv files into a Parquet store partitioned by state and year')
+    parser.add_argument('-p', '--path', type=str, default=WEATHER_DATA_PATH, help='folder holding one folder of weather csv files per state')
+    parser.add_argument('-d', '--dest', type=str, default=STORE_PATH, help='root folder of the Parquet store')
+    args = parser.parse_args()
+
+    states = convert_weather(args.path, args.dest)
+    print(f'Converted {len(states)} states into {args.dest}')
@@ -0,0 +1,146 @@
+import os
+import sys
+import time
+import argparse
+import importlib.abc
+import importlib.util
+
+def rss():
+    '''
+    Returns the resident memory of this process in bytes. Falls back to the peak resident memory
+    where /proc is not available
+    '''
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError):
+        import resource
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return peak if sys.platform == 'darwin' else peak * 1024
+
+class ImportProfiler(importlib.abc.MetaPathFinder):
+    def __init__(self):
+        '''
+        Records the time and memory every module takes to import, both including the modules it
+        imports (cumulative) and on its own (self). Installed first on sys.meta_path, it finds
+        modules through the other finders and times their loader's exec_module
+        '''
+        self.records = {}   # module name -> [cumulative seconds, self seconds, cumulative bytes, self bytes]
+        self._stack = []
+
+    def find_spec(self, fullname, path, target=None):
+        for finder in sys.meta_path:
+            if finder is self or not hasattr(finder, 'find_spec'):
+                continue
+            spec = finder.find_spec(fullname, path, target)
+            if spec is not None:
+                if spec.loader is not None and hasattr(spec.loader, 'exec_module'):
+                    spec.loader = _TimedLoader(spec.loader, fullname, self)
+                return spec
+        return None
+
+    def run(self, name, exec_module, module):
+        '''
+        Executes a module, attributing its time and memory to it and taking them off its importer's
+        own share
+        '''
+        self._stack.append([0.0, 0])
+        start, memory = time.perf_counter(), rss()
+        try:
+            exec_module(module)
+        finally:
+            seconds, grown = time.perf_counter() - start, rss() - memory
+            children = self._stack.pop()
+            self.records[name] = [seconds, seconds - children[0], grown, grown - children[1]]
+            if self._stack:
+                self._stack[-1][0] += seconds
+                self._stack[-1][1] += grown
+
+    def install(self):
+        sys.meta_path.insert(0, self)
+
+    def uninstall(self):
+        sys.meta_path.remove(self)
+
+class _TimedLoader(importlib.abc.Loader):
+    '''Private loader wrapping another module loader so ImportProfiler can time it'''
+    def __init__(self, loader, name, profiler):
+        self.loader, self.name, self.profiler = loader, name, profiler
+
+    def create_module(self, spec):
+        return self.loader.create_module(spec)
+
+    def exec_module(self, module):
+        # Leave the real loader on the module, e.g. for importlib.resources
+        module.__loader__ = self.loader
+        if module.__spec__ is not None:
+            module.__spec__.loader = self.loader
+        self.profiler.run(self.name, self.loader.exec_module, module)
+
+    def __getattr__(self, name):
+        return getattr(self.loader, name)
+
+def top_level(name):
+    '''Returns the distribution a module belongs to, e.g. 'pandas' for 'pandas.core.frame' '''
+    return name if name.startswith('app.') else name.partition('.')[0]
+
+def print_table(title, rows, headers):
+    print(f'\n{title}')
+    widths = [max(len(str(row[i])) for row in rows + [headers]) for i in range(len(headers))]
+    print('  '.join(header.rjust(width) if i else header.ljust(width) for i, (header, width) in enumerate(zip(headers, widths))))
+    for row in rows:
+        print('  '.join(str(cell).rjust(width) if i else str(cell).ljust(width) for i, (cell, width) in enumerate(zip(row, widths))))
+
+def mb(size):
+    return f'{size / 2 ** 20:.1f}'
+
+def ms(seconds):
+    return f'{seconds * 1000:.0f}'
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(prog='python -m helper_scripts.profile_startup', description='Report the import time and memory of every module the app loads at startup, then of each warm-up asset')
+    parser.add_argument('-c', '--config', type=str, default='config.DevelopmentConfig', help='config object passed to create_app')
+    parser.add_argument('-n', '--top', type=int, default=20, help='number of modules to list')
+    parser.add_argument('--no-warm-up', action='store_true', help='only profile creating the app')
+    args = parser.parse_args()
+
+    # The app warms up separately below, so each asset is measured on its own
+    os.environ['WARM_UP'] = 'false'
+    profiler = ImportProfiler()
+    profiler.install()
+    start, memory = time.perf_counter(), rss()
+    from app import create_app
+    app = create_app(args.config)
+    startup_seconds, startup_bytes = time.perf_counter() - start, rss() - memory
+
+    records = profiler.records
+    packages = {}
+    for name, (_, own_seconds, _, own_bytes) in records.items():
+        total = packages.setdefault(top_level(name), [0.0, 0, 0])
+        total[0] += own_seconds
+        total[1] += own_bytes
+        total[2] += 1
+    print_table(f'Packages imported by create_app ({len(records)} modules)',
+                [[name, count, ms(seconds), mb(size)] for name, (seconds, size, count) in
+                 sorted(packages.items(), key=lambda item: -item[1][0])[:args.top]],
+                ['package', 'modules', 'self ms', 'self MB'])
+    print_table('Slowest modules',
+                [[name, ms(cumulative), ms(own), mb(size)] for name, (cumulative, own, size, _) in
+                 sorted(records.items(), key=lambda item: -item[1][1])[:args.top]],
+                ['module', 'cumulative ms', 'self ms', 'cumulative MB'])
+    print(f'\ncreate_app: {startup_seconds:.2f}s, +{mb(startup_bytes)} MB resident')
+
+    if not args.no_warm_up:
+        from app.methods import warmup
+        rows = []
+        for name, load in warmup.ASSETS.items():
+            imported, start, memory = len(records), time.perf_counter(), rss()
+            try:
+                load()
+                result = 'ok'
+            except Exception as e:
+                result = type(e).__name__
+            rows.append([name, ms(time.perf_counter() - start), mb(rss() - memory), len(records) - imported, result])
+        print_table('Warm-up assets', rows, ['asset', 'ms', 'MB', 'modules imported', 'result'])
+    profiler.uninstall()
+    print(f'\nTotal resident memory: {mb(rss())} MB')
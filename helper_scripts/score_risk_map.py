@@ -0,0 +1,38 @@
+import argparse
+import traceback
+import time
+import os
+import app.methods.data as weather_data
+from app.methods.fips import load_fips_table
+from app.methods.risk_map import score_counties, save_risk, RISK_MAP_PATH
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(prog='python -m helper_scripts.score_risk_map', description='Score every county against current weather and save the county risk map')
+    parser.add_argument('-d', '--dest', type=str, default=os.environ.get('RISK_MAP_PATH', RISK_MAP_PATH), help='where to save the scores')
+    parser.add_argument('-w', '--workers', type=int, default=16, help='maximum number of concurrent weather requests')
+    parser.add_argument('--hours', type=float, default=24, help='hours since the outage started used for every county')
+    parser.add_argument('-c', '--cache', type=str, default=os.environ.get('WEATHER_CACHE_PATH'), help='SQLite file used to persist weather responses between runs')
+    parser.add_argument('-l', '--loop', type=int, default=None, help='keep running, rescoring every LOOP seconds')
+    args = parser.parse_args()
+
+    # Keep every county's response so a rerun within the cache ttl does not refetch
+    weather_data.configure_cache(maxsize=len(load_fips_table()), path=args.cache)
+
+    while True:
+        start = time.perf_counter()
+        try:
+            df = score_counties(args.hours, args.workers)
+            if df.empty:
+                # Counties whose weather could not be fetched are left out, e.g. all of them while the API is down
+                raise RuntimeError('No county could be scored')
+            save_risk(df, args.dest, args.hours)
+            print(f'Scored {len(df)} counties in {time.perf_counter() - start:.1f}s')
+        except Exception:
+            if args.loop is None:
+                raise
+            # The last saved map keeps being served until a later run succeeds
+            traceback.print_exc()
+            print(f'Scoring failed, retrying in {args.loop}s')
+        if args.loop is None:
+            break
+        time.sleep(args.loop)
@@ -0,0 +1,210 @@
+from pathlib import Path
+from concurrent.futures import ProcessPoolExecutor
+from itertools import product
+import numpy as np
+import pandas as pd
+import argparse
+import hashlib
+import json
+import os
+import shutil
+from joblib import dump
+from app.methods.feature_store import FeatureStore, FEATURE_STORE_PATH
+from app.methods.fips import load_fips_table
+from app.methods.labels import CUSTOMERS, expand_intervals, read_intervals
+from app.methods.model import FEATURES, Scaler, encode_state, artifact_version, scaler_path
+
+TARGET = CUSTOMERS
+
+# Hyperparameters searched by default, taken from the original notebook grid
+PARAM_GRID = {
+    'learning_rate': [0.01, 0.05, 0.1],
+    'max_depth': [3, 5, 6, 8],
+}
+
+def daily_labels(path='data/merged_data.csv'):
+    '''
+    Expands outage records into one row per (State, Date) the outage was ongoing, with the
+    largest number of customers affected and the longest outage duration in hours that day
+    '''
+    labels = expand_intervals(read_intervals(path), by=['State']).to_frame()
+    labels['Outage'] = 1
+    return labels[['State', 'Date', TARGET, 'hours', 'Outage']]
+
+def build_dataset(store, labels, start_date=None, end_date=None):
+    '''
+    Joins the state-wide daily features of the feature store with daily outage labels. Days
+    without an outage are labelled with no customers affected
+
+    Keyword arguments:\n
+    store -- A FeatureStore\n
+    labels -- DataFrame returned by daily_labels
+    '''
+    states = load_fips_table()[['StateFIPS', 'StateName']].drop_duplicates()
+    states = dict(zip(states['StateFIPS'].map('{:02d}'.format), states['StateName']))
+
+    df = store.frame([code for code in states], start_date, end_date)
+    df['State'] = df['Location'].map(states)
+    df = df.merge(labels, how='left', on=['State', 'Date'])
+    quiet = df['Outage'].isna()
+    df.loc[quiet, ['Outage', TARGET, 'hours']] = 0
+    df['State'] = df['State'].map(encode_state)
+    # Outage days with an unknown number of customers are dropped along with incomplete weather
+    df = df.dropna(subset=FEATURES + [TARGET])
+    return df.sort_values(['Location', 'Date'], kind='stable').reset_index(drop=True)
+
+def dataset_hash(X, y):
+    '''Returns a short content hash of a training set, used to key cached folds'''
+    sha = hashlib.sha256()
+    sha.update(np.ascontiguousarray(X, dtype=np.float64).tobytes())
+    sha.update(np.ascontiguousarray(y, dtype=np.float64).tobytes())
+    return sha.hexdigest()[:12]
+
+def cache_folds(X, y, folds, seed, cache_dir):
+    '''
+    Splits a training set into shuffled folds, standardizes each fold with statistics of its own
+    training part and saves them as .npy files that workers memory map. Folds already cached for
+    the same data, fold count and seed are reused. Returns the list of fold folders
+    '''
+    root = Path(cache_dir) / f'{dataset_hash(X, y)}-k{folds}-s{seed}'
+    order = np.random.default_rng(seed).permutation(len(X))
+    paths = []
+    for i, valid in enumerate(np.array_split(order, folds)):
+        path = root / f'fold{i}'
+        paths.append(str(path))
+        if (path / 'done').exists():
+            continue
+        path.mkdir(parents=True, exist_ok=True)
+        train = np.setdiff1d(order, valid)
+        mean, std = X[train].mean(axis=0), X[train].std(axis=0, ddof=1)
+        std[std == 0] = 1
+        np.save(path / 'X_train.npy', (X[train] - mean) / std)
+        np.save(path / 'y_train.npy', y[train])
+        np.save(path / 'X_valid.npy', (X[valid] - mean) / std)
+        np.save(path / 'y_valid.npy', y[valid])
+        (path / 'done').touch()
+    return paths
+
+def fit_fold(params, fold, max_rounds, early_stopping, seed):
+    '''
+    Trains on one cached fold with early stopping on its validation part.
+    Returns (params, validation RMSE, best number of rounds)
+    '''
+    from xgboost import XGBRegressor
+    fold = Path(fold)
+    X_train, y_train = np.load(fold / 'X_train.npy', mmap_mode='r'), np.load(fold / 'y_train.npy', mmap_mode='r')
+    X_valid, y_valid = np.load(fold / 'X_valid.npy', mmap_mode='r'), np.load(fold / 'y_valid.npy', mmap_mode='r')
+    model = XGBRegressor(objective='reg:squarederror', n_estimators=max_rounds, early_stopping_rounds=early_stopping,
+                         tree_method='hist', random_state=seed, n_jobs=1, **params)
+    model.fit(X_train, y_train, eval_set=[(X_valid, y_valid)], verbose=False)
+    return params, float(model.best_score), int(model.best_iteration) + 1
+
+def search(folds, grid, max_rounds=1000, early_stopping=10, seed=0, jobs=None):
+    '''
+    Cross validates every combination of grid on the cached folds, one process per (params, fold).
+    Returns a list of (params, mean RMSE, mean best rounds) sorted from best to worst
+    '''
+    combos = [dict(zip(grid, values)) for values in product(*grid.values())]
+    tasks = [(params, fold) for params in combos for fold in folds]
+    with ProcessPoolExecutor(max_workers=jobs) as pool:
+        results = list(pool.map(fit_fold, [p for p, _ in tasks], [f for _, f in tasks], [max_rounds]*len(tasks),
+                                [early_stopping]*len(tasks), [seed]*len(tasks)))
+
+    scores = {}
+    for params, rmse, rounds in results:
+        scores.setdefault(json.dumps(params, sort_keys=True), []).append((rmse, rounds))
+    ranked = [(json.loads(key), float(np.mean([r for r, _ in s])), int(round(np.mean([n for _, n in s]))))
+              for key, s in scores.items()]
+    return sorted(ranked, key=lambda x: x[1])
+
+def train_final(X, y, params, rounds, seed=0, jobs=None):
+    '''
+    Fits the scaler and the final model on the whole training set. Returns (model, scaler)
+    '''
+    from xgboost import XGBRegressor
+    scaler = Scaler(FEATURES, X.mean(axis=0), X.std(axis=0, ddof=1))
+    X_scaled = scaler.transform(pd.DataFrame(X, columns=FEATURES))
+    model = XGBRegressor(objective='reg:squarederror', n_estimators=rounds, tree_method='hist',
+                         random_state=seed, n_jobs=jobs or os.cpu_count(), **params)
+    model.fit(X_scaled, y, verbose=False)
+    return model, scaler
+
+def save_artifact(model, scaler, metadata, dest):
+    '''
+    Saves the model, its scaler statistics (which hold the feature order) and the training
+    metadata together in dest/<version>/, where version matches ModelRegistry.version.
+    Returns the artifact folder
+    '''
+    tmp = Path(dest) / '.partial'
+    shutil.rmtree(tmp, ignore_errors=True)
+    tmp.mkdir(parents=True)
+    dump(model, tmp / 'reg_model.joblib')
+    with open(tmp / 'reg_model.joblib', 'rb') as f:
+        scaler.model_sha256 = hashlib.sha256(f.read()).hexdigest()
+    scaler.save(tmp / 'reg_model.scaler.json')
+    version = artifact_version(tmp / 'reg_model.joblib', tmp / 'reg_model.scaler.json')
+    with open(tmp / 'metadata.json', 'w') as f:
+        json.dump(dict(metadata, version=version, features=FEATURES), f, indent=4)
+
+    folder = Path(dest) / version
+    shutil.rmtree(folder, ignore_errors=True)
+    os.replace(tmp, folder)
+    return folder
+
+def install_artifact(folder, model_path):
+    '''
+    Copies an artifact's files over the served model. Each replacement is atomic, and the
+    scaler holds the digest of its model, so a running ModelRegistry keeps serving the old pair
+    until both new files are in place and then hot-swaps to the new pair
+    '''
+    for src, dst in [('reg_model.scaler.json', scaler_path(model_path)), ('reg_model.joblib', model_path)]:
+        shutil.copyfile(Path(folder) / src, f'{dst}.tmp')
+        os.replace(f'{dst}.tmp', dst)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(prog='python -m helper_scripts.train', description='Train the regression model from the feature store')
+    parser.add_argument('-s', '--store', type=str, default=FEATURE_STORE_PATH, help='root folder of the feature store')
+    parser.add_argument('-l', '--labels', type=str, default='data/merged_data.csv', help='merged outage records used as labels')
+    parser.add_argument('-d', '--dest', type=str, default='models/', help='folder where versioned artifacts are saved')
+    parser.add_argument('-g', '--grid', type=str, default=None, help='JSON object of hyperparameter lists to search')
+    parser.add_argument('-k', '--folds', type=int, default=5, help='number of cross validation folds')
+    parser.add_argument('-j', '--jobs', type=int, default=None, help='number of training processes. Defaults to every core')
+    parser.add_argument('--rounds', type=int, default=1000, help='maximum number of boosting rounds')
+    parser.add_argument('--early-stopping', type=int, default=10, help='rounds without improvement before a fold stops')
+    parser.add_argument('--test-size', type=float, default=0.25, help='fraction of rows held out to report test metrics')
+    parser.add_argument('--seed', type=int, default=0, help='seed for the splits and the model')
+    parser.add_argument('--cache', type=str, default='.train_cache/', help='folder where fold datasets are cached')
+    parser.add_argument('--install', type=str, default=None, help='model path to install the new artifact to, e.g. reg_model.joblib')
+    args = parser.parse_args()
+
+    df = build_dataset(FeatureStore(args.store), daily_labels(args.labels))
+    if df.empty:
+        raise SystemExit(f'No training rows. Build the feature store with python -m helper_scripts.build_feature_store -d {args.store}')
+    X = df[FEATURES].to_numpy(dtype=np.float64)
+    y = df[TARGET].to_numpy(dtype=np.float64)
+
+    # Hold out a test set for reporting, the search only sees the rest
+    order = np.random.default_rng(args.seed).permutation(len(X))
+    test, train = np.split(order, [int(len(X) * args.test_size)])
+    print(f'{len(train)} training rows, {len(test)} test rows, {int(df["Outage"].sum())} outage days')
+
+    grid = json.loads(args.grid) if args.grid else PARAM_GRID
+    folds = cache_folds(X[train], y[train], args.folds, args.seed, args.cache)
+    ranked = search(folds, grid, args.rounds, args.early_stopping, args.seed, args.jobs)
+    for params, rmse, rounds in ranked:
+        print(f'{json.dumps(params, sort_keys=True)} RMSE {rmse:.1f} rounds {rounds}')
+    params, cv_rmse, rounds = ranked[0]
+
+    model, scaler = train_final(X[train], y[train], params, rounds, args.seed, args.jobs)
+    pred = model.predict(scaler.transform(pd.DataFrame(X[test], columns=FEATURES)))
+    test_rmse = float(np.sqrt(np.mean((pred - y[test]) ** 2)))
+    test_r2 = float(1 - np.sum((pred - y[test]) ** 2) / np.sum((y[test] - y[test].mean()) ** 2))
+
+    metadata = {'params': params, 'rounds': rounds, 'cv_rmse': cv_rmse, 'test_rmse': test_rmse, 'test_r2': test_r2,
+                'folds': args.folds, 'seed': args.seed, 'rows': len(X), 'data': dataset_hash(X, y)}
+    folder = save_artifact(model, scaler, metadata, args.dest)
+    print(f'Saved {folder} (test RMSE {test_rmse:.1f}, R2 {test_r2:.3f})')
+
+    if args.install:
+        install_artifact(folder, args.install)
+        print(f'Installed to {args.install}')
@@ -0,0 +1,68 @@
+import os
+import tempfile
+import unittest
+import datetime as dt
+from unittest import mock
+import app.methods.data as weather_data
+from app.methods import feature_store, model
+
+def fake_weather(location, startDate, endDate):
+    '''
+    Returns a Visual Crossing style response whose current description differs from the daily
+    ones, so rows built from the wrong part of the response score differently
+    '''
+    today = dt.date.today()
+    days = []
+    for d in range(8):
+        hours = [{'datetime': f'{h:02d}:00:00', 'precip': 0.1 * (h % 5) + d, 'snow': 0.0, 'snowdepth': 0.0,
+                  'windspeed': 10 + h % 7 + 3 * d} for h in range(24)]
+        days.append({'datetime': (today + dt.timedelta(days=d)).isoformat(), 'tempmin': 5 + d, 'tempmax': 15 + 2 * d,
+                     'description': 'Fog early. Snow later.' if d % 2 else 'Clear conditions throughout the day.',
+                     'hours': hours})
+    return {'description': 'Rain and thunderstorms with wind', 'days': days}
+
+def fake_weather_many(locations, startDate, endDate, max_workers=16):
+    return {location: fake_weather(location, startDate, endDate) for location in locations}
+
+class PredictBatchTest(unittest.TestCase):
+    def setUp(self):
+        # An empty store, so both paths build their rows from the weather API
+        self.store_dir = tempfile.TemporaryDirectory()
+        self.root = feature_store.store.root
+        feature_store.store.configure(self.store_dir.name)
+        patches = [mock.patch.object(weather_data, 'get_weather', fake_weather),
+                   mock.patch.object(weather_data, 'get_weather_many', fake_weather_many)]
+        for patch in patches:
+            patch.start()
+            self.addCleanup(patch.stop)
+
+    def tearDown(self):
+        feature_store.store.configure(self.root)
+        self.store_dir.cleanup()
+
+    def test_batch_matches_single_prediction(self):
+        for offset in (-30, 30):
+            start = (dt.datetime.utcnow() + dt.timedelta(hours=offset)).strftime('%Y-%m-%d %H:%M')
+            with self.subTest(offset=offset):
+                batch = model.predict_batch([{'county': 'Middlesex', 'state': 'New Jersey', 'start_date': start}])
+                single = model.predict(model.location_features('Middlesex', 'New Jersey', model.outage_hours(start)))
+                self.assertNotIn('error', batch[0])
+                self.assertAlmostEqual(batch[0]['customers_affected'], float(single[0]), delta=abs(float(single[0])) * 1e-4)
+
+class BatchEndpointTest(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        os.environ.setdefault('DATABASE_URL', 'sqlite://')
+        os.environ['WARM_UP'] = 'false'
+        from app import create_app
+        cls.client = create_app('config.DevelopmentConfig').test_client()
+
+    def test_rejects_bodies_that_are_not_objects(self):
+        for body in ([{'county': 'Middlesex', 'state': 'New Jersey', 'start_date': '2024-01-01 00:00'}], 'records', 3):
+            with self.subTest(body=body):
+                response = self.client.post('/regression-model/batch', json=body)
+                self.assertEqual(response.status_code, 400)
+                self.assertIn('error', response.get_json())
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,72 @@
+import time
+import threading
+import unittest
+from app.methods.cache import TTLCache
+
+class UpstreamTimeout(BaseException):
+    '''Stands in for gevent.Timeout, which derives from BaseException'''
+
+def slow_upstream(result=None, error=None, delay=0.2):
+    '''
+    Returns a fake upstream fetch that takes delay seconds, then returns result or raises error,
+    and the list of its calls
+    '''
+    calls = []
+
+    def fetch():
+        calls.append(time.time())
+        time.sleep(delay)
+        if error is not None:
+            raise error
+        return result
+    return fetch, calls
+
+def concurrent_get(cache, key, fetch, callers=5):
+    '''
+    Calls cache.get from several threads at once. Returns the value or exception of each caller
+    '''
+    outcomes = [None] * callers
+
+    def run(i):
+        try:
+            outcomes[i] = cache.get(key, fetch)
+        except BaseException as e:
+            outcomes[i] = e
+
+    threads = [threading.Thread(target=run, args=(i,)) for i in range(callers)]
+    threads[0].start()
+    time.sleep(0.05)   # The first caller leads the fetch, the others wait for it
+    for thread in threads[1:]:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return outcomes
+
+class TestSingleFlight(unittest.TestCase):
+    def test_waiters_share_the_result(self):
+        cache = TTLCache(ttl=60)
+        fetch, calls = slow_upstream(result={'temp': 20})
+        outcomes = concurrent_get(cache, 'weather', fetch)
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(outcomes, [{'temp': 20}] * 5)
+        stats = cache.stats()
+        self.assertEqual((stats['misses'], stats['waits'], stats['hits']), (1, 4, 0))
+        self.assertEqual(cache.get('weather', fetch), {'temp': 20})
+        self.assertEqual(cache.stats()['hits'], 1)
+
+    def test_waiters_get_the_leaders_exception(self):
+        cache = TTLCache(ttl=60)
+        error = UpstreamTimeout()
+        fetch, calls = slow_upstream(error=error)
+        outcomes = concurrent_get(cache, 'weather', fetch)
+        self.assertEqual(len(calls), 1)
+        self.assertTrue(all(outcome is error for outcome in outcomes))
+        self.assertEqual(cache.stats()['waits'], 4)
+
+        # Failures are not cached, the next lookup fetches again
+        fetch, calls = slow_upstream(result=1, delay=0)
+        self.assertEqual(cache.get('weather', fetch), 1)
+        self.assertEqual(len(calls), 1)
+
+if __name__ == '__main__':
+    unittest.main()
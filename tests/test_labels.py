@@ -0,0 +1,35 @@
+import unittest
+import numpy as np
+import pandas as pd
+from app.methods.labels import CUSTOMERS, expand_intervals
+
+def intervals(records):
+    '''
+    Returns intervals like read_intervals from (state, county, start, end, customers) tuples
+    '''
+    df = pd.DataFrame.from_records(records, columns=['State', 'County', 'Start', 'End', CUSTOMERS])
+    df['Start'], df['End'] = pd.to_datetime(df['Start']), pd.to_datetime(df['End'])
+    df['hours'] = (df['End'] - df['Start']).dt.total_seconds() / 3600
+    return df
+
+RECORDS = [('Ohio', 'Franklin', '2020-01-01 06:00', '2020-01-02 06:00', 100.0),
+           ('Ohio', 'None', '2020-01-02 00:00', '2020-01-02 12:00', 50.0),
+           ('Texas', 'Harris', '2020-01-01 00:00', '2020-01-01 08:00', 300.0)]
+
+class ByStateTest(unittest.TestCase):
+    def test_counts_counties_affected(self):
+        labels = expand_intervals(intervals(RECORDS), by=('State', 'County')).by_state()
+        self.assertEqual(list(labels.regions.get_level_values('State')), ['Ohio', 'Texas'])
+        np.testing.assert_array_equal(labels.outages, [[1, 1], [2, 0]])
+        # The state-wide Ohio record is not a county
+        np.testing.assert_array_equal(labels.affected, [[1, 1], [1, 0]])
+
+    def test_state_only_labels(self):
+        labels = expand_intervals(intervals(RECORDS), by=('State',)).by_state()
+        self.assertEqual(list(labels.regions.get_level_values('State')), ['Ohio', 'Texas'])
+        np.testing.assert_array_equal(labels.outages, [[1, 1], [2, 0]])
+        np.testing.assert_array_equal(labels.customers, [[100, 300], [100, np.nan]])
+        np.testing.assert_array_equal(labels.affected, np.zeros((2, 2)))
+
+if __name__ == '__main__':
+    unittest.main()